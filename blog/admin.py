@@ -58,19 +58,31 @@ class PostAdmin(admin.ModelAdmin):
 
 @admin.register(TagModel)
 class TagAdmin(admin.ModelAdmin):
-    list_display = ['name', 'slug']
+    list_display = ['name', 'slug', 'post_count']
     exclude = ['slug', ]
 
 
 @admin.register(ImagePostModel)
 class ImageAdmin(admin.ModelAdmin):
-    list_display = ['post', 'image']
+    list_display = ['post', 'image', 'status']
+    list_filter = ['status']
 
 
 @admin.register(EmojisModel)
 class EmojisAdmin(admin.ModelAdmin):
-    list_display = ['name', 'emoji']
+    list_display = ['name', 'emoji', 'post_count']
     exclude = ['slug', ]
 
 
+@admin.register(MediaBlobModel)
+class MediaBlobAdmin(admin.ModelAdmin):
+    list_display = ['name', 'size', 'refs', 'created']
+
+
+@admin.register(OutboxEmailModel)
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ['subject', 'to', 'status', 'attempts', 'next_attempt', 'created', 'sent']
+    list_filter = ['status']
+
+
 admin.site.register(User, UserAdmin)
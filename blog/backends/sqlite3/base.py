@@ -0,0 +1,25 @@
+"""SQLite с настраиваемым режимом начала транзакций.
+
+Django 3.2 начинает transaction.atomic() с BEGIN (DEFERRED). Транзакция,
+которая сначала читает, а потом пишет (например, get_or_create в
+blog.storage), в режиме WAL получает "database is locked" сразу, не дожидаясь
+busy_timeout, если другой процесс успел записать. С OPTIONS['transaction_mode']
+= 'IMMEDIATE' блокировка записи берется в начале транзакции и ожидается по
+busy_timeout. Название параметра совпадает с появившимся в Django 5.1.
+"""
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    transaction_mode = None
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        self.transaction_mode = params.pop('transaction_mode', None)
+        return params
+
+    def _start_transaction_under_autocommit(self):
+        if self.transaction_mode:
+            self.cursor().execute('BEGIN %s' % self.transaction_mode)
+        else:
+            super()._start_transaction_under_autocommit()
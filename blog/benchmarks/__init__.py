@@ -0,0 +1,19 @@
+"""Бенчмарки блога.
+
+Каждый модуль пакета предоставляет функцию run(**params), возвращающую словарь
+с результатами. Запуск: django-admin benchmark <имя> [--param key=value] [--output file.json]
+
+Данные для замеров создает data.seed() (команда seed_benchmark_data): queries
+заполняет ими отдельную тестовую базу, а load рассчитан на сервер, база
+которого заполнена заранее.
+"""
+from . import ingest, load, queries, resize, sqlite_concurrency, templates
+
+BENCHMARKS = {
+    'ingest': ingest.run,
+    'load': load.run,
+    'queries': queries.run,
+    'resize': resize.run,
+    'sqlite_concurrency': sqlite_concurrency.run,
+    'templates': templates.run,
+}
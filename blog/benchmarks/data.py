@@ -0,0 +1,167 @@
+"""Генератор данных для бенчмарков и нагрузочного теста.
+
+seed() создает пользователей, теги, emoji, посты и фото. Данные зависят
+только от параметров и seed, поэтому замеры на разных коммитах сравнимы.
+Строки вставляются через bulk_create, а все, что обычно делают сигналы
+(кластеры карты, поисковый индекс, счетчики, обложки и списки тегов),
+пересчитывается один раз в конце. Фото обрабатываются сразу в фоновом
+пуле (tasks.run_many). Все пользователи получают пароль PASSWORD, почта -
+bench<номер>@example.com (см. user_email).
+"""
+import random
+import tempfile
+from contextlib import contextmanager
+from datetime import timedelta
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.template import defaultfilters
+from django.test import override_settings
+from django.test.utils import setup_databases, teardown_databases
+from django.utils import timezone
+from unidecode import unidecode
+
+from blog import clusters, counters, geo, geocoder, search, tasks
+from blog.models import User, PostModel, TagModel, EmojisModel, ImagePostModel
+
+PASSWORD = 'benchmark-password'
+
+# Центры, вокруг которых разбросаны посты: (широта, долгота)
+PLACES = [
+    ('Москва', 55.75, 37.62),
+    ('Петербург', 59.94, 30.31),
+    ('Казань', 55.79, 49.12),
+    ('Сочи', 43.59, 39.72),
+    ('Байкал', 53.56, 108.16),
+    ('Алтай', 50.45, 86.10),
+    ('Камчатка', 53.02, 158.65),
+    ('Стамбул', 41.01, 28.98),
+    ('Тбилиси', 41.72, 44.79),
+    ('Рим', 41.90, 12.50),
+]
+
+WORDS = ['горы', 'море', 'озеро', 'город', 'музей', 'закат', 'поход', 'вокзал', 'рынок', 'храм', 'парк',
+         'мост', 'река', 'лес', 'дорога', 'перевал', 'пляж', 'крепость', 'водопад', 'набережная']
+
+TAGS = ['Горы', 'Море', 'Города', 'Музеи', 'Еда', 'Поход', 'Пляж', 'Архитектура', 'Природа', 'Зима']
+
+BATCH_SIZE = 500
+
+
+def user_email(number):
+    return 'bench%s@example.com' % number
+
+
+def _numbered(names, count):
+    """count уникальных имен: сначала names, дальше они же с номером."""
+    return [names[number % len(names)] + ('' if number < len(names) else ' %s' % (number // len(names) + 1))
+            for number in range(count)]
+
+
+def make_photo(rng, size=(800, 600)):
+    """JPEG с несколькими цветными прямоугольниками - у каждого фото свое содержимое."""
+    image = Image.new('RGB', size, tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(8):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.rectangle([x, y, x + rng.randrange(50, 300), y + rng.randrange(50, 300)],
+                       fill=tuple(rng.randrange(256) for _ in range(3)))
+    buffer = BytesIO()
+    image.save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
+
+
+def _users(count):
+    password = make_password(PASSWORD)
+    emails = [user_email(number) for number in range(count)]
+    User.objects.bulk_create([User(email=email, slug=email[:email.find('@')], password=password)
+                              for email in emails], ignore_conflicts=True)
+    return list(User.objects.filter(email__in=emails).order_by('pk'))
+
+
+def _tags(count):
+    names = _numbered(TAGS, count)
+    TagModel.objects.bulk_create([TagModel(name=name, slug=defaultfilters.slugify(unidecode(name)))
+                                  for name in names], ignore_conflicts=True)
+    return list(TagModel.objects.filter(name__in=names).order_by('pk'))
+
+
+def _emojis(count):
+    names = _numbered(['bench-emoji'], count)
+    slugs = [defaultfilters.slugify(name) for name in names]
+    EmojisModel.objects.bulk_create([EmojisModel(name=name[:20], slug=slug, emoji='blog/emoji/%s.png' % slug)
+                                     for name, slug in zip(names, slugs)], ignore_conflicts=True)
+    return list(EmojisModel.objects.filter(slug__in=slugs).order_by('pk'))
+
+
+def _posts(rng, count, users, tags, emojis):
+    start = PostModel.objects.count()
+    now = timezone.now()
+    posts = []
+    for number in range(start, start + count):
+        place, latitude, longitude = rng.choice(PLACES)
+        latitude, longitude = latitude + rng.gauss(0, 0.5), longitude + rng.gauss(0, 0.5)
+        title = '%s, %s %s' % (place, rng.choice(WORDS), number)
+        # lon хранит широту, lat - долготу (см. blog.geo)
+        posts.append(PostModel(author=rng.choice(users), emoji=rng.choice(emojis), title=title,
+                               text=' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 15))).capitalize(),
+                               slug=defaultfilters.slugify(unidecode(title)), lon=latitude, lat=longitude,
+                               geohash=geo.encode(latitude, longitude)))
+    countries = geocoder.country_ids([post.lon for post in posts], [post.lat for post in posts])
+    for post, country_id in zip(posts, countries):
+        post.country_id = country_id
+    PostModel.objects.bulk_create(posts, batch_size=BATCH_SIZE)
+    posts = list(PostModel.objects.filter(slug__in=[post.slug for post in posts]).order_by('pk'))
+    # Даты создания расходятся на минуты, как у настоящей ленты
+    for offset, post in enumerate(reversed(posts)):
+        post.datetime_create = now - timedelta(minutes=offset * 7 + rng.randrange(7))
+    PostModel.objects.bulk_update(posts, ['datetime_create'], batch_size=BATCH_SIZE)
+    links = [PostModel.tag.through(postmodel_id=post.pk, tagmodel_id=tag.pk)
+             for post in posts for tag in rng.sample(tags, min(len(tags), rng.randint(1, 3)))]
+    PostModel.tag.through.objects.bulk_create(links, batch_size=BATCH_SIZE)
+    return posts
+
+
+def _images(rng, posts, per_post):
+    field = ImagePostModel._meta.get_field('image')
+    images = []
+    for post in posts:
+        for _ in range(per_post):
+            image = ImagePostModel(post=post)
+            image.image = field.storage.save(field.generate_filename(image, 'photo.jpg'),
+                                             ContentFile(make_photo(rng)))
+            images.append(image)
+    ImagePostModel.objects.bulk_create(images, batch_size=BATCH_SIZE)
+    image_ids = ImagePostModel.objects.filter(post__in=posts, status=ImagePostModel.STATUS_PENDING)
+    tasks.run_many(tasks.process_image, [(image_id,) for image_id in image_ids.values_list('pk', flat=True)])
+    return len(images)
+
+
+def seed(users=10, posts=100, tags=10, emojis=5, images=1, seed=0):
+    """Заполняет базу данными для бенчмарков. Возвращает число созданных объектов."""
+    rng = random.Random(int(seed))
+    user_list = _users(int(users))
+    tag_list = _tags(int(tags))
+    emoji_list = _emojis(int(emojis))
+    post_list = _posts(rng, int(posts), user_list, tag_list, emoji_list)
+    image_count = _images(rng, post_list, int(images))
+
+    PostModel.objects.filter(pk__in=[post.pk for post in post_list]).refresh_summary()
+    clusters.rebuild(PostModel.objects.filter(lon__isnull=False).values_list('lon', 'lat').iterator())
+    search.rebuild()
+    counters.recount()
+    return {'users': len(user_list), 'tags': len(tag_list), 'emojis': len(emoji_list), 'posts': len(post_list),
+            'images': image_count}
+
+
+@contextmanager
+def temporary_database():
+    """Чистые тестовые базы (как у manage.py test) и временный MEDIA_ROOT на время замера."""
+    with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            yield
+        finally:
+            teardown_databases(old_config, verbosity=0)
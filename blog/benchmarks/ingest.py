@@ -0,0 +1,88 @@
+"""Пиковая память процесса при приеме одного загруженного фото.
+
+Каждый замер выполняется в отдельном свежем процессе (spawn), который читает
+фото из временного файла, как Django читает крупные загрузки. Сравнивается
+прежний способ (декодирование и запись результата в BytesIO) и blog.imaging
+(draft() и spooled-файл). Пик памяти - прирост VmHWM относительно RSS
+процесса перед обработкой, поэтому замер работает только в Linux.
+"""
+import multiprocessing
+import os
+import tempfile
+import time
+from io import BytesIO
+
+from PIL import Image
+
+from blog import imaging
+
+# Размеры синтетических фото: от обычного телефона до 48-мегапиксельной камеры
+RESOLUTIONS = [(4032, 3024), (8000, 6000)]
+
+
+def _memory_kb(field):
+    """Поле VmRSS или VmHWM из /proc/self/status в килобайтах."""
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+
+
+def make_jpeg(size, path):
+    """Записывает синтетическое фото заданного размера в JPEG."""
+    Image.effect_noise(size, 64).convert('RGB').save(path, format='JPEG', quality=90)
+
+
+def _legacy(path):
+    image = Image.open(path)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    output = BytesIO()
+    image.thumbnail(imaging.SIZES['full'], Image.LANCZOS)
+    image.save(output, format='JPEG', quality=75)
+    return len(output.getvalue())
+
+
+def _ingest(path):
+    total = 0
+    with open(path, 'rb') as file:
+        for *_, content in imaging.iter_derivatives(file, 'photo.jpg'):
+            with content:
+                total += content.size
+    return total
+
+
+def _measure(method, path, queue):
+    baseline = _memory_kb('VmRSS')
+    started = time.perf_counter()
+    output_size = method(path)
+    elapsed = time.perf_counter() - started
+    queue.put({'peak_rss_kb': _memory_kb('VmHWM') - baseline,
+               'seconds': round(elapsed, 4),
+               'output_bytes': output_size})
+
+
+def run(repeat=3):
+    results = []
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as directory:
+        for size in RESOLUTIONS:
+            path = os.path.join(directory, '%sx%s.jpg' % size)
+            make_jpeg(size, path)
+            for name, method in (('legacy', _legacy), ('imaging', _ingest)):
+                samples = []
+                for _ in range(int(repeat)):
+                    queue = context.Queue()
+                    process = context.Process(target=_measure, args=(method, path, queue))
+                    process.start()
+                    samples.append(queue.get())
+                    process.join()
+                results.append({
+                    'method': name,
+                    'resolution': '%sx%s' % size,
+                    'input_bytes': os.path.getsize(path),
+                    'peak_rss_kb': max(sample['peak_rss_kb'] for sample in samples),
+                    'seconds': min(sample['seconds'] for sample in samples),
+                    'output_bytes': samples[0]['output_bytes'],
+                })
+    return {'benchmark': 'ingest', 'results': results}
@@ -0,0 +1,229 @@
+"""Нагрузочный тест запущенного сервера по основным сценариям пользователей.
+
+Каждый виртуальный пользователь - отдельный поток со своими cookie - входит
+под своей учетной записью из data.seed() (bench<номер>@example.com) и до
+конца теста выбирает сценарии из MIX с указанными весами:
+
+- sign_in: выход и повторный вход;
+- home: домашняя лента;
+- post_detail: страница случайного поста из ленты;
+- create_post: форма создания поста и отправка поста с фото;
+- update_profile: форма профиля и сохранение даты рождения.
+
+Время сценария включает все его запросы и переходы по редиректам. Сервер
+запускается отдельно (runserver или gunicorn) на базе, заполненной командой
+seed_benchmark_data, например:
+
+    django-admin benchmark load --param url=http://127.0.0.1:8000 --param users=20
+"""
+import json
+import random
+import re
+import statistics
+import threading
+import time
+import uuid
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode, urljoin
+from urllib.request import HTTPCookieProcessor, Request, build_opener
+
+from django.urls import reverse
+
+from . import data
+
+# Сценарий -> вес при случайном выборе
+MIX = {
+    'sign_in': 2,
+    'home': 40,
+    'post_detail': 45,
+    'create_post': 5,
+    'update_profile': 8,
+}
+
+TIMEOUT = 30
+
+_CSRF = re.compile(r'name="csrfmiddlewaretoken" value="([^"]+)"')
+_TAGS = re.compile(r'name="tag" value="(\d+)"')
+_EMOJIS = re.compile(r'<option value="(\d+)"')
+
+
+class FlowError(Exception):
+    pass
+
+
+class VirtualUser:
+    """Пользователь сайта со своими cookie"""
+
+    def __init__(self, base_url, number, post_urls, rng):
+        self.base_url = base_url
+        self.email = data.user_email(number)
+        self.slug = self.email[:self.email.find('@')]
+        self.post_urls = post_urls
+        self.rng = rng
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()))
+        self.photo = data.make_photo(rng, (1600, 1200))
+        self.signed_in = False
+
+    def request(self, path, fields=None, files=None):
+        """GET, а при fields - POST формы. Возвращает (адрес после редиректов, текст ответа)."""
+        url = urljoin(self.base_url, path)
+        headers = {'Referer': url}
+        body = None
+        if files:
+            body, content_type = _multipart(fields, files)
+            headers['Content-Type'] = content_type
+        elif fields is not None:
+            body = urlencode(fields, doseq=True).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        try:
+            with self.opener.open(Request(url, body, headers), timeout=TIMEOUT) as response:
+                return response.geturl(), response.read().decode('utf-8')
+        except HTTPError as error:
+            raise FlowError('%s %s' % (error.code, path))
+        except URLError as error:
+            raise FlowError('%s %s' % (error.reason, path))
+
+    def form(self, path):
+        """Открывает страницу формы и возвращает (html, csrf-токен)."""
+        _, html = self.request(path)
+        token = _CSRF.search(html)
+        if token is None:
+            raise FlowError('Нет формы на %s' % path)
+        return html, token.group(1)
+
+    def expect(self, url, path):
+        if not url.endswith(path):
+            raise FlowError('Ожидался переход на %s, получен %s' % (path, url))
+
+    def sign_in(self):
+        if self.signed_in:
+            self.request(reverse('logout'))
+        _, token = self.form(reverse('sign_in'))
+        url, _ = self.request(reverse('sign_in'), {'csrfmiddlewaretoken': token, 'username': self.email,
+                                                   'password': data.PASSWORD})
+        self.expect(url, reverse('home'))
+        self.signed_in = True
+
+    def home(self):
+        self.request(reverse('home'))
+
+    def post_detail(self):
+        self.request(self.rng.choice(self.post_urls))
+
+    def create_post(self):
+        html, token = self.form(reverse('create-post'))
+        tags, emojis = _TAGS.findall(html), _EMOJIS.findall(html)
+        if not emojis:
+            raise FlowError('Нет emoji в форме поста')
+        _, latitude, longitude = self.rng.choice(data.PLACES)
+        fields = {
+            'csrfmiddlewaretoken': token,
+            'title': 'Нагрузка %s' % uuid.uuid4().hex[:12],
+            'text': ' '.join(self.rng.choice(data.WORDS) for _ in range(10)),
+            'tag': self.rng.sample(tags, min(len(tags), 2)),
+            'emoji': self.rng.choice(emojis),
+            'lon': str(latitude + self.rng.gauss(0, 0.5)),
+            'lat': str(longitude + self.rng.gauss(0, 0.5)),
+        }
+        url, _ = self.request(reverse('create-post'), fields, {'images': ('photo.jpg', self.photo, 'image/jpeg')})
+        if url.endswith(reverse('create-post')):
+            raise FlowError('Пост не создан')
+        self.post_urls.append(url)
+
+    def update_profile(self):
+        _, token = self.form(reverse('profile', kwargs={'url': self.slug}))
+        birthday = '%02d.%02d.%s' % (self.rng.randint(1, 28), self.rng.randint(1, 12), self.rng.randint(1960, 2005))
+        url, _ = self.request(reverse('profile', kwargs={'url': self.slug}),
+                              {'csrfmiddlewaretoken': token, 'email': self.email, 'birthday': birthday,
+                               'sex': '', 'country': ''})
+        self.expect(url, reverse('home'))
+
+
+def _multipart(fields, files):
+    """Тело multipart/form-data: fields - {имя: значение или список}, files - {имя: (файл, байты, тип)}."""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, values in fields.items():
+        for value in values if isinstance(values, list) else [values]:
+            parts.append(('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n'
+                          % (boundary, name, value)).encode())
+    for name, (filename, content, content_type) in files.items():
+        parts.append(('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                      'Content-Type: %s\r\n\r\n' % (boundary, name, filename, content_type)).encode())
+        parts.append(content + b'\r\n')
+    parts.append(('--%s--\r\n' % boundary).encode())
+    return b''.join(parts), 'multipart/form-data; boundary=%s' % boundary
+
+
+def _post_urls(base_url, pages):
+    """Адреса постов из первых страниц ленты (JSON-вариант, см. PostFeedView)."""
+    user = VirtualUser(base_url, 0, [], random.Random(0))
+    user.sign_in()
+    urls, cursor = [], None
+    for _ in range(pages):
+        _, text = user.request(reverse('feed') + ('?' + urlencode({'cursor': cursor}) if cursor else ''))
+        page = json.loads(text)
+        urls.extend(item['url'] for item in page['posts'])
+        cursor = page['next']
+        if not cursor:
+            break
+    return urls
+
+
+def _worker(user, deadline, samples, errors):
+    flows, weights = list(MIX), list(MIX.values())
+    try:
+        user.sign_in()
+    except FlowError as error:
+        errors['sign_in'].append(str(error))
+        return
+    while time.perf_counter() < deadline:
+        flow = user.rng.choices(flows, weights)[0]
+        started = time.perf_counter()
+        try:
+            getattr(user, flow)()
+        except FlowError as error:
+            errors[flow].append(str(error))
+        else:
+            samples[flow].append(time.perf_counter() - started)
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def run(url='http://127.0.0.1:8000', users=10, duration=30, accounts=10, pages=25, seed=0):
+    users, duration, accounts = int(users), float(duration), int(accounts)
+    post_urls = _post_urls(url, int(pages))
+    if not post_urls:
+        raise FlowError('В ленте нет постов - заполните базу командой seed_benchmark_data')
+    samples = {flow: [] for flow in MIX}
+    errors = {flow: [] for flow in MIX}
+    deadline = time.perf_counter() + duration
+    threads = [threading.Thread(target=_worker, args=(
+        VirtualUser(url, number % accounts, post_urls, random.Random('%s-%s' % (seed, number))),
+        deadline, samples, errors)) for number in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results = []
+    for flow in MIX:
+        values = samples[flow]
+        result = {'flow': flow, 'count': len(values), 'errors': len(errors[flow]),
+                  'per_second': round(len(values) / duration, 2)}
+        if values:
+            result.update({
+                'median_ms': round(statistics.median(values) * 1000, 1),
+                'p95_ms': round(_percentile(values, 95) * 1000, 1),
+                'p99_ms': round(_percentile(values, 99) * 1000, 1),
+                'max_ms': round(max(values) * 1000, 1),
+            })
+        if errors[flow]:
+            result['first_error'] = errors[flow][0]
+        results.append(result)
+    return {'benchmark': 'load', 'url': url, 'users': users, 'duration': duration,
+            'total_per_second': round(sum(len(values) for values in samples.values()) / duration, 2),
+            'results': results}
@@ -0,0 +1,70 @@
+"""Время и число запросов к базе для основных выборок блога.
+
+Замер идет на отдельной тестовой базе, которую заполняет data.seed(), так
+что результат не зависит от данных разработчика. Кэш отключен (DummyCache):
+измеряется слой запросов, а не попадания. Для каждой выборки выводится
+минимальное и медианное время из repeat повторов и число SQL-запросов.
+"""
+import statistics
+import time
+
+from django.db import connection, reset_queries
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+
+from blog import clusters, nearby, pagination, search
+from blog.models import PostModel, TagModel, EmojisModel
+from blog.templatetags.cloudtags import tag_cloud
+from . import data
+
+DUMMY_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+
+
+def _operations():
+    """Выборки по имени; данные для параметров берутся из уже заполненной базы."""
+    post = PostModel.objects.order_by('pk')[PostModel.objects.count() // 2]
+    middle = pagination.encode_cursor(post)
+    tag = TagModel.objects.order_by('-post_count').first()
+    emoji = EmojisModel.objects.order_by('-post_count').first()
+    _, latitude, longitude = data.PLACES[0]
+    return {
+        'feed_first_page': lambda: list(pagination.paginate(PostModel.objects.all(), None, 4)),
+        'feed_deep_page': lambda: list(pagination.paginate(PostModel.objects.all(), middle, 4)),
+        'post_detail': lambda: PostModel.objects.with_related().get(slug=post.slug).images,
+        'tag_page': lambda: list(pagination.paginate(PostModel.objects.filter(tag=tag), None, 12)),
+        'emoji_page': lambda: list(pagination.paginate(PostModel.objects.filter(emoji=emoji), None, 12)),
+        'map_bbox': lambda: list(PostModel.objects.in_bbox(latitude - 1, longitude - 1,
+                                                           latitude + 1, longitude + 1)[:500]),
+        'map_clusters': lambda: list(clusters.in_bbox(4, -60, -180, 80, 180)),
+        'search': lambda: search.search(data.WORDS[0]),
+        'nearby': lambda: nearby.nearest(latitude, longitude, 10),
+        'tag_cloud': lambda: tag_cloud(),
+    }
+
+
+def _measure(operation, repeat):
+    # При DEBUG журнал запросов ограничен, после заполнения базы он уже полон
+    reset_queries()
+    with CaptureQueriesContext(connection) as context:
+        operation()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        operation()
+        samples.append(time.perf_counter() - started)
+    return {
+        'queries': len(context.captured_queries),
+        'min_ms': round(min(samples) * 1000, 3),
+        'median_ms': round(statistics.median(samples) * 1000, 3),
+    }
+
+
+def run(users=20, posts=2000, tags=30, emojis=5, images=0, repeat=50, seed=0):
+    repeat = int(repeat)
+    results = []
+    with data.temporary_database(), override_settings(CACHES=DUMMY_CACHES):
+        created = data.seed(users=users, posts=posts, tags=tags, emojis=emojis, images=images, seed=seed)
+        for name, operation in _operations().items():
+            results.append(dict(operation=name, **_measure(operation, repeat)))
+    return {'benchmark': 'queries', 'repeat': repeat, 'data': created,
+            'results': results}
@@ -0,0 +1,55 @@
+"""Время подготовки копий загруженного фото и аватара.
+
+Для каждого разрешения синтетическое фото (ingest.make_jpeg) проходит через
+imaging.iter_derivatives так же, как в ImagePostModel.process: замеряется
+полное время и время каждой копии (размер и формат) отдельно - копия
+кодируется, когда генератор ее отдает, а в первую входит и декодирование.
+Отдельно замеряется make_avatar. Берется минимум из repeat повторов.
+"""
+import os
+import tempfile
+import time
+
+from blog import imaging
+from .ingest import make_jpeg
+
+
+def _derivatives(path):
+    """Время каждой копии в секундах и общее время."""
+    timings = {}
+    started = time.perf_counter()
+    with open(path, 'rb') as file:
+        previous = started
+        for size, _, _, format_name, content in imaging.iter_derivatives(file, 'photo.jpg'):
+            content.close()
+            now = time.perf_counter()
+            timings['%s:%s' % (size, format_name)] = now - previous
+            previous = now
+    return timings, time.perf_counter() - started
+
+
+def _avatar(path):
+    started = time.perf_counter()
+    with open(path, 'rb') as file:
+        imaging.make_avatar(file).close()
+    return time.perf_counter() - started
+
+
+def run(resolutions='1280x960,4032x3024', repeat=5):
+    repeat = int(repeat)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for resolution in str(resolutions).split(','):
+            size = tuple(int(value) for value in resolution.split('x'))
+            path = os.path.join(directory, '%s.jpg' % resolution)
+            make_jpeg(size, path)
+            samples = [_derivatives(path) for _ in range(repeat)]
+            results.append({
+                'resolution': resolution,
+                'input_bytes': os.path.getsize(path),
+                'total_ms': round(min(total for _, total in samples) * 1000, 2),
+                'derivatives_ms': {name: round(min(timings[name] for timings, _ in samples) * 1000, 2)
+                                   for name in samples[0][0]},
+                'avatar_ms': round(min(_avatar(path) for _ in range(repeat)) * 1000, 2),
+            })
+    return {'benchmark': 'resize', 'repeat': repeat, 'formats': imaging.available_formats(), 'results': results}
@@ -0,0 +1,148 @@
+"""Пропускная способность SQLite при одновременной работе нескольких процессов.
+
+Каждый рабочий процесс (spawn) открывает свое соединение, как процесс
+gunicorn/uwsgi, и в течение duration секунд выполняет смесь запросов:
+чтение страницы ленты с фото постов и запись - создание поста с фото
+и сохранение сессии в одной транзакции, как CreateNewPostView. Сессия
+сначала читается, потом пишется, как в SessionStore.save(). Замер
+повторяется на свежей базе без PRAGMA (как у Django по умолчанию: журнал
+DELETE, synchronous=FULL, ожидание блокировки 5 с, BEGIN) и с SQLITE_PRAGMAS
+и BEGIN IMMEDIATE, как в blog.backends.sqlite3.
+"""
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from django.conf import settings
+
+from blog.db import pragma_statements
+
+SCHEMA = [
+    'CREATE TABLE post (id INTEGER PRIMARY KEY, title TEXT, text TEXT, created REAL)',
+    'CREATE INDEX post_created ON post (created DESC)',
+    'CREATE TABLE image (id INTEGER PRIMARY KEY, post_id INTEGER, name TEXT)',
+    'CREATE INDEX image_post ON image (post_id)',
+    'CREATE TABLE session (key TEXT PRIMARY KEY, data TEXT, expire REAL)',
+]
+
+IMAGES_PER_POST = 3
+
+
+def _connect(path, pragmas):
+    # Как Django: режим autocommit, таймаут sqlite3 по умолчанию 5 с
+    connection = sqlite3.connect(path, timeout=5.0, isolation_level=None)
+    for statement in pragma_statements(pragmas):
+        connection.execute(statement)
+    return connection
+
+
+def _create(path, pragmas, rows):
+    connection = _connect(path, pragmas)
+    for statement in SCHEMA:
+        connection.execute(statement)
+    connection.execute('BEGIN')
+    for number in range(rows):
+        post_id = connection.execute('INSERT INTO post (title, text, created) VALUES (?, ?, ?)',
+                                     ('Пост %s' % number, 'Текст ' * 50, number)).lastrowid
+        connection.executemany('INSERT INTO image (post_id, name) VALUES (?, ?)',
+                               [(post_id, 'photo%s.jpg' % index) for index in range(IMAGES_PER_POST)])
+    connection.execute('COMMIT')
+    connection.close()
+
+
+def _read(connection):
+    posts = connection.execute('SELECT id, title, text FROM post ORDER BY created DESC LIMIT 4').fetchall()
+    ids = [post[0] for post in posts]
+    connection.execute('SELECT post_id, name FROM image WHERE post_id IN (%s)' % ', '.join('?' * len(ids)),
+                       ids).fetchall()
+
+
+def _write(connection, worker, rng, begin):
+    key = 'session-%s-%s' % (worker, rng.randrange(100))
+    connection.execute(begin)
+    try:
+        connection.execute('SELECT data FROM session WHERE key = ?', (key,)).fetchone()
+        post_id = connection.execute('INSERT INTO post (title, text, created) VALUES (?, ?, ?)',
+                                     ('Новый пост', 'Текст ' * 50, time.time())).lastrowid
+        connection.executemany('INSERT INTO image (post_id, name) VALUES (?, ?)',
+                               [(post_id, 'photo%s.jpg' % index) for index in range(IMAGES_PER_POST)])
+        connection.execute('INSERT OR REPLACE INTO session (key, data, expire) VALUES (?, ?, ?)',
+                           (key, 'x' * 200, time.time() + 3600))
+        connection.execute('COMMIT')
+    except sqlite3.OperationalError:
+        if connection.in_transaction:
+            connection.execute('ROLLBACK')
+        raise
+
+
+def _worker(path, pragmas, begin, worker, start_at, duration, write_ratio, queue):
+    connection = _connect(path, pragmas)
+    rng = random.Random(worker)
+    counts = {'reads': 0, 'writes': 0, 'locked': 0}
+    write_latencies = []
+    time.sleep(max(0.0, start_at - time.time()))
+    deadline = start_at + duration
+    while time.time() < deadline:
+        started = time.perf_counter()
+        try:
+            if rng.random() < write_ratio:
+                _write(connection, worker, rng, begin)
+                counts['writes'] += 1
+                write_latencies.append(time.perf_counter() - started)
+            else:
+                _read(connection)
+                counts['reads'] += 1
+        except sqlite3.OperationalError:
+            counts['locked'] += 1
+    connection.close()
+    queue.put((counts, write_latencies))
+
+
+def _percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def _measure(pragmas, begin, workers, duration, write_ratio, rows):
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'db.sqlite3')
+        _create(path, pragmas, rows)
+        queue = context.Queue()
+        start_at = time.time() + 2 + 0.2 * workers
+        processes = [context.Process(target=_worker,
+                                     args=(path, pragmas, begin, worker, start_at, duration, write_ratio, queue))
+                     for worker in range(workers)]
+        for process in processes:
+            process.start()
+        results = [queue.get() for _ in processes]
+        for process in processes:
+            process.join()
+    totals = {'reads': 0, 'writes': 0, 'locked': 0}
+    latencies = []
+    for counts, write_latencies in results:
+        for name in totals:
+            totals[name] += counts[name]
+        latencies.extend(write_latencies)
+    return {
+        'reads_per_second': round(totals['reads'] / duration, 1),
+        'writes_per_second': round(totals['writes'] / duration, 1),
+        'locked_errors': totals['locked'],
+        'write_p95_ms': round(_percentile(latencies, 95) * 1000, 2) if latencies else None,
+    }
+
+
+def run(workers=4, duration=5, write_ratio=0.2, rows=2000):
+    workers, duration, write_ratio, rows = int(workers), float(duration), float(write_ratio), int(rows)
+    results = []
+    for name, pragmas, begin in (('default', {}, 'BEGIN'), ('tuned', settings.SQLITE_PRAGMAS, 'BEGIN IMMEDIATE')):
+        result = _measure(pragmas, begin, workers, duration, write_ratio, rows)
+        result.update({'pragmas': name, 'workers': workers})
+        results.append(result)
+    return {'benchmark': 'sqlite_concurrency', 'duration': duration, 'write_ratio': write_ratio,
+            'results': results}
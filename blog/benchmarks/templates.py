@@ -0,0 +1,115 @@
+"""Время рендера основных шаблонов в зависимости от числа постов.
+
+index.html рендерится со страницей из N постов, post_detail.html - с постом
+из N фото и N тегов, base.html - как база для сравнения. Объекты создаются
+в памяти, база не нужна; кэш фрагментов отключается (DummyCache), чтобы
+измерять рендер, а не попадания. Каждый шаблон загружается заново на каждый
+рендер, как во view, поэтому видна разница между обычным и кэширующим
+загрузчиком (TEMPLATE_LOADERS). Отдельно сравниваются прежний цикл пунктов
+меню карты в шаблоне и json_script.
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.template import Context
+from django.template.backends.django import DjangoTemplates
+from django.test import RequestFactory, override_settings
+from django.utils import timezone
+
+from blog.models import User, PostModel, TagModel, EmojisModel, ImagePostModel
+from blog.views import PostFeedView
+
+DUMMY_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+
+# Пункты меню карты так, как index.html строил их до перехода на json_script
+LEGACY_ITEMS = '''{% load l10n %}var items = [
+{% for post in posts %}{
+    center: [{{ post.lon|unlocalize }}, {{ post.lat|unlocalize }}],
+    url: "{{ post.get_absolute_url }}",
+    icon: "{{ post.title }}"
+},
+{% endfor %}]'''
+
+JSON_ITEMS = "{{ map_items|json_script:'map-items' }}"
+
+
+def _backend(cached):
+    options = dict(settings.TEMPLATES[0]['OPTIONS'])
+    loaders = settings.TEMPLATE_LOADERS
+    options['loaders'] = [('django.template.loaders.cached.Loader', loaders)] if cached else loaders
+    return DjangoTemplates({'NAME': 'benchmark', 'DIRS': settings.TEMPLATES[0]['DIRS'], 'APP_DIRS': False,
+                            'OPTIONS': options})
+
+
+def _objects(count):
+    user = User(pk=1, email='author@example.com', slug='author')
+    emoji = EmojisModel(pk=1, name='smile', emoji='blog/emoji/smile.png', slug='smile')
+    tags = [TagModel(pk=number, name='Тег %s' % number, slug='tag-%s' % number) for number in range(count)]
+    now = timezone.now()
+    posts = []
+    for number in range(count):
+        post = PostModel(pk=number + 1, author=user, emoji=emoji, title='Пост "%s" <b>' % number,
+                         text='Текст поста ' * 20, slug='post-%s' % number, lon=55 + number / 1000,
+                         lat=37 + number / 1000, datetime_create=now - timedelta(minutes=number),
+                         datetime_update=now, tag_list=[tag.name for tag in tags[:3]])
+        post._prefetched_objects_cache = {'tag': tags[:3]}
+        posts.append(post)
+    detail = posts[0]
+    detail._prefetched_objects_cache = {'tag': tags}
+    detail.images = [ImagePostModel(pk=number + 1, post=detail, image='blog/post/photo%s.jpg' % number,
+                                    status=ImagePostModel.STATUS_READY) for number in range(count)]
+    return user, posts, detail
+
+
+def _time(render, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        render()
+        samples.append(time.perf_counter() - started)
+    return round(min(samples) * 1000, 3)
+
+
+def run(sizes='10,100,1000', repeat=20):
+    sizes = [int(size) for size in str(sizes).split(',')]
+    repeat = int(repeat)
+    results = []
+    with override_settings(CACHES=DUMMY_CACHES):
+        for count in sizes:
+            user, posts, detail = _objects(count)
+            request = RequestFactory().get('/')
+            request.user = user
+            contexts = {
+                'blog/base.html': {'title': 'Домашняя'},
+                'blog/index.html': {'title': 'Домашняя', 'posts': posts, 'post_zoom': 15,
+                                    'map_items': [PostFeedView.get_item(post) for post in posts]},
+                'blog/post_detail.html': {'title': detail.title, 'post': detail, 'images': detail.images,
+                                          'col_images': len(detail.images)},
+            }
+            for cached in (False, True):
+                backend = _backend(cached)
+                for name, context in contexts.items():
+                    results.append({
+                        'template': name,
+                        'posts': count,
+                        'loader': 'cached' if cached else 'default',
+                        'ms': _time(lambda: backend.get_template(name).render(context, request), repeat),
+                    })
+            # Для json_script в замер входит и подготовка пунктов во view
+            engine = _backend(True).engine
+            legacy = engine.from_string(LEGACY_ITEMS)
+            json_items = engine.from_string(JSON_ITEMS)
+            renders = {
+                'legacy_loop': lambda: legacy.render(Context({'posts': posts})),
+                'json_script': lambda: json_items.render(Context({
+                    'map_items': [PostFeedView.get_item(post) for post in posts]})),
+            }
+            for name, render in renders.items():
+                results.append({
+                    'template': 'map_items:%s' % name,
+                    'posts': count,
+                    'loader': 'compiled',
+                    'ms': _time(render, repeat),
+                })
+    return {'benchmark': 'templates', 'repeat': repeat, 'results': results}
@@ -0,0 +1,104 @@
+"""Кэш отрендеренных фрагментов постов.
+
+Ключ фрагмента включает PostModel.datetime_update, поэтому изменение поста
+(а сигналы обновляют datetime_update и при изменении его тегов и фото)
+автоматически делает старые фрагменты недоступными - старые версии просто
+вытесняются кэшем по таймауту. Попадания и промахи считаются по видам
+фрагментов в пределах процесса, см. stats().
+"""
+import threading
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Count, Max
+from django.http import HttpResponse
+
+from . import metrics
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def _cache():
+    return caches[settings.FRAGMENT_CACHE_ALIAS]
+
+
+def _count(kind, hits, misses):
+    with _stats_lock:
+        _stats[(kind, 'hit')] += hits
+        _stats[(kind, 'miss')] += misses
+    metrics.count_cache(hits, misses)
+
+
+def stats():
+    """Счетчики попаданий и промахов: {вид фрагмента: {'hit': .., 'miss': ..}}."""
+    with _stats_lock:
+        result = {}
+        for (kind, outcome), value in _stats.items():
+            result.setdefault(kind, {'hit': 0, 'miss': 0})[outcome] = value
+        return result
+
+
+def fragment_key(kind, post):
+    """Ключ фрагмента вида kind для текущей версии поста."""
+    return 'post:%s:%s:%s' % (kind, post.pk, post.datetime_update.timestamp())
+
+
+def get_or_render(kind, post, render):
+    """Фрагмент из кэша или результат render(), сохраненный в кэш."""
+    key = fragment_key(kind, post)
+    fragment = _cache().get(key)
+    if fragment is not None:
+        _count(kind, 1, 0)
+        return fragment
+    _count(kind, 0, 1)
+    fragment = render()
+    _cache().set(key, fragment, settings.FRAGMENT_CACHE_TIMEOUT)
+    return fragment
+
+
+def get_or_render_many(kind, posts, render):
+    """То же для списка постов: одно чтение get_many и одна запись set_many."""
+    keys = [fragment_key(kind, post) for post in posts]
+    cached = _cache().get_many(keys)
+    missing = {}
+    fragments = []
+    for key, post in zip(keys, posts):
+        if key not in cached:
+            missing[key] = cached[key] = render(post)
+        fragments.append(cached[key])
+    if missing:
+        _cache().set_many(missing, settings.FRAGMENT_CACHE_TIMEOUT)
+    _count(kind, len(keys) - len(missing), len(missing))
+    return fragments
+
+
+def invalidate(post, kinds):
+    """Удаляет фрагменты текущей версии поста (например, при его удалении)."""
+    _cache().delete_many([fragment_key(kind, post) for kind in kinds])
+
+
+def feed_version():
+    """Версия ленты одним агрегатом: время последнего изменения поста и число постов.
+
+    Число постов нужно, чтобы версия менялась и при удалении поста.
+    """
+    from .models import PostModel
+    version = PostModel.objects.aggregate(last=Max('datetime_update'), count=Count('pk'))
+    return version['last'], version['count']
+
+
+def get_response(key):
+    """Ответ из кэша, собранный заново из тела, статуса и типа содержимого, или None."""
+    cached = _cache().get('response:%s' % key)
+    _count('response', int(cached is not None), int(cached is None))
+    if cached is None:
+        return None
+    content, status, content_type = cached
+    return HttpResponse(content, status=status, content_type=content_type)
+
+
+def set_response(key, response, timeout):
+    """Кэширует только тело, статус и тип содержимого: cookie и прочие заголовки ответа не переиспользуются."""
+    _cache().set('response:%s' % key, (response.content, response.status_code, response['Content-Type']), timeout)
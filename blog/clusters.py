@@ -0,0 +1,136 @@
+"""Серверная кластеризация меток карты по сетке.
+
+Для каждого уровня зума мир делится на ячейки CELL_SIZE x CELL_SIZE пикселей
+(проекция Web Mercator, как у карты Яндекса). В MapClusterModel для каждой
+непустой ячейки хранится число постов и сумма координат, из которой считается
+центр кластера. Таблица обновляется инкрементально при сохранении
+и удалении постов, поэтому запрос карты читает готовые кластеры.
+"""
+import math
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import F, Q
+
+from .models import MapClusterModel
+
+CLUSTER_MAX_ZOOM = 14
+CELL_SIZE = 64
+TILE_SIZE = 256
+MAX_LATITUDE = 85.05112878
+
+
+def _pixels(latitude, longitude, zoom):
+    """Координаты точки в пикселях мировой карты на заданном зуме."""
+    world = TILE_SIZE * 2 ** zoom
+    latitude = max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude))
+    sin = math.sin(math.radians(latitude))
+    x = (longitude + 180.0) / 360.0 * world
+    y = (0.5 - math.log((1 + sin) / (1 - sin)) / (4 * math.pi)) * world
+    return min(max(x, 0), world - 1), min(max(y, 0), world - 1)
+
+
+def cell_of(latitude, longitude, zoom):
+    """Ячейка сетки (x, y), в которую попадает точка."""
+    x, y = _pixels(latitude, longitude, zoom)
+    return int(x // CELL_SIZE), int(y // CELL_SIZE)
+
+
+def _cells(latitude, longitude):
+    """Ячейки (zoom, x, y) точки на всех уровнях кластеризации."""
+    return [(zoom,) + cell_of(latitude, longitude, zoom) for zoom in range(CLUSTER_MAX_ZOOM + 1)]
+
+
+def _cells_query(latitude, longitude):
+    query = Q()
+    for zoom, x, y in _cells(latitude, longitude):
+        query |= Q(zoom=zoom, x=x, y=y)
+    return query
+
+
+def add_point(latitude, longitude):
+    """Учитывает новую точку во всех уровнях зума."""
+    with transaction.atomic():
+        MapClusterModel.objects.bulk_create(
+            [MapClusterModel(zoom=zoom, x=x, y=y) for zoom, x, y in _cells(latitude, longitude)],
+            ignore_conflicts=True,
+        )
+        MapClusterModel.objects.filter(_cells_query(latitude, longitude)).update(
+            count=F('count') + 1,
+            latitude_sum=F('latitude_sum') + latitude,
+            longitude_sum=F('longitude_sum') + longitude,
+        )
+
+
+def remove_point(latitude, longitude):
+    """Убирает точку из кластеров и удаляет опустевшие ячейки."""
+    cells = MapClusterModel.objects.filter(_cells_query(latitude, longitude))
+    with transaction.atomic():
+        cells.update(
+            count=F('count') - 1,
+            latitude_sum=F('latitude_sum') - latitude,
+            longitude_sum=F('longitude_sum') - longitude,
+        )
+        cells.filter(count__lte=0).delete()
+
+
+def _totals(points):
+    """Число точек и суммы координат по ячейкам (zoom, x, y)."""
+    totals = defaultdict(lambda: [0, 0.0, 0.0])
+    for latitude, longitude in points:
+        for cell in _cells(latitude, longitude):
+            total = totals[cell]
+            total[0] += 1
+            total[1] += latitude
+            total[2] += longitude
+    return totals
+
+
+def add_points(points, batch_size=300):
+    """Учитывает сразу много новых точек (импорт): ячейки читаются и пишутся пачками, а не по точке."""
+    totals = _totals(points)
+    cells = list(totals)
+    with transaction.atomic():
+        for start in range(0, len(cells), batch_size):
+            batch = cells[start:start + batch_size]
+            # Как в add_point: сначала пустые ячейки, затем прибавка к заблокированным строкам
+            MapClusterModel.objects.bulk_create([MapClusterModel(zoom=zoom, x=x, y=y) for zoom, x, y in batch],
+                                                ignore_conflicts=True)
+            query = Q()
+            for zoom, x, y in batch:
+                query |= Q(zoom=zoom, x=x, y=y)
+            updated = list(MapClusterModel.objects.select_for_update().filter(query))
+            for cluster in updated:
+                count, latitude_sum, longitude_sum = totals[cluster.zoom, cluster.x, cluster.y]
+                cluster.count += count
+                cluster.latitude_sum += latitude_sum
+                cluster.longitude_sum += longitude_sum
+            MapClusterModel.objects.bulk_update(updated, ['count', 'latitude_sum', 'longitude_sum'])
+    return len(cells)
+
+
+def rebuild(points):
+    """Полностью пересобирает кластеры по итератору пар (latitude, longitude)."""
+    totals = _totals(points)
+    with transaction.atomic():
+        MapClusterModel.objects.all().delete()
+        MapClusterModel.objects.bulk_create(
+            [MapClusterModel(zoom=zoom, x=x, y=y, count=count,
+                             latitude_sum=latitude_sum, longitude_sum=longitude_sum)
+             for (zoom, x, y), (count, latitude_sum, longitude_sum) in totals.items()],
+            batch_size=1000,
+        )
+    return len(totals)
+
+
+def in_bbox(zoom, south, west, north, east):
+    """Кластеры уровня zoom, попадающие в область карты."""
+    zoom = max(0, min(CLUSTER_MAX_ZOOM, zoom))
+    x_min, y_min = cell_of(north, west, zoom)
+    x_max, y_max = cell_of(south, east, zoom)
+    if x_min <= x_max:
+        columns = Q(x__gte=x_min, x__lte=x_max)
+    else:
+        # Область пересекает 180-й меридиан
+        columns = Q(x__gte=x_min) | Q(x__lte=x_max)
+    return MapClusterModel.objects.filter(columns, zoom=zoom, y__gte=y_min, y__lte=y_max, count__gt=0)
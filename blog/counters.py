@@ -0,0 +1,46 @@
+"""Материализованные счетчики постов у тегов и emoji.
+
+TagModel.post_count и EmojisModel.post_count меняются сигналами на величину
+изменения (F-выражением), поэтому облако тегов и меню emoji читают готовые
+числа без COUNT ... GROUP BY по таблице связей. Команда recount_posts
+пересчитывает счетчики целиком, если они разошлись с данными.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .models import PostModel, TagModel, EmojisModel
+
+
+def _change(model, deltas):
+    """Прибавляет к post_count объектов model изменения {pk: delta}, по запросу на каждое значение delta."""
+    groups = defaultdict(list)
+    for pk, delta in deltas.items():
+        if delta:
+            groups[delta].append(pk)
+    with transaction.atomic():
+        for delta, pks in groups.items():
+            model.objects.filter(pk__in=pks).update(post_count=F('post_count') + delta)
+
+
+def change_tags(deltas):
+    _change(TagModel, deltas)
+
+
+def change_emojis(deltas):
+    _change(EmojisModel, deltas)
+
+
+def _count(queryset, field):
+    counts = queryset.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(count=Count('*'))
+    return Coalesce(Subquery(counts.values('count'), output_field=IntegerField()), Value(0))
+
+
+def recount():
+    """Пересчитывает все счетчики по базе. Возвращает (число тегов, число emoji)."""
+    with transaction.atomic():
+        tags = TagModel.objects.update(post_count=_count(PostModel.tag.through.objects, 'tagmodel_id'))
+        emojis = EmojisModel.objects.update(post_count=_count(PostModel.objects, 'emoji_id'))
+    return tags, emojis
@@ -0,0 +1,38 @@
+"""Обслуживание соединений с базой.
+
+Каждое новое соединение с SQLite настраивается PRAGMA из настройки
+SQLITE_PRAGMAS (WAL, synchronous, busy_timeout, mmap и кэш страниц).
+
+В Django 3.2 нет CONN_HEALTH_CHECKS: постоянное соединение (CONN_MAX_AGE),
+оборванное базой или сетью, обнаруживается только ошибкой запроса. Здесь
+в начале каждого запроса соединения с CONN_HEALTH_CHECKS проверяются
+через is_usable() и закрываются, если они неработоспособны, - Django
+откроет новое при первом обращении.
+"""
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+def pragma_statements(pragmas):
+    """SQL для применения словаря PRAGMA."""
+    return ['PRAGMA %s = %s' % (name, value) for name, value in pragmas.items()]
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for statement in pragma_statements(getattr(settings, 'SQLITE_PRAGMAS', {})):
+            cursor.execute(statement)
+
+
+@receiver(request_started)
+def check_connections(**kwargs):
+    for connection in connections.all():
+        if (connection.settings_dict.get('CONN_HEALTH_CHECKS') and connection.connection is not None
+                and not connection.in_atomic_block and not connection.is_usable()):
+            connection.close()
@@ -1,15 +1,13 @@
 import datetime
-import sys
-from io import BytesIO
 
-from PIL import Image
 from django import forms
 from django.contrib.auth import get_user_model
 from django.contrib.auth.forms import ReadOnlyPasswordHashField, AuthenticationForm
 from django.core.exceptions import ValidationError
-from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.core.validators import FileExtensionValidator
 
-from .models import CountryModel, SexModel, PostModel
+from . import imaging
+from .models import CountryModel, SexModel, PostModel, EmojisModel
 
 from django.utils.translation import gettext_lazy as _
 
@@ -115,16 +113,12 @@ class UserChangeForm(forms.ModelForm):
 
     def save(self, *args, **kwargs):
         instance = super().save(commit=False)
-        image_temporary = Image.open(self.cleaned_data.get("avatar"))
-        if image_temporary.mode != 'RGB':
-            image_temporary = image_temporary.convert('RGB')
-        output_io_stream = BytesIO()
-        image_temporary.thumbnail((50, 50), Image.ANTIALIAS)
-        image_temporary.save(output_io_stream, format='JPEG', quality=75)
-        output_io_stream.seek(0)
-        instance.avatar = InMemoryUploadedFile(output_io_stream, 'ImageField', "avatar.jpg", 'image/jpeg',
-                                               sys.getsizeof(output_io_stream), None)
+        old_avatar = User.objects.filter(pk=instance.pk).values_list('avatar', flat=True).first()
+        if 'avatar' in self.changed_data:
+            instance.avatar = imaging.make_avatar(self.cleaned_data.get("avatar"))
         instance.save()
+        if old_avatar and old_avatar != instance.avatar.name and old_avatar != User.avatar.field.default:
+            instance.avatar.storage.delete(old_avatar)
         return instance
 
 
@@ -145,10 +139,11 @@ class CreatePostForm(forms.ModelForm):
     images = forms.ImageField(label='Изображения',
                               widget=forms.ClearableFileInput(attrs={'class': 'form-control',
                                                                      'multiple': True}))
-    lon = forms.FloatField(localize=True, widget=forms.TextInput(attrs={'class': 'form-control',
-                                                                        'hidden': True}))
-    lat = forms.FloatField(localize=True, widget=forms.TextInput(attrs={'class': 'form-control',
-                                                                        'hidden': True}))
+    # Если точку на карте не выбрали, координаты берутся из геотегов фото (см. ImagePostModel.process)
+    lon = forms.FloatField(localize=True, required=False, widget=forms.TextInput(attrs={'class': 'form-control',
+                                                                                        'hidden': True}))
+    lat = forms.FloatField(localize=True, required=False, widget=forms.TextInput(attrs={'class': 'form-control',
+                                                                                        'hidden': True}))
 
     class Meta:
         model = PostModel
@@ -160,6 +155,12 @@ class CreatePostForm(forms.ModelForm):
             'text': forms.Textarea(attrs={'class': 'form-control'}),
         }
 
+    def clean(self):
+        cleaned_data = super().clean()
+        if (cleaned_data.get('lon') is None) != (cleaned_data.get('lat') is None):
+            raise ValidationError('Укажите обе координаты или ни одной')
+        return cleaned_data
+
     # Для  SQLite, не проверяет на этапе моделей длину
     def clean_title(self):
         title = self.cleaned_data['title']
@@ -173,3 +174,14 @@ class CreatePostForm(forms.ModelForm):
         if len(text) > 150:
             raise ValidationError('Длина текста не должна превышать 150 символов')
         return text
+
+
+class ImportTripForm(forms.Form):
+    """Форма загрузки архива поездки (см. blog.trips)"""
+    archive = forms.FileField(label='Архив ZIP с фото и файлами GPX/GeoJSON',
+                              validators=[FileExtensionValidator(['zip'])],
+                              widget=forms.FileInput(attrs={'class': 'form-control'}))
+    emoji = forms.ModelChoiceField(EmojisModel.objects.all(),
+                                   label='Emoji постов, для которых оно не указано',
+                                   required=False,
+                                   widget=forms.Select(attrs={'class': 'form-select'}))
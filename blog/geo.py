@@ -0,0 +1,139 @@
+"""Геопространственные утилиты: geohash и покрытие области карты.
+
+Обратите внимание: в PostModel поле ``lon`` хранит широту, а ``lat`` — долготу
+(так их заполняет карта Яндекса в create_post.html, см. verbose_name полей).
+Функции этого модуля принимают координаты в явном виде: latitude, longitude.
+"""
+
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+GEOHASH_PRECISION = 9
+
+
+def encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    """Возвращает geohash точки заданной длины."""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(geohash) < precision:
+        if even:
+            mid = (lon_range[0] + lon_range[1]) / 2
+            if longitude >= mid:
+                bits = bits * 2 + 1
+                lon_range[0] = mid
+            else:
+                bits = bits * 2
+                lon_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if latitude >= mid:
+                bits = bits * 2 + 1
+                lat_range[0] = mid
+            else:
+                bits = bits * 2
+                lat_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(geohash)
+
+
+def _cell_size(precision):
+    """Размер ячейки geohash в градусах: (высота по широте, ширина по долготе)."""
+    bits = 5 * precision
+    lon_bits = (bits + 1) // 2
+    lat_bits = bits // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+def _next_prefix(prefix):
+    """Следующий за prefix geohash той же длины или None, если prefix последний."""
+    chars = list(prefix)
+    while chars:
+        index = _BASE32.index(chars[-1])
+        if index < len(_BASE32) - 1:
+            chars[-1] = _BASE32[index + 1]
+            return ''.join(chars)
+        chars.pop()
+    return None
+
+
+def _steps(start, stop, step):
+    value = start
+    while value < stop:
+        yield value
+        value += step
+    yield stop
+
+
+def _cover(south, west, north, east, max_cells):
+    """Префиксы geohash, покрывающие прямоугольник, не пересекающий 180-й меридиан."""
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        cell_lat, cell_lon = _cell_size(precision)
+        rows = int((north - south) / cell_lat) + 2
+        columns = int((east - west) / cell_lon) + 2
+        if rows * columns <= max_cells or precision == 1:
+            break
+    prefixes = set()
+    for latitude in _steps(south, north, cell_lat):
+        for longitude in _steps(west, east, cell_lon):
+            prefixes.add(encode(latitude, longitude, precision))
+    return prefixes
+
+
+def bbox_ranges(south, west, north, east, max_cells=32):
+    """Диапазоны geohash [start, end), покрывающие область карты.
+
+    Соседние ячейки склеиваются в один диапазон, поэтому область превращается
+    в несколько range-запросов по индексу. end равен None для открытого диапазона.
+    """
+    south, north = max(south, -90.0), min(north, 90.0)
+    if west <= east:
+        prefixes = _cover(south, west, north, east, max_cells)
+    else:
+        # Область пересекает 180-й меридиан - покрываем две половины.
+        prefixes = _cover(south, west, north, 180.0, max_cells // 2)
+        prefixes |= _cover(south, -180.0, north, east, max_cells // 2)
+
+    ranges = []
+    for prefix in sorted(prefixes):
+        end = _next_prefix(prefix)
+        if ranges and (ranges[-1][1] is None or ranges[-1][1] >= prefix):
+            if ranges[-1][1] is not None and (end is None or end > ranges[-1][1]):
+                ranges[-1][1] = end
+            continue
+        ranges.append([prefix, end])
+    return [tuple(item) for item in ranges]
+
+
+def parse_bbox(value):
+    """Разбирает строку 'south,west,north,east' в кортеж float."""
+    try:
+        south, west, north, east = (float(part) for part in value.split(','))
+    except (AttributeError, ValueError):
+        raise ValueError('bbox должен иметь вид south,west,north,east')
+    if not (-90 <= south <= north <= 90):
+        raise ValueError('некорректные границы широты')
+    if east - west >= 360:
+        return south, -180.0, north, 180.0
+    # Карта может отдавать долготу за пределами [-180, 180] после прокрутки мира.
+    west = (west + 180) % 360 - 180
+    east = (east + 180) % 360 - 180 if east % 360 != 180 else 180.0
+    return south, west, north, east
+
+
+def parse_point(value):
+    """Разбирает строку 'latitude,longitude' в кортеж float."""
+    try:
+        latitude, longitude = (float(part) for part in value.split(','))
+    except (AttributeError, ValueError):
+        raise ValueError('point должен иметь вид latitude,longitude')
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('некорректные координаты точки')
+    return latitude, longitude
@@ -0,0 +1,240 @@
+"""Офлайн-определение страны по координатам (обратное геокодирование).
+
+Границы стран читаются из GeoJSON с полигонами (settings.COUNTRY_BOUNDARIES).
+В проект входит blog/data/countries.geojson - границы 177 стран Natural Earth
+1:110m (admin 0, public domain) с русскими названиями в NAME_RU. У границ и
+побережий он ошибается на 10-20 км; для большей точности файл можно заменить
+на Natural Earth 1:50m или 1:10m (название страны берется из свойств NAME_RU,
+name или NAME). Внешние сервисы не нужны.
+
+Поверх полигонов строится сеточный индекс с ячейками CELL_SIZE градусов.
+Ячейка, целиком лежащая внутри одной страны, сразу дает ответ; для ячеек,
+через которые проходит граница, хранится список полигонов-кандидатов, и точка
+проверяется по ним лучевым методом. Поиск векторизован NumPy по всем точкам
+пачки, поэтому assign() проставляет страну сотням тысяч постов за секунды.
+"""
+import json
+import threading
+from collections import defaultdict
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+CELL_SIZE = 1.0
+COLUMNS = int(360 / CELL_SIZE)
+ROWS = int(180 / CELL_SIZE)
+
+# Свойства GeoJSON с названием страны, по порядку предпочтения
+NAME_PROPERTIES = ['NAME_RU', 'name_ru', 'name', 'NAME', 'ADMIN']
+
+# Значения ячейки сетки, кроме номера страны
+NOWHERE = -1
+BORDER = -2
+
+# Постов в одном UPDATE: держимся в пределах числа параметров запроса SQLite
+UPDATE_BATCH_SIZE = 500
+
+_lock = threading.Lock()
+_index = None
+
+
+def _cells(latitudes, longitudes):
+    """Номера строки и столбца сетки для массивов координат в градусах."""
+    rows = np.clip(((np.asarray(latitudes, dtype=float) + 90) // CELL_SIZE).astype(int), 0, ROWS - 1)
+    columns = np.clip(((np.asarray(longitudes, dtype=float) + 180) // CELL_SIZE).astype(int), 0, COLUMNS - 1)
+    return rows, columns
+
+
+def _contains(edges, latitudes, longitudes, block=1000000):
+    """Какие точки лежат внутри полигона: четность пересечений луча на восток с ребрами.
+
+    edges - массив (ребро, [x1, y1, x2, y2]) всех колец полигона, так что дыры
+    учитываются сами. Ребра перебираются блоками, чтобы матрица ребра x точки
+    не превышала block элементов.
+    """
+    inside = np.zeros(len(latitudes), dtype=bool)
+    if not len(latitudes):
+        return inside
+    x, y = np.asarray(longitudes)[None, :], np.asarray(latitudes)[None, :]
+    step = max(1, block // len(latitudes))
+    for start in range(0, len(edges), step):
+        x1, y1, x2, y2 = (column[:, None] for column in edges[start:start + step].T)
+        crosses = (y1 > y) != (y2 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            hits = crosses & (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+        inside ^= np.count_nonzero(hits, axis=0) % 2 == 1
+    return inside
+
+
+class CountryIndex:
+    """Полигоны стран и сеточный индекс над ними."""
+
+    def __init__(self, countries):
+        """countries - список (название, [полигон, ...]), полигон - список колец [[долгота, широта], ...]."""
+        self.names = []
+        self.polygons = []
+        claims = defaultdict(set)
+        border = np.zeros((ROWS, COLUMNS), dtype=bool)
+        for name, polygons in countries:
+            country = len(self.names)
+            self.names.append(name)
+            for rings in polygons:
+                polygon = len(self.polygons)
+                edges = np.concatenate([np.hstack([ring[:-1], ring[1:]])
+                                        for ring in (np.asarray(ring, dtype=float) for ring in rings) if len(ring) > 1])
+                self.polygons.append((country, edges))
+                crossed = self._crossed_cells(edges)
+                for cell in crossed:
+                    claims[cell].add(polygon)
+                    border[cell] = True
+                for cell in self._inner_cells(edges, crossed):
+                    claims[cell].add(polygon)
+        # Ячейка без границ внутри одной страны отвечает сразу, остальные проверяются по кандидатам
+        self.grid = np.full((ROWS, COLUMNS), NOWHERE, dtype=np.int32)
+        self.candidates = defaultdict(list)
+        for cell, polygons in claims.items():
+            if not border[cell] and len(polygons) == 1:
+                self.grid[cell] = self.polygons[next(iter(polygons))][0]
+            else:
+                self.grid[cell] = BORDER
+                for polygon in polygons:
+                    self.candidates[polygon].append(cell[0] * COLUMNS + cell[1])
+        self.candidates = {polygon: np.array(cells) for polygon, cells in self.candidates.items()}
+
+    @staticmethod
+    def _crossed_cells(edges):
+        """Ячейки, которые задевает прямоугольник хотя бы одного ребра."""
+        first_rows, first_columns = _cells(np.minimum(edges[:, 1], edges[:, 3]), np.minimum(edges[:, 0], edges[:, 2]))
+        last_rows, last_columns = _cells(np.maximum(edges[:, 1], edges[:, 3]), np.maximum(edges[:, 0], edges[:, 2]))
+        cells = set()
+        for row_range in zip(first_rows, last_rows, first_columns, last_columns):
+            first_row, last_row, first_column, last_column = (int(value) for value in row_range)
+            cells.update((row, column) for row in range(first_row, last_row + 1)
+                         for column in range(first_column, last_column + 1))
+        return cells
+
+    @staticmethod
+    def _inner_cells(edges, crossed):
+        """Ячейки в рамке полигона без ребер, центр которых внутри полигона (значит, и вся ячейка)."""
+        first_rows, first_columns = _cells(edges[:, [1, 3]].min(), edges[:, [0, 2]].min())
+        last_rows, last_columns = _cells(edges[:, [1, 3]].max(), edges[:, [0, 2]].max())
+        rows, columns = np.meshgrid(np.arange(first_rows, last_rows + 1), np.arange(first_columns, last_columns + 1),
+                                    indexing='ij')
+        rows, columns = rows.ravel(), columns.ravel()
+        free = np.array([(row, column) not in crossed for row, column in zip(rows.tolist(), columns.tolist())],
+                        dtype=bool)
+        rows, columns = rows[free], columns[free]
+        inside = _contains(edges, (rows + 0.5) * CELL_SIZE - 90, (columns + 0.5) * CELL_SIZE - 180)
+        return zip(rows[inside].tolist(), columns[inside].tolist())
+
+    @classmethod
+    def from_geojson(cls, path):
+        with open(path, encoding='utf-8') as file:
+            data = json.load(file)
+        countries = []
+        for feature in data.get('features', []):
+            properties = feature.get('properties') or {}
+            geometry = feature.get('geometry') or {}
+            name = next((properties[key] for key in NAME_PROPERTIES if properties.get(key)), None)
+            if not name or geometry.get('type') not in ('Polygon', 'MultiPolygon'):
+                continue
+            polygons = geometry['coordinates'] if geometry['type'] == 'MultiPolygon' else [geometry['coordinates']]
+            countries.append((name, polygons))
+        return cls(countries)
+
+    def lookup(self, latitudes, longitudes):
+        """Номера стран (индексы в names) для массивов координат; NOWHERE - вне известных стран."""
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        rows, columns = _cells(latitudes, longitudes)
+        result = self.grid[rows, columns]
+        pending = np.flatnonzero(result == BORDER)
+        result[pending] = NOWHERE
+        if not len(pending):
+            return result
+        cells = rows[pending] * COLUMNS + columns[pending]
+        for polygon, (country, edges) in enumerate(self.polygons):
+            if polygon not in self.candidates:
+                continue
+            checked = np.flatnonzero(np.isin(cells, self.candidates[polygon]) & (result[pending] == NOWHERE))
+            points = pending[checked]
+            result[points[_contains(edges, latitudes[points], longitudes[points])]] = country
+        return result
+
+    def name_at(self, latitude, longitude):
+        country = int(self.lookup([latitude], [longitude])[0])
+        return None if country == NOWHERE else self.names[country]
+
+
+def get_index():
+    """Индекс границ стран, загружается при первом обращении."""
+    global _index
+    with _lock:
+        if _index is None:
+            _index = CountryIndex.from_geojson(settings.COUNTRY_BOUNDARIES)
+        return _index
+
+
+def _country_ids(names):
+    """pk CountryModel для названий; недостающие страны создаются."""
+    from .models import CountryModel
+    existing = dict(CountryModel.objects.filter(name__in=names).order_by().values_list('name', 'pk'))
+    missing = [name for name in names if name not in existing]
+    if missing:
+        CountryModel.objects.bulk_create([CountryModel(name=name) for name in missing])
+        existing.update(CountryModel.objects.filter(name__in=missing).values_list('name', 'pk'))
+    return [existing[name] for name in names]
+
+
+def country_ids(latitudes, longitudes):
+    """pk стран для массивов координат (None - вне известных стран), по запросу на пачку."""
+    index = get_index()
+    countries = index.lookup(latitudes, longitudes)
+    found = np.unique(countries[countries != NOWHERE]).tolist()
+    pks = dict(zip(found, _country_ids([index.names[country] for country in found])))
+    return [pks.get(country) for country in countries.tolist()]
+
+
+def country_id(latitude, longitude):
+    """pk страны точки или None, если точка вне известных стран."""
+    if latitude is None or longitude is None:
+        return None
+    return country_ids([latitude], [longitude])[0]
+
+
+def assign(posts, batch_size=20000):
+    """Проставляет страну постам queryset пачками по batch_size. Возвращает число постов со страной.
+
+    Посты обновляются через update() по странам, без сигналов, но с новым
+    datetime_update, чтобы сменились кэш фрагментов и версия ленты. Посты,
+    у которых страна уже верная, не меняются.
+    """
+    from . import stats
+    from .models import PostModel
+    posts = posts.filter(lon__isnull=False, lat__isnull=False).order_by('pk')
+    found = 0
+    authors = set()
+    last = 0
+    while True:
+        # lon хранит широту, lat - долготу (см. blog.geo)
+        rows = list(posts.filter(pk__gt=last).values_list('pk', 'author_id', 'lon', 'lat', 'country_id')[:batch_size])
+        if not rows:
+            break
+        last = rows[-1][0]
+        post_ids, author_ids, latitudes, longitudes, old_countries = zip(*rows)
+        countries = country_ids(latitudes, longitudes)
+        changed = defaultdict(list)
+        for post_id, author_id, old_country, country in zip(post_ids, author_ids, old_countries, countries):
+            if country != old_country:
+                changed[country].append(post_id)
+                authors.add(author_id)
+        now = timezone.now()
+        for country, selected in changed.items():
+            for start in range(0, len(selected), UPDATE_BATCH_SIZE):
+                PostModel.objects.filter(pk__in=selected[start:start + UPDATE_BATCH_SIZE]).update(
+                    country_id=country, datetime_update=now)
+        found += sum(country is not None for country in countries)
+    for author_id in authors:
+        stats.invalidate(author_id)
+    return found
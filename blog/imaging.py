@@ -0,0 +1,144 @@
+"""Прием загруженных изображений: уменьшение, перекодирование и копии фото постов.
+
+Весь код работы с Pillow собран здесь. Изображение декодируется один раз:
+для JPEG через Image.draft() сразу в уменьшенном масштабе, что в разы снижает
+потребление памяти на фото с телефона. Результат пишется во временный
+SpooledTemporaryFile: до IMAGE_SPOOL_MAX_MEMORY байт в памяти, дальше на диск.
+"""
+import os
+from datetime import datetime, timedelta, timezone
+from tempfile import SpooledTemporaryFile
+
+from PIL import Image
+from django.conf import settings
+from django.core.files import File
+
+# Размер копии -> ограничивающий прямоугольник. Копии пишутся от большей к меньшей.
+SIZES = {
+    'full': (1280, 720),
+    'card': (640, 360),
+    'balloon': (320, 180),
+    'thumb': (160, 90),
+}
+
+AVATAR_SIZE = (50, 50)
+
+# Теги EXIF: вложенные каталоги GPS и Exif, время съемки и смещение часового пояса
+EXIF_GPS_IFD = 0x8825
+EXIF_IFD = 0x8769
+EXIF_DATETIME = 0x0132
+EXIF_DATETIME_ORIGINAL = 0x9003
+EXIF_OFFSET_TIME_ORIGINAL = 0x9011
+
+# Формат -> (формат Pillow, расширение, MIME-тип, параметры сохранения)
+FORMATS = {
+    'avif': ('AVIF', 'avif', 'image/avif', {'quality': 50}),
+    'webp': ('WEBP', 'webp', 'image/webp', {'quality': 70}),
+    'jpeg': ('JPEG', 'jpg', 'image/jpeg', {'quality': 75}),
+}
+
+
+def available_formats():
+    """Форматы, которые умеет сохранять установленный Pillow; JPEG есть всегда."""
+    Image.init()
+    return [name for name, (pillow_format, *_) in FORMATS.items() if pillow_format in Image.SAVE]
+
+
+def open_image(file, box, metadata=None):
+    """Открывает изображение и декодирует его в RGB не крупнее, чем нужно для box.
+
+    Для JPEG draft() выбирает масштаб декодирования 1/2, 1/4 или 1/8, так что
+    полноразмерный растр в памяти не создается. Если передан словарь metadata,
+    в него попадают location и taken из EXIF (см. image_metadata) - заголовок
+    уже прочитан при открытии, второй раз файл не разбирается.
+    """
+    image = Image.open(file)
+    if metadata is not None:
+        metadata['location'], metadata['taken'] = image_metadata(image)
+    if image.format == 'JPEG':
+        image.draft('RGB', box)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return image
+
+
+def encode(image, format_name, name):
+    """Кодирует изображение в файл с ограниченным потреблением памяти.
+
+    Возвращает django File с корректным size, который можно передать
+    в FieldFile.save() или storage.save().
+    """
+    pillow_format, extension, _, options = FORMATS[format_name]
+    spool = SpooledTemporaryFile(max_size=settings.IMAGE_SPOOL_MAX_MEMORY)
+    image.save(spool, format=pillow_format, **options)
+    file = File(spool, name='%s.%s' % (os.path.splitext(name)[0], extension))
+    file.size = spool.tell()
+    spool.seek(0)
+    return file
+
+
+def iter_derivatives(file, name, metadata=None):
+    """Декодирует фото один раз и по очереди отдает его копии всех размеров.
+
+    Генерирует кортежи (размер, ширина, высота, формат, File). Следующая копия
+    кодируется только после того, как предыдущая обработана, поэтому в памяти
+    одновременно находится не больше одного результата. Файл нужно закрыть
+    после сохранения. metadata заполняется до первой копии, как в open_image.
+    """
+    image = open_image(file, SIZES['full'], metadata)
+    formats = available_formats()
+    for size, box in SIZES.items():
+        image.thumbnail(box, Image.LANCZOS)
+        for format_name in formats:
+            yield size, image.width, image.height, format_name, encode(image, format_name, name)
+
+
+def make_avatar(file):
+    """Уменьшает аватар до AVATAR_SIZE и перекодирует его в JPEG."""
+    image = open_image(file, AVATAR_SIZE)
+    image.thumbnail(AVATAR_SIZE, Image.LANCZOS)
+    return encode(image, 'jpeg', 'avatar.jpg')
+
+
+def _degrees(value, reference, negative):
+    """Градусы из трех рациональных чисел EXIF (градусы, минуты, секунды)."""
+    degrees, minutes, seconds = (float(part) for part in value)
+    degrees += minutes / 60 + seconds / 3600
+    return -degrees if reference == negative else degrees
+
+
+def _taken(exif):
+    """Время съемки из EXIF. Без смещения часового пояса возвращается наивное время."""
+    details = exif.get_ifd(EXIF_IFD)
+    value = details.get(EXIF_DATETIME_ORIGINAL) or exif.get(EXIF_DATETIME)
+    try:
+        taken = datetime.strptime(str(value).strip('\x00 '), '%Y:%m:%d %H:%M:%S')
+    except ValueError:
+        return None
+    offset = str(details.get(EXIF_OFFSET_TIME_ORIGINAL) or '').strip('\x00 ')
+    if len(offset) == 6 and offset[0] in '+-' and offset[3] == ':':
+        minutes = int(offset[1:3]) * 60 + int(offset[4:6])
+        taken = taken.replace(tzinfo=timezone(timedelta(minutes=-minutes if offset[0] == '-' else minutes)))
+    return taken
+
+
+def read_exif(file):
+    """Координаты и время съемки фото из EXIF без декодирования растра."""
+    return image_metadata(Image.open(file))
+
+
+def image_metadata(image):
+    """Координаты и время съемки открытого изображения из EXIF.
+
+    Возвращает ((широта, долгота) или None, datetime или None).
+    """
+    exif = image.getexif()
+    gps = exif.get_ifd(EXIF_GPS_IFD)
+    try:
+        location = (_degrees(gps[2], gps.get(1), 'S'), _degrees(gps[4], gps.get(3), 'W'))
+    except (KeyError, TypeError, ValueError, ZeroDivisionError):
+        location = None
+    # NaN (нулевой знаменатель) и мусор отсекаются проверкой диапазона
+    if location is not None and not (abs(location[0]) <= 90 and abs(location[1]) <= 180):
+        location = None
+    return location, _taken(exif)
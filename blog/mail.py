@@ -0,0 +1,114 @@
+"""Очередь исходящих писем.
+
+User.email_user только сохраняет письмо в OutboxEmailModel, а сигнал после
+коммита запускает send_outbox в фоне (blog.tasks), поэтому запрос не ждет
+SMTP. send_outbox отправляет письма пачками по EMAIL_OUTBOX_BATCH_SIZE через
+одно соединение get_connection(). Неудачная отправка повторяется с
+экспоненциальной задержкой EMAIL_OUTBOX_RETRY_DELAY * 2 ** (попытка - 1),
+после EMAIL_OUTBOX_MAX_ATTEMPTS попыток письмо помечается ошибкой. Письма,
+для которых запуск не сработал (например, после перезапуска), отправляет
+команда send_outbox.
+"""
+import logging
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db.models import F
+from django.utils import timezone
+
+from .models import OutboxEmailModel
+
+logger = logging.getLogger(__name__)
+
+# Сколько письмо остается за отправителем; если процесс упал, письмо снова станет доступно
+LEASE_TIME = timedelta(minutes=5)
+
+
+def claim(batch_size):
+    """Забирает пачку писем, которые пора отправить, и возвращает их.
+
+    Письма помечаются уникальной меткой и сдвигаются на LEASE_TIME вперед,
+    поэтому параллельные отправители не отправят одно письмо дважды.
+    """
+    now = timezone.now()
+    due = OutboxEmailModel.objects.filter(status=OutboxEmailModel.STATUS_PENDING, next_attempt__lte=now)
+    email_ids = list(due.order_by('next_attempt').values_list('pk', flat=True)[:batch_size])
+    if not email_ids:
+        return []
+    lease = uuid.uuid4().hex
+    due.filter(pk__in=email_ids).update(lease=lease, next_attempt=now + LEASE_TIME, attempts=F('attempts') + 1)
+    return list(OutboxEmailModel.objects.filter(lease=lease))
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=settings.EMAIL_OUTBOX_RETRY_DELAY * 2 ** (attempts - 1))
+
+
+def _message(email, connection):
+    message = EmailMultiAlternatives(email.subject, email.body, email.from_email or None, email.to,
+                                     connection=connection)
+    if email.html_body:
+        message.attach_alternative(email.html_body, 'text/html')
+    return message
+
+
+def _fail(email, error, now):
+    """Планирует повторную отправку письма или помечает его ошибкой."""
+    email.last_error = '%s: %s' % (type(error).__name__, error)
+    email.lease = ''
+    if email.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+        email.status = OutboxEmailModel.STATUS_FAILED
+    else:
+        email.next_attempt = now + retry_delay(email.attempts)
+
+
+def send_batch(emails):
+    """Отправляет письма через одно соединение. Возвращает число отправленных."""
+    connection = get_connection()
+    sent, failed = [], []
+    try:
+        connection.open()
+    except Exception as error:
+        logger.warning('Не удалось подключиться к почтовому серверу: %s', error)
+        failed = [(email, error) for email in emails]
+    else:
+        try:
+            for email in emails:
+                try:
+                    _message(email, connection).send()
+                except Exception as error:
+                    logger.warning('Не удалось отправить письмо %s: %s', email.pk, error)
+                    failed.append((email, error))
+                else:
+                    sent.append(email.pk)
+        finally:
+            connection.close()
+    now = timezone.now()
+    if sent:
+        OutboxEmailModel.objects.filter(pk__in=sent).update(status=OutboxEmailModel.STATUS_SENT, sent=now,
+                                                            lease='', last_error='')
+    for email, error in failed:
+        _fail(email, error, now)
+    OutboxEmailModel.objects.bulk_update([email for email, _ in failed],
+                                         ['status', 'next_attempt', 'last_error', 'lease'])
+    return len(sent)
+
+
+def send_outbox(batch_size=None):
+    """Отправляет письма, которые пора отправить. Возвращает число отправленных.
+
+    Останавливается, если из очередной пачки не ушло ни одного письма
+    (например, почтовый сервер недоступен) - остальные дождутся следующего запуска.
+    """
+    batch_size = batch_size or settings.EMAIL_OUTBOX_BATCH_SIZE
+    total = 0
+    while True:
+        emails = claim(batch_size)
+        if not emails:
+            return total
+        sent = send_batch(emails)
+        if not sent:
+            return total
+        total += sent
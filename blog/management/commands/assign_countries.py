@@ -0,0 +1,18 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from blog import geocoder
+from blog.models import PostModel
+
+
+class Command(BaseCommand):
+    help = 'Определяет страну постов по координатам (офлайн, по границам из COUNTRY_BOUNDARIES)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=20000)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        found = geocoder.assign(PostModel.objects.all(), options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('Постов со страной: %s (%.1f с)' % (found, time.perf_counter() - started)))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from blog.models import PostModel
+
+
+class Command(BaseCommand):
+    help = 'Заполняет денормализованные обложку и список тегов у существующих постов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        post_ids = list(PostModel.objects.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(post_ids), chunk_size):
+            PostModel.objects.filter(pk__in=post_ids[start:start + chunk_size]).refresh_summary()
+        self.stdout.write(self.style.SUCCESS('Обновлено постов: %s' % len(post_ids)))
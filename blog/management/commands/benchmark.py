@@ -0,0 +1,50 @@
+import json
+import platform
+import subprocess
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from blog.benchmarks import BENCHMARKS
+
+
+def _commit():
+    """Текущий коммит git, чтобы сравнивать результаты между коммитами."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = 'Запускает бенчмарк из пакета blog.benchmarks и выводит результат в JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=sorted(BENCHMARKS))
+        parser.add_argument('--param', action='append', default=[], metavar='KEY=VALUE',
+                            help='Параметр функции run() бенчмарка')
+        parser.add_argument('--output', help='Файл для сохранения результата')
+
+    def handle(self, *args, **options):
+        try:
+            params = dict(param.split('=', 1) for param in options['param'])
+        except ValueError:
+            raise CommandError('Параметры передаются в виде key=value')
+        result = {
+            'commit': _commit(),
+            'started': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'params': params,
+        }
+        result.update(BENCHMARKS[options['name']](**params))
+        result = json.dumps(result, ensure_ascii=False, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                file.write(result)
+        self.stdout.write(result)
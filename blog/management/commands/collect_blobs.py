@@ -0,0 +1,52 @@
+import os
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+
+from blog.models import ImagePostModel, MediaBlobModel, User
+from blog.storage import BLOB_PREFIX, blob_storage
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает ссылки на файлы хранилища и удаляет файлы, на которые никто не ссылается'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Только показать, что будет удалено')
+
+    def handle(self, *args, **options):
+        refs = Counter()
+        for image in ImagePostModel.objects.only('image', 'variants').iterator():
+            refs.update(image.file_names())
+        refs.update(User.objects.values_list('avatar', flat=True).iterator())
+
+        blobs = {blob.name: blob for blob in MediaBlobModel.objects.all()}
+        for name, blob in blobs.items():
+            blob.refs = refs.get(name, 0)
+        orphans = {name for name, blob in blobs.items() if not blob.refs}
+
+        # Файлы на диске без записи в базе: учитываем используемые, остальные удаляем
+        missing = []
+        for directory, _, files in os.walk(blob_storage.path(BLOB_PREFIX)):
+            for file_name in files:
+                if file_name.endswith('.part'):
+                    continue
+                path = os.path.join(directory, file_name)
+                name = os.path.relpath(path, blob_storage.location).replace(os.sep, '/')
+                if name in blobs:
+                    continue
+                if refs.get(name):
+                    missing.append(MediaBlobModel(name=name, size=os.path.getsize(path), refs=refs[name]))
+                else:
+                    orphans.add(name)
+
+        if not options['dry_run']:
+            MediaBlobModel.objects.bulk_update(blobs.values(), ['refs'], batch_size=500)
+            MediaBlobModel.objects.bulk_create(missing, batch_size=500)
+            MediaBlobModel.objects.filter(name__in=orphans).delete()
+            for name in orphans:
+                if blob_storage.exists(name):
+                    os.remove(blob_storage.path(name))
+        for name in sorted(orphans):
+            self.stdout.write(name)
+        self.stdout.write(self.style.SUCCESS('Удалено файлов: %s' % len(orphans)))
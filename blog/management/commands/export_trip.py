@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from blog import trips
+from blog.models import User
+
+
+class Command(BaseCommand):
+    help = 'Сохраняет посты пользователя с фото в архив поездки'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='Путь к создаваемому архиву ZIP')
+        parser.add_argument('--user', required=True, help='Электронная почта автора')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(email=options['user'])
+        except User.DoesNotExist as error:
+            raise CommandError(error)
+        size = 0
+        with open(options['output'], 'wb') as file:
+            for chunk in trips.export_archive(user):
+                file.write(chunk)
+                size += len(chunk)
+        self.stdout.write(self.style.SUCCESS('Архив записан: %s байт' % size))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from blog import tasks, trips
+from blog.models import User, EmojisModel
+
+
+class Command(BaseCommand):
+    help = 'Создает посты пользователя из архива поездки (ZIP с фото и файлами GPX/GeoJSON)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('archive', help='Путь к архиву ZIP')
+        parser.add_argument('--user', required=True, help='Электронная почта автора')
+        parser.add_argument('--emoji', help='slug emoji для постов, у которых оно не указано')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(email=options['user'])
+            emoji = EmojisModel.objects.get(slug=options['emoji']) if options['emoji'] else None
+        except (User.DoesNotExist, EmojisModel.DoesNotExist) as error:
+            raise CommandError(error)
+        try:
+            with open(options['archive'], 'rb') as file:
+                result = trips.import_archive(file, user, emoji)
+        except (OSError, ValueError) as error:
+            raise CommandError(error)
+        for name in result['skipped']:
+            self.stderr.write('Нет координат: %s' % name)
+        # Фото обрабатываются в фоновом пуле - дожидаемся его до выхода
+        tasks.wait()
+        self.stdout.write(self.style.SUCCESS('Импортировано постов: %s, фото: %s' % (result['posts'],
+                                                                                    result['images'])))
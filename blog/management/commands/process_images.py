@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from blog import tasks
+from blog.models import ImagePostModel
+
+
+class Command(BaseCommand):
+    help = 'Обрабатывает фото, оставшиеся в статусе "Ожидает обработки" (например, после перезапуска)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--failed', action='store_true',
+                            help='Повторить обработку фото с ошибкой')
+        parser.add_argument('--interrupted', action='store_true',
+                            help='Повторить обработку фото, прерванную остановкой процесса '
+                                 '(только когда фоновые задачи не запущены)')
+
+    def handle(self, *args, **options):
+        images = ImagePostModel.objects.all()
+        if options['failed']:
+            images.filter(status=ImagePostModel.STATUS_FAILED).update(status=ImagePostModel.STATUS_PENDING)
+        if options['interrupted']:
+            images.filter(status=ImagePostModel.STATUS_PROCESSING).update(status=ImagePostModel.STATUS_PENDING)
+        image_ids = images.filter(status=ImagePostModel.STATUS_PENDING).values_list('pk', flat=True)
+        count = tasks.run_many(tasks.process_image, [(pk,) for pk in image_ids])
+        self.stdout.write(self.style.SUCCESS('Обработано фото: %s' % count))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from blog import clusters
+from blog.models import PostModel
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает кластеры меток карты по всем постам'
+
+    def handle(self, *args, **options):
+        points = PostModel.objects.filter(lon__isnull=False).values_list('lon', 'lat').iterator()
+        cells = clusters.rebuild(points)
+        self.stdout.write(self.style.SUCCESS('Кластеров пересобрано: %s' % cells))
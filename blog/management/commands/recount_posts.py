@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from blog import counters
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает счетчики постов у тегов и emoji'
+
+    def handle(self, *args, **options):
+        tags, emojis = counters.recount()
+        self.stdout.write(self.style.SUCCESS('Пересчитано тегов: %s, emoji: %s' % (tags, emojis)))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from blog.benchmarks import data
+
+
+class Command(BaseCommand):
+    help = 'Заполняет базу пользователями, тегами, emoji, постами и фото для бенчмарков и нагрузочного теста'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10)
+        parser.add_argument('--posts', type=int, default=100)
+        parser.add_argument('--tags', type=int, default=10)
+        parser.add_argument('--emojis', type=int, default=5)
+        parser.add_argument('--images', type=int, default=1, help='Фото на пост')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        created = data.seed(users=options['users'], posts=options['posts'], tags=options['tags'],
+                            emojis=options['emojis'], images=options['images'], seed=options['seed'])
+        self.stdout.write(self.style.SUCCESS(
+            'Создано: %s. Пароль пользователей: %s' % (', '.join('%s %s' % item for item in created.items()),
+                                                       data.PASSWORD)))
@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from blog import mail
+
+
+class Command(BaseCommand):
+    help = 'Отправляет письма из очереди, в том числе повторные попытки'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float,
+                            help='Не завершаться, а проверять очередь каждые N секунд')
+
+    def handle(self, *args, **options):
+        while True:
+            count = mail.send_outbox()
+            self.stdout.write(self.style.SUCCESS('Отправлено писем: %s' % count))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
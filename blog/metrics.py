@@ -0,0 +1,201 @@
+"""Метрики запросов по представлениям.
+
+MetricsMiddleware для каждого запроса считает время ответа, число и время
+запросов к базе (connection.execute_wrapper), попадания и промахи кэша
+(blog.cache сообщает о них через count_cache) и время рендера шаблонов
+(бэкенд TimedDjangoTemplates). Итоги копятся в памяти процесса по имени
+маршрута (home, post, create-post, ...) и отдаются представлением
+metrics_view в текстовом формате Prometheus. Кроме того, каждый запрос
+пишется строкой в логгер blog.metrics на уровне INFO - ротацию файла
+настраивают через LOGGING (например, RotatingFileHandler).
+
+На запрос приходится несколько вызовов perf_counter и одно обновление
+словаря под блокировкой, так что middleware можно держать включенным всегда.
+Счетчики у каждого процесса свои.
+"""
+import contextvars
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+
+from django.db import connections
+from django.template import TemplateDoesNotExist
+from django.template.backends.django import DjangoTemplates, Template, reraise
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограммы времени ответа, секунды
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+UNRESOLVED = '<unresolved>'
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    """Показатели одного запроса"""
+
+    def __init__(self):
+        self.duration = 0.0
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.template_time = 0.0
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - started
+            self.db_queries += 1
+
+
+class _ViewTotals:
+    """Накопленные показатели одного представления"""
+
+    def __init__(self):
+        self.requests = 0
+        self.statuses = defaultdict(int)
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.duration = 0.0
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.template_time = 0.0
+
+    def add(self, metrics, status):
+        self.requests += 1
+        self.statuses['%sxx' % (status // 100)] += 1
+        for index, bound in enumerate(DURATION_BUCKETS):
+            if metrics.duration <= bound:
+                self.buckets[index] += 1
+        self.duration += metrics.duration
+        self.db_queries += metrics.db_queries
+        self.db_time += metrics.db_time
+        self.cache_hits += metrics.cache_hits
+        self.cache_misses += metrics.cache_misses
+        self.template_time += metrics.template_time
+
+
+_totals = defaultdict(_ViewTotals)
+_lock = threading.Lock()
+
+
+def count_cache(hits, misses):
+    """Учитывает обращения к кэшу в текущем запросе."""
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.cache_hits += hits
+        metrics.cache_misses += misses
+
+
+def record(view, metrics, status):
+    with _lock:
+        _totals[view].add(metrics, status)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info('view=%s status=%s duration=%.4f db_queries=%s db_time=%.4f cache_hits=%s '
+                    'cache_misses=%s template_time=%.4f', view, status, metrics.duration, metrics.db_queries,
+                    metrics.db_time, metrics.cache_hits, metrics.cache_misses, metrics.template_time)
+
+
+def reset():
+    with _lock:
+        _totals.clear()
+
+
+class MetricsMiddleware:
+    """Собирает показатели запроса; ставится первым в MIDDLEWARE, чтобы учесть все остальные"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics.execute_wrapper))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        metrics.duration = time.perf_counter() - started
+        match = request.resolver_match
+        record(match.view_name if match else UNRESOLVED, metrics, response.status_code)
+        return response
+
+
+class TimedTemplate(Template):
+    """Шаблон, время рендера которого учитывается в метриках запроса"""
+
+    def render(self, context=None, request=None):
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics = _current.get()
+            if metrics is not None:
+                metrics.template_time += time.perf_counter() - started
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """Бэкенд шаблонов Django, замеряющий время рендера (include и extends входят в шаблон верхнего уровня)"""
+
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return TimedTemplate(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            reraise(exc, self)
+
+
+def _labels(**labels):
+    return ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in labels.items())
+
+
+def render_text():
+    """Накопленные метрики в текстовом формате Prometheus."""
+    with _lock:
+        # Снимок целиком под блокировкой: словарь статусов и корзины меняются в record()
+        totals = {view: dict(vars(item), statuses=dict(item.statuses), buckets=list(item.buckets))
+                  for view, item in _totals.items()}
+    lines = []
+
+    def metric(name, kind, description, samples):
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for suffix, labels, value in samples:
+            lines.append('%s%s{%s} %s' % (name, suffix, _labels(**labels), value))
+
+    views = sorted(totals)
+    metric('blog_requests_total', 'counter', 'Число запросов по представлениям и классам статуса',
+           [('', {'view': view, 'status': status}, count)
+            for view in views for status, count in sorted(totals[view]['statuses'].items())])
+    samples = []
+    for view in views:
+        item = totals[view]
+        for bound, count in zip(DURATION_BUCKETS, item['buckets']):
+            samples.append(('_bucket', {'view': view, 'le': bound}, count))
+        samples.append(('_bucket', {'view': view, 'le': '+Inf'}, item['requests']))
+        samples.append(('_sum', {'view': view}, round(item['duration'], 6)))
+        samples.append(('_count', {'view': view}, item['requests']))
+    metric('blog_request_duration_seconds', 'histogram', 'Время ответа', samples)
+    metric('blog_db_queries_total', 'counter', 'Число запросов к базе',
+           [('', {'view': view}, totals[view]['db_queries']) for view in views])
+    metric('blog_db_duration_seconds_total', 'counter', 'Время запросов к базе',
+           [('', {'view': view}, round(totals[view]['db_time'], 6)) for view in views])
+    metric('blog_cache_requests_total', 'counter', 'Обращения к кэшу фрагментов и ответов',
+           [('', {'view': view, 'result': result}, totals[view]['cache_%s' % key])
+            for view in views for result, key in (('hit', 'hits'), ('miss', 'misses'))])
+    metric('blog_template_render_seconds_total', 'counter', 'Время рендера шаблонов',
+           [('', {'view': view}, round(totals[view]['template_time'], 6)) for view in views])
+    return '\n'.join(lines) + '\n'
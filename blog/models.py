@@ -1,16 +1,17 @@
-import sys
-from io import BytesIO
-from django.core.files.uploadedfile import InMemoryUploadedFile
-from django.core.mail import send_mail
-from django.db import models
+import os
+from collections import defaultdict
+from django.db import models, transaction
 from django.contrib.auth.models import (
     BaseUserManager, AbstractBaseUser
 )
 from unidecode import unidecode
 from django.template import defaultfilters
+from django.utils import timezone
 
 from django.urls import reverse
-from PIL import Image
+
+from . import geo, geocoder, imaging
+from .storage import blob_storage
 
 
 class UserManager(BaseUserManager):
@@ -86,6 +87,7 @@ class User(AbstractBaseUser):
                                 blank=True,
                                 verbose_name='Страна')
     avatar = models.ImageField(upload_to="blog/avatar/%Y/%m/%d",
+                               storage=blob_storage,
                                default="blog/avatar/default/default.png",
                                verbose_name='Аватар')
     slug = models.SlugField(max_length=255,
@@ -104,13 +106,17 @@ class User(AbstractBaseUser):
         verbose_name = 'Пользоатель'
         verbose_name_plural = 'Пользователи'
         ordering = ['create_date', 'email']
+        indexes = [
+            models.Index(fields=['create_date', 'email'], name='user_ordering_idx'),
+        ]
 
     def get_absolute_url(self):
         return reverse('profile', kwargs={'url': self.slug})
 
-    def email_user(self, subject, message, from_email=None, **kwargs):
-        """Send an email to this user."""
-        send_mail(subject, message, from_email, [self.email], **kwargs)
+    def email_user(self, subject, message, from_email=None, html_message=''):
+        """Ставит письмо пользователю в очередь отправки (см. blog.mail)."""
+        return OutboxEmailModel.objects.create(subject=subject, body=message, html_body=html_message or '',
+                                               from_email=from_email or '', to=[self.email])
 
     def get_full_name(self):
         # The user is identified by their email address
@@ -168,12 +174,73 @@ class CountryModel(models.Model):
     def __str__(self):
         return self.name
 
+    def get_absolute_url(self):
+        return reverse('country', kwargs={'url': self.pk})
+
     class Meta:
         verbose_name = 'Страна'
         verbose_name_plural = 'Страны'
         ordering = ['name', ]
 
 
+class PostQuerySet(models.QuerySet):
+    def with_related(self):
+        """Загружает автора, emoji, страну, теги и фото постов за постоянное число запросов.
+
+        Фото доступны списком post.images, первое из них - обложка поста.
+        """
+        return self.select_related('author', 'emoji', 'country').prefetch_related(
+            'tag',
+            models.Prefetch('imagepostmodel_set',
+                            queryset=ImagePostModel.objects.order_by('pk'),
+                            to_attr='images'),
+        )
+
+    def refresh_summary(self):
+        """Пересчитывает денормализованные обложку (с копиями) и список тегов постов.
+
+        Заодно обновляет datetime_update - от него зависят ключи кэша фрагментов.
+        """
+        post_ids = list(self.values_list('pk', flat=True))
+        covers = {}
+        images = ImagePostModel.objects.filter(post_id__in=post_ids).order_by('-pk')
+        for post_id, image, variants in images.values_list('post_id', 'image', 'variants'):
+            covers[post_id] = (image, variants)
+        tags = defaultdict(list)
+        links = PostModel.tag.through.objects.filter(postmodel_id__in=post_ids).order_by('tagmodel__name')
+        for post_id, name in links.values_list('postmodel_id', 'tagmodel__name'):
+            tags[post_id].append(name)
+        now = timezone.now()
+        posts = []
+        for pk in post_ids:
+            cover, cover_variants = covers.get(pk, ('', {}))
+            posts.append(PostModel(pk=pk, cover=cover, cover_variants=cover_variants, tag_list=tags[pk],
+                                   datetime_update=now))
+        PostModel.objects.bulk_update(posts, ['cover', 'cover_variants', 'tag_list', 'datetime_update'],
+                                      batch_size=500)
+        return len(post_ids)
+
+    def in_bbox(self, south, west, north, east):
+        """Посты внутри области карты.
+
+        Область раскладывается на несколько диапазонов geohash, каждый из которых
+        читается по индексу, после чего точки отсекаются по точным координатам.
+        Сортировка по умолчанию снимается: с ней планировщик предпочитает обойти
+        индекс даты целиком.
+        """
+        ranges = models.Q()
+        for start, end in geo.bbox_ranges(south, west, north, east):
+            if end is None:
+                ranges |= models.Q(geohash__gte=start)
+            else:
+                ranges |= models.Q(geohash__gte=start, geohash__lt=end)
+        # lon хранит широту, lat - долготу (см. blog.geo)
+        queryset = self.filter(ranges, lon__gte=south, lon__lte=north).order_by()
+        if west <= east:
+            return queryset.filter(lat__gte=west, lat__lte=east)
+        return queryset.filter(models.Q(lat__gte=west) | models.Q(lat__lte=east))
+
+
 class PostModel(models.Model):
     author = models.ForeignKey(User,
                                on_delete=models.PROTECT,
@@ -190,19 +257,59 @@ class PostModel(models.Model):
                             unique=True,
                             verbose_name='url',
                             allow_unicode=True)
-    lon = models.FloatField(verbose_name='Широта')
-    lat = models.FloatField(verbose_name='Долгота')
+    # Без координат пост создается, если их должны дать геотеги фото (см. ImagePostModel.process)
+    lon = models.FloatField(null=True,
+                            blank=True,
+                            verbose_name='Широта')
+    lat = models.FloatField(null=True,
+                            blank=True,
+                            verbose_name='Долгота')
+    geohash = models.CharField(max_length=geo.GEOHASH_PRECISION,
+                               blank=True,
+                               db_index=True,
+                               editable=False,
+                               verbose_name='Geohash')
     tag = models.ManyToManyField('TagModel',
                                  db_index=True,
                                  verbose_name='Теги')
     emoji = models.ForeignKey('EmojisModel',
                               on_delete=models.PROTECT,
                               verbose_name='Emoji')
+    # Определяется по координатам, см. blog.geocoder
+    country = models.ForeignKey('CountryModel',
+                                on_delete=models.SET_NULL,
+                                null=True,
+                                blank=True,
+                                editable=False,
+                                verbose_name='Страна')
+    # Денормализованные данные для списков и карты, см. PostQuerySet.refresh_summary
+    cover = models.ImageField(blank=True,
+                              storage=blob_storage,
+                              editable=False,
+                              verbose_name='Обложка')
+    cover_variants = models.JSONField(default=dict,
+                                      blank=True,
+                                      editable=False,
+                                      verbose_name='Копии обложки')
+    tag_list = models.JSONField(default=list,
+                                blank=True,
+                                editable=False,
+                                verbose_name='Список тегов')
+
+    objects = PostQuerySet.as_manager()
 
     class Meta:
         verbose_name = 'Пост'
         verbose_name_plural = 'Посты'
         ordering = ['datetime_create', ]
+        indexes = [
+            # Лента с курсором, см. blog.pagination
+            models.Index(fields=['-datetime_create', '-id'], name='post_feed_idx'),
+            # Посты автора в порядке ленты
+            models.Index(fields=['author', '-datetime_create', '-id'], name='post_author_feed_idx'),
+            # Посты страны в порядке ленты
+            models.Index(fields=['country', '-datetime_create', '-id'], name='post_country_feed_idx'),
+        ]
 
     def __str__(self):
         return self.title
@@ -210,10 +317,97 @@ class PostModel(models.Model):
     def get_absolute_url(self):
         return reverse('post', kwargs={'url': self.slug})
 
+    @property
+    def images_processing(self):
+        """Есть ли у поста фото, которые еще обрабатываются."""
+        waiting = [ImagePostModel.STATUS_PENDING, ImagePostModel.STATUS_PROCESSING]
+        images = getattr(self, 'images', None)
+        if images is None:
+            return self.imagepostmodel_set.filter(status__in=waiting).exists()
+        return any(image.status in waiting for image in images)
+
+    def place(self, latitude, longitude):
+        """Ставит на карту пост, у которого еще нет координат. Возвращает, поставлен ли пост."""
+        with transaction.atomic():
+            post = PostModel.objects.select_for_update().filter(pk=self.pk, lon__isnull=True).first()
+            if post is None:
+                return False
+            # save(), а не update(): сигналы добавят пост в кластеры карты и сменят версию кэша
+            post.lon, post.lat = latitude, longitude
+            post.save(update_fields=['lon', 'lat', 'geohash', 'country', 'datetime_update'])
+        self.lon, self.lat, self.geohash, self.country_id = post.lon, post.lat, post.geohash, post.country_id
+        return True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        post = super().from_db(db, field_names, values)
+        # Координаты из базы: save() пересчитывает страну, только если пост сдвинули
+        if 'lon' in post.__dict__ and 'lat' in post.__dict__:
+            post._saved_point = (post.lon, post.lat)
+        return post
+
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = defaultfilters.slugify(unidecode(self.title))
-        return super().save(*args, **kwargs)
+        point = (self.lon, self.lat)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None:
+            moved = getattr(self, '_saved_point', None) != point
+        else:
+            moved = not {'lon', 'lat'}.isdisjoint(update_fields)
+        if moved:
+            self.geohash = '' if self.lon is None or self.lat is None else geo.encode(self.lon, self.lat)
+            self.country_id = geocoder.country_id(self.lon, self.lat)
+        result = super().save(*args, **kwargs)
+        self._saved_point = point
+        return result
+
+
+class MapClusterModel(models.Model):
+    """Кластер меток карты: ячейка сетки на заданном уровне зума (см. blog.clusters)"""
+    zoom = models.PositiveSmallIntegerField(verbose_name='Зум')
+    x = models.IntegerField(verbose_name='Столбец')
+    y = models.IntegerField(verbose_name='Строка')
+    count = models.IntegerField(default=0,
+                                verbose_name='Количество постов')
+    latitude_sum = models.FloatField(default=0,
+                                     verbose_name='Сумма широт')
+    longitude_sum = models.FloatField(default=0,
+                                      verbose_name='Сумма долгот')
+
+    class Meta:
+        verbose_name = 'Кластер карты'
+        verbose_name_plural = 'Кластеры карты'
+        unique_together = [('zoom', 'x', 'y')]
+
+    def __str__(self):
+        return '%s/%s/%s' % (self.zoom, self.x, self.y)
+
+    @property
+    def center(self):
+        """Центр кластера: [широта, долгота]"""
+        return [self.latitude_sum / self.count, self.longitude_sum / self.count]
+
+
+class SearchTermModel(models.Model):
+    """Запись обратного индекса поиска: терм поста и его вес (см. blog.search)
+
+    Используется на базах без FTS5, на SQLite индекс хранится в таблице FTS5.
+    """
+    term = models.CharField(max_length=64,
+                            verbose_name='Терм')
+    post = models.ForeignKey(PostModel,
+                             on_delete=models.CASCADE,
+                             verbose_name='Пост')
+    weight = models.FloatField(verbose_name='Вес')
+
+    class Meta:
+        verbose_name = 'Терм поиска'
+        verbose_name_plural = 'Термы поиска'
+        unique_together = [('term', 'post')]
+
+    def __str__(self):
+        return self.term
 
 
 class TagModel(models.Model):
@@ -223,11 +417,18 @@ class TagModel(models.Model):
     slug = models.SlugField(unique=True,
                             db_index=True,
                             verbose_name='URL')
+    # Счетчик постов для облака тегов, см. blog.counters
+    post_count = models.PositiveIntegerField(default=0,
+                                             editable=False,
+                                             verbose_name='Количество постов')
 
     class Meta:
         verbose_name = 'Тег'
         verbose_name_plural = 'Теги'
         ordering = ['name', ]
+        indexes = [
+            models.Index(fields=['-post_count', 'name'], name='tag_cloud_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -242,11 +443,42 @@ class TagModel(models.Model):
 
 
 class ImagePostModel(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_PROCESSING = 'processing'
+    STATUS_READY = 'ready'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Ожидает обработки'),
+        (STATUS_PROCESSING, 'Обрабатывается'),
+        (STATUS_READY, 'Готово'),
+        (STATUS_FAILED, 'Ошибка обработки'),
+    ]
+
     post = models.ForeignKey(PostModel,
                              on_delete=models.CASCADE,
                              verbose_name='Пост')
     image = models.ImageField(upload_to='blog/post/%Y/%m/%d',
+                              storage=blob_storage,
                               verbose_name='Путь хранения')
+    status = models.CharField(max_length=10,
+                              choices=STATUS_CHOICES,
+                              default=STATUS_PENDING,
+                              db_index=True,
+                              verbose_name='Статус обработки')
+    # {размер: {'width': .., 'height': .., 'files': {формат: имя файла}}}, см. blog.imaging
+    variants = models.JSONField(default=dict,
+                                blank=True,
+                                editable=False,
+                                verbose_name='Копии фото')
+    # Место съемки из геотегов EXIF, как у поста: lon - широта, lat - долгота
+    lon = models.FloatField(null=True,
+                            blank=True,
+                            editable=False,
+                            verbose_name='Широта')
+    lat = models.FloatField(null=True,
+                            blank=True,
+                            editable=False,
+                            verbose_name='Долгота')
 
     class Meta:
         verbose_name = 'Фото'
@@ -255,17 +487,130 @@ class ImagePostModel(models.Model):
     def __str__(self):
         return self.post.title
 
-    def save(self, *args, **kwargs):
-        image_temporary = Image.open(self.image)
-        if image_temporary.mode != 'RGB':
-            image_temporary = image_temporary.convert('RGB')
-        output_io_stream = BytesIO()
-        image_temporary.thumbnail((1280, 720), Image.ANTIALIAS)
-        image_temporary.save(output_io_stream, format='JPEG', quality=75)
-        output_io_stream.seek(0)
-        self.image = InMemoryUploadedFile(output_io_stream, 'ImageField', "%s.jpg" % self.image.name.split('.')[0],
-                                          'image/jpeg', sys.getsizeof(output_io_stream), None)
-        super(ImagePostModel, self).save(*args, **kwargs)
+    def file_names(self):
+        """Имена файлов фото - оригинала или готовых копий - по одному на каждую ссылку.
+
+        Одинаковые копии (например, full и card у маленького фото) хранятся
+        одним файлом, но ссылок на него столько же, сколько копий.
+        """
+        if not self.variants:
+            return [self.image.name]
+        return [name for variant in self.variants.values() for name in variant['files'].values()]
+
+    def process(self):
+        """Создает копии фото всех размеров (blog.imaging.SIZES) и заменяет ими оригинал.
+
+        Вызывается фоновой задачей blog.tasks.process_image, оригинал до этого
+        момента хранится как есть. В поле image остается копия 'full' в JPEG.
+        Геотег фото читается при том же декодировании; пост без координат
+        получает место съемки первого фото, в котором оно есть. Если обработка
+        не удалась (или фото удалили во время нее), ссылки с уже записанных
+        копий снимаются.
+        """
+        original = self.image.name
+        storage = self.image.storage
+        base = os.path.join(os.path.dirname(original), os.path.basename(original).split('.')[0])
+        variants = {}
+        metadata = {}
+        saved = []
+        try:
+            with self.image.open('rb') as file:
+                for size, width, height, format_name, content in imaging.iter_derivatives(file, original, metadata):
+                    with content:
+                        name = storage.save('%s_%s%s' % (base, size, os.path.splitext(content.name)[1]), content)
+                    saved.append(name)
+                    variant = variants.setdefault(size, {'width': width, 'height': height, 'files': {}})
+                    variant['files'][format_name] = name
+            self.image = variants['full']['files']['jpeg']
+            self.variants = variants
+            self.status = self.STATUS_READY
+            if metadata['location'] is not None:
+                self.lon, self.lat = metadata['location']
+            # Удаленное во время обработки фото дает DatabaseError (строк для update_fields не нашлось);
+            # точка сохранения не дает ошибке сломать внешнюю транзакцию
+            with transaction.atomic():
+                self.save(update_fields=['image', 'variants', 'status', 'lon', 'lat'])
+        except Exception:
+            for name in saved:
+                storage.delete(name)
+            raise
+        storage.delete(original)
+        if self.lon is not None:
+            self.post.place(self.lon, self.lat)
+
+
+class MediaBlobModel(models.Model):
+    """Файл хранилища с адресацией по содержимому и число ссылок на него (см. blog.storage)"""
+    name = models.CharField(max_length=255,
+                            unique=True,
+                            verbose_name='Имя файла')
+    size = models.PositiveBigIntegerField(default=0,
+                                          verbose_name='Размер')
+    refs = models.IntegerField(default=0,
+                               verbose_name='Число ссылок')
+    created = models.DateTimeField(auto_now_add=True,
+                                   verbose_name='Дата создания')
+
+    class Meta:
+        verbose_name = 'Файл хранилища'
+        verbose_name_plural = 'Файлы хранилища'
+
+    def __str__(self):
+        return self.name
+
+
+class OutboxEmailModel(models.Model):
+    """Письмо в очереди отправки (см. blog.mail)"""
+    STATUS_PENDING = 'pending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Ожидает отправки'),
+        (STATUS_SENT, 'Отправлено'),
+        (STATUS_FAILED, 'Ошибка отправки'),
+    ]
+
+    subject = models.CharField(max_length=255,
+                               verbose_name='Тема')
+    body = models.TextField(verbose_name='Текст')
+    html_body = models.TextField(blank=True,
+                                 verbose_name='HTML')
+    from_email = models.CharField(max_length=255,
+                                  blank=True,
+                                  verbose_name='Отправитель')
+    to = models.JSONField(default=list,
+                          verbose_name='Получатели')
+    status = models.CharField(max_length=10,
+                              choices=STATUS_CHOICES,
+                              default=STATUS_PENDING,
+                              verbose_name='Статус')
+    attempts = models.PositiveSmallIntegerField(default=0,
+                                                verbose_name='Попыток отправки')
+    # Время следующей попытки; на время отправки сдвигается вперед, см. blog.mail.claim
+    next_attempt = models.DateTimeField(default=timezone.now,
+                                        verbose_name='Следующая попытка')
+    lease = models.CharField(max_length=32,
+                             blank=True,
+                             db_index=True,
+                             editable=False,
+                             verbose_name='Метка отправителя')
+    last_error = models.TextField(blank=True,
+                                  verbose_name='Последняя ошибка')
+    created = models.DateTimeField(auto_now_add=True,
+                                   verbose_name='Дата создания')
+    sent = models.DateTimeField(null=True,
+                                blank=True,
+                                verbose_name='Дата отправки')
+
+    class Meta:
+        verbose_name = 'Письмо'
+        verbose_name_plural = 'Очередь писем'
+        indexes = [
+            models.Index(fields=['status', 'next_attempt'], name='outbox_due_idx'),
+        ]
+
+    def __str__(self):
+        return self.subject
 
 
 class EmojisModel(models.Model):
@@ -276,10 +621,17 @@ class EmojisModel(models.Model):
     slug = models.SlugField(unique=True,
                             db_index=True,
                             verbose_name='URL')
+    # Счетчик постов для меню фильтра, см. blog.counters
+    post_count = models.PositiveIntegerField(default=0,
+                                             editable=False,
+                                             verbose_name='Количество постов')
 
     class Meta:
         verbose_name = 'Emoji'
         verbose_name_plural = 'Emojis'
+        indexes = [
+            models.Index(fields=['-post_count', 'name'], name='emoji_menu_idx'),
+        ]
 
     def __str__(self):
         return self.emoji.url
@@ -0,0 +1,64 @@
+"""Постраничный вывод по курсору (keyset) вместо OFFSET.
+
+Страница выбирается условием по (datetime_create, id) последнего показанного
+поста и читается по составному индексу PostModel, поэтому глубина прокрутки
+не влияет на стоимость запроса, а COUNT(*) не нужен вовсе.
+"""
+import base64
+import binascii
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+def encode_cursor(post):
+    """Непрозрачный курсор, указывающий на пост."""
+    value = '%s|%s' % (post.datetime_create.isoformat(), post.pk)
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Возвращает (datetime_create, id) из курсора или ValueError."""
+    try:
+        value = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created, pk = value.split('|')
+        created = parse_datetime(created)
+        pk = int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError('Некорректный курсор')
+    if created is None:
+        raise ValueError('Некорректный курсор')
+    return created, pk
+
+
+class CursorPage:
+    """Страница ленты: посты и курсор следующей страницы"""
+
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def after_cursor(queryset, cursor):
+    """Посты после курсора в порядке от новых к старым (без ограничения размера)."""
+    queryset = queryset.order_by('-datetime_create', '-id')
+    if cursor:
+        created, pk = decode_cursor(cursor)
+        queryset = queryset.filter(Q(datetime_create__lt=created) | Q(datetime_create=created, id__lt=pk))
+    return queryset
+
+
+def paginate(queryset, cursor, page_size):
+    """Страница постов от курсора в порядке от новых к старым."""
+    posts = list(after_cursor(queryset, cursor)[:page_size + 1])
+    next_cursor = encode_cursor(posts[page_size - 1]) if len(posts) > page_size else None
+    return CursorPage(posts[:page_size], next_cursor)
@@ -0,0 +1,59 @@
+"""Маршрутизация запросов между основной базой и репликой.
+
+Запись всегда идет в default. Чтение уходит в алиас REPLICA_DB_ALIAS, только
+если он настроен и код выполняется внутри read_only() - так помечены
+read-only представления (см. ReplicaReadMixin во views). Пользователи
+читаются из основной базы: после регистрации, активации или смены пароля
+отставание реплики не должно разлогинивать пользователя.
+"""
+import contextvars
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+REPLICA_DB_ALIAS = 'replica'
+
+_read_only = contextvars.ContextVar('read_only', default=False)
+
+
+@contextmanager
+def read_only():
+    """Чтение данных блога внутри блока направляется в реплику."""
+    token = _read_only.set(True)
+    try:
+        yield
+    finally:
+        _read_only.reset(token)
+
+
+def _has_replica():
+    """Настроена ли реплика, отличная от основной базы.
+
+    Зеркало основной базы (TEST MIRROR в тестах) читается через основное
+    соединение - иначе второе соединение не увидит незакоммиченные данные.
+    """
+    if REPLICA_DB_ALIAS not in settings.DATABASES:
+        return False
+    replica = connections[REPLICA_DB_ALIAS].settings_dict
+    primary = connections[DEFAULT_DB_ALIAS].settings_dict
+    return any(replica[key] != primary[key] for key in ('NAME', 'HOST', 'PORT'))
+
+
+class PrimaryReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        if (_read_only.get() and model._meta.app_label == 'blog'
+                and model._meta.label != settings.AUTH_USER_MODEL and _has_replica()):
+            return REPLICA_DB_ALIAS
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплика содержит те же данные, что и основная база
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db != REPLICA_DB_ALIAS
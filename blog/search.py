@@ -0,0 +1,304 @@
+"""Полнотекстовый поиск постов по заголовку, тексту и тегам.
+
+Слова приводятся к основе стеммером Портера для русского языка (алгоритм
+Snowball) и транслитерируются через unidecode, поэтому в индексе хранятся
+ASCII-термы: "горы" и "горах" дают один терм "gor". Латинские слова перед
+стеммингом переводятся в кириллицу (cyrillic), одинаково в тексте постов
+и в запросе, поэтому "moskva" и "zimoy" находят "Москва зимой". Слова запроса
+ищутся по префиксу терма. После изменения правил индекс пересобирается
+командой rebuild_search_index.
+
+На SQLite индекс хранится в виртуальной таблице FTS5 (SEARCH_TABLE), которая
+создается после migrate, а результаты ранжируются по bm25. На других базах
+используется обратный индекс в SearchTermModel с ранжированием TF-IDF.
+Индекс обновляется сигналами при сохранении поста и изменении его тегов,
+полная пересборка - командой rebuild_search_index.
+"""
+import math
+import re
+
+from django.db import connections, router
+from django.db.models import Case, Count, F, FloatField, IntegerField, Max, Q, Sum, Value, When
+from unidecode import unidecode
+
+from .models import PostModel, SearchTermModel
+
+SEARCH_TABLE = 'blog_post_search'
+
+# Поле поста -> вес терма из этого поля при ранжировании
+FIELD_WEIGHTS = {
+    'title': 10.0,
+    'text': 1.0,
+    'tags': 5.0,
+}
+
+MAX_QUERY_TERMS = 8
+
+# Строк в одном INSERT в таблицу FTS5 (у SQLite ограничено число параметров запроса)
+INSERT_BATCH_SIZE = 200
+
+_WORD = re.compile(r'\w+')
+_CYRILLIC = re.compile('[а-я]')
+_LATIN = re.compile('[a-z]+$')
+_NOT_TERM = re.compile('[^a-z0-9]')
+
+_fts5_support = {}
+
+_VOWELS = 'аеиоуыэюя'
+
+# Латиница -> кириллица для распространенных транслитераций; "y" разбирается отдельно в cyrillic()
+_LATIN_LETTERS = {
+    'shch': 'щ', 'zh': 'ж', 'kh': 'х', 'ts': 'ц', 'ch': 'ч', 'sh': 'ш',
+    'ya': 'я', 'yu': 'ю', 'yo': 'ё', 'ye': 'е',
+    'a': 'а', 'b': 'б', 'v': 'в', 'g': 'г', 'd': 'д', 'e': 'е', 'z': 'з', 'i': 'и', 'j': 'й', 'k': 'к',
+    'l': 'л', 'm': 'м', 'n': 'н', 'o': 'о', 'p': 'п', 'r': 'р', 's': 'с', 't': 'т', 'u': 'у', 'f': 'ф',
+    'h': 'х', 'c': 'к', 'q': 'к', 'w': 'в', 'x': 'кс',
+}
+_LATIN_LONGEST = max(len(letters) for letters in _LATIN_LETTERS)
+
+
+def _endings(after_a, other=()):
+    """Окончания стеммера (окончание, должно ли перед ним стоять "а" или "я"), от длинных к коротким."""
+    endings = [(ending, True) for ending in after_a] + [(ending, False) for ending in other]
+    return sorted(endings, key=lambda item: -len(item[0]))
+
+
+_PERFECTIVE_GERUND = _endings(['в', 'вши', 'вшись'], ['ив', 'ивши', 'ившись', 'ыв', 'ывши', 'ывшись'])
+_ADJECTIVE = _endings([], ['ее', 'ие', 'ые', 'ое', 'ими', 'ыми', 'ей', 'ий', 'ый', 'ой', 'ем', 'им', 'ым',
+                           'ом', 'его', 'ого', 'ему', 'ому', 'их', 'ых', 'ую', 'юю', 'ая', 'яя', 'ою', 'ею'])
+_PARTICIPLE = _endings(['ем', 'нн', 'вш', 'ющ', 'щ'], ['ивш', 'ывш', 'ующ'])
+_REFLEXIVE = _endings([], ['ся', 'сь'])
+_VERB = _endings(['ла', 'на', 'ете', 'йте', 'ли', 'й', 'л', 'ем', 'н', 'ло', 'но', 'ет', 'ют', 'ны', 'ть',
+                  'ешь', 'нно'],
+                 ['ила', 'ыла', 'ена', 'ейте', 'уйте', 'ите', 'или', 'ыли', 'ей', 'уй', 'ил', 'ыл', 'им',
+                  'ым', 'ен', 'ило', 'ыло', 'ено', 'ят', 'ует', 'уют', 'ит', 'ыт', 'ены', 'ить', 'ыть',
+                  'ишь', 'ую', 'ю'])
+_NOUN = _endings([], ['а', 'ев', 'ов', 'ие', 'ье', 'е', 'иями', 'ями', 'ами', 'еи', 'ии', 'и', 'ией', 'ей',
+                      'ой', 'ий', 'й', 'иям', 'ям', 'ием', 'ем', 'ам', 'ом', 'о', 'у', 'ах', 'иях', 'ях',
+                      'ы', 'ь', 'ию', 'ью', 'ю', 'ия', 'ья', 'я'])
+_SUPERLATIVE = _endings([], ['ейше', 'ейш'])
+
+
+def _strip(word, endings):
+    """Отрезает самое длинное из окончаний или возвращает None, как among в Snowball."""
+    for ending, after_a in endings:
+        if word.endswith(ending):
+            stem = word[:-len(ending)]
+            if after_a and not stem.endswith(('а', 'я')):
+                return None
+            return stem
+    return None
+
+
+def _region(word, start=0):
+    """Начало области после первого сочетания гласная-согласная (R1/R2 в Snowball)."""
+    for index in range(start + 1, len(word)):
+        if word[index] not in _VOWELS and word[index - 1] in _VOWELS:
+            return index + 1
+    return len(word)
+
+
+def stem(word):
+    """Основа русского слова по алгоритму Портера (Snowball)."""
+    word = word.replace('ё', 'е')
+    rv = next((index + 1 for index, char in enumerate(word) if char in _VOWELS), len(word))
+    r2 = _region(word, _region(word))
+    prefix, word = word[:rv], word[rv:]
+
+    # Шаг 1: окончания деепричастий, иначе возвратных форм и прилагательных, глаголов, существительных
+    stripped = _strip(word, _PERFECTIVE_GERUND)
+    if stripped is None:
+        reflexive = _strip(word, _REFLEXIVE)
+        if reflexive is not None:
+            word = reflexive
+        stripped = _strip(word, _ADJECTIVE)
+        if stripped is not None:
+            participle = _strip(stripped, _PARTICIPLE)
+            if participle is not None:
+                stripped = participle
+        else:
+            stripped = _strip(word, _VERB)
+            if stripped is None:
+                stripped = _strip(word, _NOUN)
+    if stripped is not None:
+        word = stripped
+    # Шаг 2
+    if word.endswith('и'):
+        word = word[:-1]
+    # Шаг 3: словообразовательные окончания в R2
+    for ending in ('ость', 'ост'):
+        if word.endswith(ending) and len(prefix) + len(word) - len(ending) >= r2:
+            word = word[:-len(ending)]
+            break
+    # Шаг 4
+    if word.endswith('нн'):
+        word = word[:-1]
+    else:
+        stripped = _strip(word, _SUPERLATIVE)
+        if stripped is not None:
+            word = stripped[:-1] if stripped.endswith('нн') else stripped
+        elif word.endswith('ь'):
+            word = word[:-1]
+    return prefix + word
+
+
+def cyrillic(word):
+    """Латинское слово в кириллице: "krasnaya" -> "красная", "zimoy" -> "зимой"."""
+    result = []
+    position = 0
+    while position < len(word):
+        for length in range(_LATIN_LONGEST, 0, -1):
+            letter = _LATIN_LETTERS.get(word[position:position + length])
+            if letter is not None:
+                break
+        else:
+            # "y" без гласной после нее: "й" после гласной ("zimoy"), иначе "ы" ("krasnyy" -> "красный")
+            letter = 'й' if result and result[-1] in _VOWELS else 'ы'
+            length = 1
+        result.append(letter)
+        position += length
+    return ''.join(result)
+
+
+def terms(text):
+    """Термы текста: основы слов в транслитерации латиницей."""
+    result = []
+    for word in _WORD.findall((text or '').lower()):
+        if _LATIN.match(word):
+            word = cyrillic(word)
+        if _CYRILLIC.search(word):
+            word = stem(word)
+        term = _NOT_TERM.sub('', unidecode(word).lower())
+        if term:
+            result.append(term)
+    return result
+
+
+def _documents(posts):
+    """Пары (pk, {поле: список термов}) для индексации."""
+    for post in posts:
+        yield post.pk, {
+            'title': terms(post.title),
+            'text': terms(post.text),
+            'tags': terms(' '.join(post.tag_list)),
+        }
+
+
+def _fts5(using):
+    """Доступен ли FTS5 на базе using."""
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return False
+    if using not in _fts5_support:
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA compile_options')
+            _fts5_support[using] = any(row[0] == 'ENABLE_FTS5' for row in cursor.fetchall())
+    return _fts5_support[using]
+
+
+def create_index(using):
+    """Создает таблицу FTS5, если ее еще нет. Вызывается после migrate."""
+    if _fts5(using):
+        with connections[using].cursor() as cursor:
+            cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s)'
+                           % (SEARCH_TABLE, ', '.join(FIELD_WEIGHTS)))
+
+
+def update(posts):
+    """Переиндексирует посты. Нужны поля title, text и tag_list."""
+    documents = list(_documents(posts))
+    if not documents:
+        return
+    using = router.db_for_write(PostModel)
+    remove([pk for pk, _ in documents])
+    if _fts5(using):
+        # Одним INSERT на пачку, а не executemany: его не умеет показывать SQL-панель debug_toolbar
+        row = '(%s)' % ', '.join(['%s'] * (len(FIELD_WEIGHTS) + 1))
+        with connections[using].cursor() as cursor:
+            for start in range(0, len(documents), INSERT_BATCH_SIZE):
+                batch = documents[start:start + INSERT_BATCH_SIZE]
+                cursor.execute(
+                    'INSERT INTO %s (rowid, %s) VALUES %s' % (
+                        SEARCH_TABLE, ', '.join(FIELD_WEIGHTS), ', '.join([row] * len(batch))),
+                    [value for pk, fields in batch
+                     for value in [pk] + [' '.join(fields[name]) for name in FIELD_WEIGHTS]],
+                )
+        return
+    entries = []
+    for pk, fields in documents:
+        weights = {}
+        for name, field_terms in fields.items():
+            for term in set(field_terms):
+                # Насыщение по частоте, как в BM25: повторы слова дают все меньший прирост
+                frequency = field_terms.count(term)
+                weights[term] = weights.get(term, 0) + FIELD_WEIGHTS[name] * frequency / (frequency + 1)
+        entries.extend(SearchTermModel(post_id=pk, term=term[:64], weight=weight)
+                       for term, weight in weights.items())
+    SearchTermModel.objects.using(using).bulk_create(entries, batch_size=1000, ignore_conflicts=True)
+
+
+def remove(post_ids):
+    """Удаляет посты из индекса."""
+    post_ids = list(post_ids)
+    if not post_ids:
+        return
+    using = router.db_for_write(PostModel)
+    if _fts5(using):
+        with connections[using].cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE rowid IN (%s)' % (SEARCH_TABLE, ', '.join(['%s'] * len(post_ids))),
+                           post_ids)
+    else:
+        SearchTermModel.objects.using(using).filter(post_id__in=post_ids).delete()
+
+
+def rebuild(chunk_size=500):
+    """Полностью пересобирает индекс. Возвращает число постов."""
+    using = router.db_for_write(PostModel)
+    create_index(using)
+    if _fts5(using):
+        with connections[using].cursor() as cursor:
+            cursor.execute('DELETE FROM %s' % SEARCH_TABLE)
+    else:
+        SearchTermModel.objects.using(using).all().delete()
+    post_ids = list(PostModel.objects.order_by('pk').values_list('pk', flat=True))
+    for start in range(0, len(post_ids), chunk_size):
+        update(PostModel.objects.filter(pk__in=post_ids[start:start + chunk_size]).only('title', 'text', 'tag_list'))
+    return len(post_ids)
+
+
+def search(query, limit=50):
+    """pk постов, подходящих под все слова запроса, от более релевантных к менее."""
+    query_terms = list(dict.fromkeys(terms(query)))[:MAX_QUERY_TERMS]
+    if not query_terms:
+        return []
+    using = router.db_for_read(PostModel)
+    if _fts5(using):
+        with connections[using].cursor() as cursor:
+            # Термы состоят только из [a-z0-9], экранировать в выражении MATCH нечего
+            cursor.execute(
+                'SELECT rowid FROM {table} WHERE {table} MATCH %s ORDER BY bm25({table}, {weights}) LIMIT %s'.format(
+                    table=SEARCH_TABLE, weights=', '.join(str(weight) for weight in FIELD_WEIGHTS.values())),
+                [' '.join('%s*' % term for term in query_terms), limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    entries = SearchTermModel.objects.using(using)
+    matches = [Q(term__startswith=term) for term in query_terms]
+    total = PostModel.objects.using(using).count()
+    frequencies = entries.aggregate(**{
+        'df%s' % index: Count('post', distinct=True, filter=match) for index, match in enumerate(matches)
+    })
+    score = Value(0.0, output_field=FloatField())
+    matched = Value(0, output_field=IntegerField())
+    for index, match in enumerate(matches):
+        idf = math.log(1 + total / max(frequencies['df%s' % index], 1))
+        score += Sum(Case(When(match, then=F('weight') * idf), default=0.0, output_field=FloatField()))
+        matched += Max(Case(When(match, then=1), default=0, output_field=IntegerField()))
+    combined = Q()
+    for match in matches:
+        combined |= match
+    rows = (entries.filter(combined).values('post_id')
+            .annotate(score=score, matched=matched)
+            .filter(matched=len(matches))
+            .order_by('-score', '-post_id')[:limit])
+    return [row['post_id'] for row in rows]
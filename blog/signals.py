@@ -0,0 +1,206 @@
+from collections import Counter
+
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed, post_migrate
+from django.dispatch import receiver
+
+from . import cache, clusters, counters, mail, nearby, search, stats, tasks
+from .models import PostModel, TagModel, ImagePostModel, OutboxEmailModel
+
+
+@receiver(pre_save, sender=PostModel)
+def remember_post_state(sender, instance, **kwargs):
+    """Запоминает прежние координаты и emoji поста, чтобы сдвинуть его кластер и счетчики."""
+    instance._old_point = instance._old_emoji_id = None
+    old = None
+    if instance.pk:
+        old = PostModel.objects.filter(pk=instance.pk).values_list('lon', 'lat', 'emoji_id').first()
+    if old is not None:
+        instance._old_point, instance._old_emoji_id = old[:2], old[2]
+
+
+@receiver(post_save, sender=PostModel)
+def update_post_clusters(sender, instance, created, raw=False, **kwargs):
+    """Инкрементально обновляет кластеры карты при создании или переносе поста."""
+    if raw:
+        return
+    # lon хранит широту, lat - долготу (см. blog.geo)
+    point = (instance.lon, instance.lat)
+    old_point = getattr(instance, '_old_point', None)
+    if old_point == point:
+        return
+    # Пост без координат (их дадут геотеги фото) на карте не учитывается
+    if old_point is not None and None not in old_point:
+        clusters.remove_point(*old_point)
+    if None not in point:
+        clusters.add_point(*point)
+
+
+@receiver(post_save, sender=PostModel)
+def update_emoji_counts(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    old_emoji_id = getattr(instance, '_old_emoji_id', None)
+    if old_emoji_id != instance.emoji_id:
+        deltas = {instance.emoji_id: 1}
+        if old_emoji_id is not None:
+            deltas[old_emoji_id] = -1
+        counters.change_emojis(deltas)
+
+
+@receiver(pre_delete, sender=PostModel)
+def remember_post_tags(sender, instance, **kwargs):
+    """Связи с тегами удаляются каскадом без m2m_changed - запоминаем теги заранее."""
+    instance._tag_ids = list(instance.tag.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=PostModel)
+def update_deleted_post_counts(sender, instance, **kwargs):
+    counters.change_tags({pk: -1 for pk in getattr(instance, '_tag_ids', [])})
+    counters.change_emojis({instance.emoji_id: -1})
+
+
+@receiver(post_delete, sender=PostModel)
+def remove_post_from_clusters(sender, instance, **kwargs):
+    if instance.lon is not None and instance.lat is not None:
+        clusters.remove_point(instance.lon, instance.lat)
+
+
+@receiver(post_delete, sender=PostModel)
+def invalidate_post_fragments(sender, instance, **kwargs):
+    """Изменения поста меняют версию ключа сами, удаление - нет."""
+    cache.invalidate(instance, ['card', 'detail', 'map'])
+
+
+@receiver(post_save, sender=PostModel)
+@receiver(post_delete, sender=PostModel)
+def refresh_nearby_index(sender, raw=False, **kwargs):
+    if not raw:
+        nearby.mark_stale()
+
+
+@receiver(post_save, sender=PostModel)
+def update_trip_stats(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        stats.add_post(instance)
+    else:
+        stats.invalidate(instance.author_id)
+
+
+@receiver(post_delete, sender=PostModel)
+def reset_trip_stats(sender, instance, **kwargs):
+    stats.invalidate(instance.author_id)
+
+
+@receiver(post_save, sender=PostModel)
+def update_post_search(sender, instance, raw=False, **kwargs):
+    if not raw:
+        search.update([instance])
+
+
+@receiver(post_delete, sender=PostModel)
+def remove_post_from_search(sender, instance, **kwargs):
+    search.remove([instance.pk])
+
+
+@receiver(post_migrate)
+def create_search_index(sender, using, **kwargs):
+    """Таблица FTS5 не описывается моделью - создаем ее после migrate."""
+    if sender.name == 'blog':
+        search.create_index(using)
+
+
+@receiver(post_save, sender=ImagePostModel)
+@receiver(post_delete, sender=ImagePostModel)
+def update_post_cover(sender, instance, raw=False, **kwargs):
+    """Обновляет обложку поста при добавлении или удалении фото."""
+    if not raw:
+        PostModel.objects.filter(pk=instance.post_id).refresh_summary()
+
+
+@receiver(m2m_changed, sender=PostModel.tag.through)
+def remember_cleared_posts(sender, instance, action, reverse, **kwargs):
+    """tag.postmodel_set.clear() не передает pk постов - запоминаем их заранее."""
+    if reverse and action == 'pre_clear':
+        instance._cleared_post_ids = list(instance.postmodel_set.values_list('pk', flat=True))
+
+
+@receiver(m2m_changed, sender=PostModel.tag.through)
+def remember_unlinked_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    """Запоминает теги связей, которые действительно будут удалены.
+
+    В pre_remove pk_set содержит все переданные pk, в том числе не связанные.
+    """
+    if action not in ('pre_remove', 'pre_clear'):
+        return
+    links = sender.objects.filter(**{'tagmodel_id' if reverse else 'postmodel_id': instance.pk})
+    if action == 'pre_remove':
+        links = links.filter(**{'postmodel_id__in' if reverse else 'tagmodel_id__in': pk_set})
+    instance._unlinked_tags = Counter(links.values_list('tagmodel_id', flat=True))
+
+
+@receiver(m2m_changed, sender=PostModel.tag.through)
+def update_tag_counts(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_add':
+        counters.change_tags({instance.pk: len(pk_set)} if reverse else {pk: 1 for pk in pk_set})
+    elif action in ('post_remove', 'post_clear'):
+        counters.change_tags({pk: -count for pk, count in instance._unlinked_tags.items()})
+
+
+@receiver(m2m_changed, sender=PostModel.tag.through)
+def update_post_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    """Обновляет список тегов поста при изменении связей пост-тег."""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        posts = PostModel.objects.filter(pk=instance.pk)
+    elif action == 'post_clear':
+        posts = PostModel.objects.filter(pk__in=instance._cleared_post_ids)
+    else:
+        posts = PostModel.objects.filter(pk__in=pk_set)
+    posts.refresh_summary()
+    search.update(posts.only('title', 'text', 'tag_list'))
+
+
+@receiver(post_save, sender=TagModel)
+def update_renamed_tag(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        posts = PostModel.objects.filter(tag=instance)
+        posts.refresh_summary()
+        search.update(posts.only('title', 'text', 'tag_list'))
+
+
+@receiver(pre_delete, sender=TagModel)
+def remember_tag_posts(sender, instance, **kwargs):
+    instance._post_ids = list(instance.postmodel_set.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=TagModel)
+def update_deleted_tag(sender, instance, **kwargs):
+    posts = PostModel.objects.filter(pk__in=instance._post_ids)
+    posts.refresh_summary()
+    search.update(posts.only('title', 'text', 'tag_list'))
+
+
+@receiver(post_save, sender=ImagePostModel)
+def enqueue_image_processing(sender, instance, created, raw=False, **kwargs):
+    """Новое фото сохраняется как есть, уменьшение выполняется в фоне."""
+    if created and not raw:
+        tasks.run_in_background(tasks.process_image, instance.pk)
+
+
+@receiver(post_save, sender=OutboxEmailModel)
+def enqueue_email_sending(sender, instance, created, raw=False, **kwargs):
+    """Письмо отправляется в фоне после коммита, запрос не ждет почтовый сервер."""
+    if created and not raw:
+        tasks.run_in_background(mail.send_outbox)
+
+
+@receiver(post_delete, sender=ImagePostModel)
+def release_image_files(sender, instance, **kwargs):
+    """Снимает ссылки с файлов удаленного фото, в том числе при каскадном удалении поста."""
+    storage = instance.image.storage
+    for name in instance.file_names():
+        transaction.on_commit(lambda name=name: storage.delete(name))
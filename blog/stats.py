@@ -0,0 +1,124 @@
+"""Статистика поездок пользователя для страницы профиля.
+
+Считается NumPy по массивам координат и дат всех постов автора, а не циклом
+по строкам: пройденный путь - сумма отрезков между постами в порядке
+создания, самая дальняя точка - от первого поста (он считается домом),
+посты по месяцам - np.unique по датам, округленным до месяца, страны - по
+PostModel.country (см. blog.geocoder). Посты без места учитываются только
+в числе постов.
+
+Итоги хранятся в кэше отдельно для каждого пользователя вместе с тем, что
+нужно для продолжения: новый пост, созданный позже уже учтенных, добавляется
+к итогам без чтения остальных постов (add_post, вызывается сигналом).
+Изменение или удаление поста сбрасывает итоги (invalidate). При чтении число
+учтенных постов сверяется с базой одним COUNT, поэтому посты, созданные
+в обход сигналов (bulk_create при импорте поездки), тоже ведут к пересчету.
+"""
+from datetime import date
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from django.urls import reverse
+
+from . import nearby
+from .models import PostModel
+
+
+def _cache():
+    return caches[settings.FRAGMENT_CACHE_ALIAS]
+
+
+def _key(user_id):
+    return 'trip-stats:%s' % user_id
+
+
+def _month(created):
+    return '%04d-%02d' % (created.year, created.month)
+
+
+def _furthest(post_id, title, slug, distance):
+    return {'pk': post_id, 'title': title, 'url': reverse('post', kwargs={'url': slug}), 'distance': distance}
+
+
+def compute(user_id):
+    """Итоги по всем постам пользователя."""
+    rows = list(PostModel.objects.filter(author_id=user_id).order_by('datetime_create', 'pk')
+                .values_list('pk', 'title', 'slug', 'lon', 'lat', 'datetime_create', 'country_id'))
+    state = {'count': len(rows), 'distance': 0.0, 'months': {}, 'home': None, 'last': None, 'furthest': None,
+             'last_created': rows[-1][5] if rows else None, 'countries': [], 'home_country': None}
+    if not rows:
+        return state
+    post_ids, titles, slugs, latitudes, longitudes, created, countries = zip(*rows)
+    state['countries'] = np.unique(np.array([country for country in countries if country is not None],
+                                            dtype=np.int64)).tolist()
+    # Секунды от эпохи -> месяцы; даты постов хранятся в UTC
+    months, counts = np.unique(np.array([int(value.timestamp()) for value in created], dtype='datetime64[s]')
+                               .astype('datetime64[M]'), return_counts=True)
+    state['months'] = {str(month): int(count) for month, count in zip(months, counts)}
+    # lon хранит широту, lat - долготу (см. blog.geo); None становится NaN
+    points = np.radians(np.array([latitudes, longitudes], dtype=float).T)
+    located = np.flatnonzero(~np.isnan(points[:, 0]))
+    if not len(located):
+        return state
+    path = points[located]
+    state['distance'] = float(nearby.haversine(path[:-1, 0], path[:-1, 1], path[1:, 0], path[1:, 1]).sum())
+    state['home'], state['last'] = path[0].tolist(), path[-1].tolist()
+    state['home_country'] = countries[located[0]]
+    from_home = nearby.haversine(path[0, 0], path[0, 1], path[:, 0], path[:, 1])
+    furthest = int(np.argmax(from_home))
+    row = located[furthest]
+    state['furthest'] = _furthest(post_ids[row], titles[row], slugs[row], float(from_home[furthest]))
+    return state
+
+
+def add_post(post):
+    """Добавляет к сохраненным итогам новый пост; пост с более ранней датой ведет к пересчету."""
+    key = _key(post.author_id)
+    state = _cache().get(key)
+    if state is None:
+        return
+    if state['last_created'] is not None and post.datetime_create < state['last_created']:
+        _cache().delete(key)
+        return
+    state['count'] += 1
+    state['last_created'] = post.datetime_create
+    month = _month(post.datetime_create)
+    state['months'][month] = state['months'].get(month, 0) + 1
+    if post.country_id is not None and post.country_id not in state['countries']:
+        state['countries'].append(post.country_id)
+    if post.lon is not None and post.lat is not None:
+        point = [float(np.radians(post.lon)), float(np.radians(post.lat))]
+        if state['home'] is None:
+            state['home'], state['home_country'] = point, post.country_id
+            state['furthest'] = _furthest(post.pk, post.title, post.slug, 0.0)
+        else:
+            state['distance'] += float(nearby.haversine(*state['last'], *point))
+            from_home = float(nearby.haversine(*state['home'], *point))
+            if from_home > state['furthest']['distance']:
+                state['furthest'] = _furthest(post.pk, post.title, post.slug, from_home)
+        state['last'] = point
+    _cache().set(key, state, settings.TRIP_STATS_CACHE_TIMEOUT)
+
+
+def invalidate(user_id):
+    _cache().delete(_key(user_id))
+
+
+def get(user_id):
+    """Итоги для страницы профиля: из кэша или пересчитанные заново."""
+    key = _key(user_id)
+    state = _cache().get(key)
+    if state is None or state['count'] != PostModel.objects.filter(author_id=user_id).count():
+        state = compute(user_id)
+        _cache().set(key, state, settings.TRIP_STATS_CACHE_TIMEOUT)
+    months = [(date(int(month[:4]), int(month[5:]), 1), count) for month, count in sorted(state['months'].items())]
+    return {
+        'posts': state['count'],
+        'distance': state['distance'],
+        'countries': len(state['countries']),
+        'home_country': state['home_country'],
+        'furthest': state['furthest'],
+        'months': months,
+        'busiest_month': max(count for _, count in months) if months else 0,
+    }
@@ -0,0 +1,86 @@
+"""Хранилище медиафайлов с адресацией по содержимому.
+
+Файл сохраняется под именем blobs/ab/cd/<sha256>.<ext>, поэтому повторная
+загрузка того же фото не пишет на диск ничего нового. Число ссылок на каждый
+файл ведется в MediaBlobModel: save() увеличивает его, delete() уменьшает,
+а сам файл удаляется, когда ссылок не осталось. Команда collect_blobs
+пересчитывает ссылки по базе и убирает потерянные файлы.
+"""
+import hashlib
+import os
+import posixpath
+import tempfile
+
+from django.apps import apps
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.db.models import F
+from django.utils.deconstruct import deconstructible
+
+BLOB_PREFIX = 'blobs'
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+
+    @staticmethod
+    def _blobs():
+        return apps.get_model('blog', 'MediaBlobModel').objects
+
+    def get_available_name(self, name, max_length=None):
+        # Имя определяется содержимым, одинаковые файлы должны совпадать по имени.
+        return name
+
+    def blob_name(self, name, content):
+        """Имя файла по SHA-256 содержимого; каталог из upload_to отбрасывается."""
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        digest = digest.hexdigest()
+        extension = os.path.splitext(name)[1].lower()
+        return posixpath.join(BLOB_PREFIX, digest[:2], digest[2:4], digest + extension)
+
+    def _save(self, name, content):
+        name = self.blob_name(name, content)
+        with transaction.atomic():
+            self._blobs().get_or_create(name=name, defaults={'size': content.size})
+            self._blobs().filter(name=name).update(refs=F('refs') + 1)
+        if not self.exists(name):
+            self._write(name, content)
+        return name
+
+    def _write(self, name, content):
+        """Пишет файл во временный и атомарно переименовывает его."""
+        full_path = self.path(name)
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+        descriptor, temporary_path = tempfile.mkstemp(dir=directory, suffix='.part')
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                for chunk in content.chunks():
+                    file.write(chunk)
+            if self.file_permissions_mode is not None:
+                os.chmod(temporary_path, self.file_permissions_mode)
+            os.replace(temporary_path, full_path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+    def delete(self, name):
+        """Снимает одну ссылку с файла и удаляет его, если ссылок не осталось."""
+        if not name:
+            return
+        if not name.startswith(BLOB_PREFIX + '/'):
+            # Файлы, загруженные до перехода на это хранилище
+            return super().delete(name)
+        with transaction.atomic():
+            if not self._blobs().filter(name=name).update(refs=F('refs') - 1):
+                # Файл без учета ссылок - решение о нем примет collect_blobs
+                return
+            orphan = self._blobs().filter(name=name, refs__lte=0).delete()[0]
+        if orphan:
+            super().delete(name)
+
+
+blob_storage = ContentAddressedStorage()
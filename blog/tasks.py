@@ -0,0 +1,80 @@
+"""Фоновые задачи блога.
+
+Задачи выполняются в пуле потоков после коммита транзакции, в которой они
+поставлены. Если BACKGROUND_TASKS_ASYNC = False, задача выполняется сразу
+в текущем потоке (удобно для тестов и отладки).
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from .models import ImagePostModel
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.BACKGROUND_WORKERS,
+                                       thread_name_prefix='blog-tasks')
+    return _executor
+
+
+def _run(func, args):
+    try:
+        func(*args)
+    except Exception:
+        logger.exception('Фоновая задача %s завершилась с ошибкой', func.__name__)
+    finally:
+        # У каждого потока пула свое подключение к БД - не оставляем его открытым.
+        connections.close_all()
+
+
+def run_in_background(func, *args):
+    """Ставит func(*args) в очередь после коммита текущей транзакции."""
+    def submit():
+        if settings.BACKGROUND_TASKS_ASYNC:
+            get_executor().submit(_run, func, args)
+        else:
+            func(*args)
+    transaction.on_commit(submit)
+
+
+def wait():
+    """Дожидается всех поставленных задач. Нужно командам, после которых процесс завершается."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+def run_many(func, arguments):
+    """Выполняет func для каждого кортежа аргументов в пуле и дожидается завершения."""
+    futures = [get_executor().submit(_run, func, args) for args in arguments]
+    for future in futures:
+        future.result()
+    return len(futures)
+
+
+def process_image(image_id):
+    """Обрабатывает загруженное фото поста и помечает результат в status.
+
+    Фото забирается условным UPDATE pending -> processing, поэтому два
+    исполнителя (или повторный запуск process_images) не обработают его дважды.
+    """
+    claimed = ImagePostModel.objects.filter(pk=image_id, status=ImagePostModel.STATUS_PENDING).update(
+        status=ImagePostModel.STATUS_PROCESSING)
+    image = ImagePostModel.objects.filter(pk=image_id).first() if claimed else None
+    if image is None:
+        return
+    try:
+        image.process()
+    except Exception:
+        ImagePostModel.objects.filter(pk=image_id, status=ImagePostModel.STATUS_PROCESSING).update(
+            status=ImagePostModel.STATUS_FAILED)
+        raise
@@ -0,0 +1,32 @@
+import math
+
+from django.template import Library
+
+from blog.models import TagModel, EmojisModel
+
+register = Library()
+
+# Классы размера шрифта Bootstrap от мелкого к крупному
+CLOUD_SIZES = ['fs-6', 'fs-5', 'fs-4', 'fs-3', 'fs-2']
+
+
+@register.inclusion_tag('blog/include/tag_cloud.html')
+def tag_cloud(limit=30, current=None):
+    """Облако самых популярных тегов по материализованным счетчикам (см. blog.counters).
+
+    Размер шрифта тега выбирается из CLOUD_SIZES по логарифму числа постов.
+    """
+    tags = list(TagModel.objects.filter(post_count__gt=0).order_by('-post_count', 'name')[:limit])
+    if tags:
+        top = math.log(tags[0].post_count + 1)
+        for tag in tags:
+            tag.cloud_size = CLOUD_SIZES[round((len(CLOUD_SIZES) - 1) * math.log(tag.post_count + 1) / top)]
+        tags.sort(key=lambda tag: tag.name)
+    return {'tags': tags, 'current': current}
+
+
+@register.inclusion_tag('blog/include/emoji_menu.html')
+def emoji_menu(current=None):
+    """Меню фильтра по emoji с количеством постов."""
+    emojis = EmojisModel.objects.filter(post_count__gt=0).order_by('-post_count', 'name')
+    return {'emojis': emojis, 'current': current}
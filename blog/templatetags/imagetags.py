@@ -0,0 +1,41 @@
+from django.core.files.storage import default_storage
+from django.template import Library
+from django.utils.html import format_html, format_html_join
+
+from blog.imaging import FORMATS, SIZES
+
+register = Library()
+
+
+def _srcset(variants, format_name, storage):
+    """Строка srcset из всех копий фото в заданном формате."""
+    return ', '.join('%s %sw' % (storage.url(variant['files'][format_name]), variant['width'])
+                     for variant in variants.values() if format_name in variant['files'])
+
+
+def picture(file, variants, size='full', sizes='100vw', css_class='', alt=''):
+    """HTML <picture> с srcset по всем копиям фото.
+
+    file - поле с фото (ImagePostModel.image или PostModel.cover),
+    variants - словарь копий (ImagePostModel.variants или PostModel.cover_variants).
+    Пока копий нет (фото обрабатывается), выводится оригинал.
+    """
+    if not file:
+        return ''
+    if not variants:
+        return format_html('<img src="{}" class="{}" alt="{}">', file.url, css_class, alt)
+    storage = getattr(file, 'storage', default_storage)
+    sources = format_html_join(
+        '', '<source type="{}" srcset="{}" sizes="{}">',
+        ((FORMATS[name][2], _srcset(variants, name, storage), sizes)
+         for name in FORMATS if name != 'jpeg' and any(name in v['files'] for v in variants.values())),
+    )
+    fallback = variants.get(size) or variants[max(variants, key=lambda name: SIZES[name][0])]
+    return format_html(
+        '<picture>{}<img src="{}" srcset="{}" sizes="{}" width="{}" height="{}" class="{}" alt="{}"></picture>',
+        sources, storage.url(fallback['files']['jpeg']), _srcset(variants, 'jpeg', storage), sizes,
+        fallback['width'], fallback['height'], css_class, alt,
+    )
+
+
+register.simple_tag(picture, name='picture')
@@ -0,0 +1,32 @@
+from django import template
+
+from blog import cache
+
+register = template.Library()
+
+
+class PostCacheNode(template.Node):
+    def __init__(self, nodelist, kind, post):
+        self.nodelist = nodelist
+        self.kind = kind
+        self.post = post
+
+    def render(self, context):
+        post = self.post.resolve(context)
+        return cache.get_or_render(self.kind.resolve(context), post, lambda: self.nodelist.render(context))
+
+
+def do_postcache(parser, token):
+    """Кэширует фрагмент шаблона для версии поста.
+
+    Использование: {% postcache 'card' post %} ... {% endpostcache %}
+    """
+    bits = token.split_contents()
+    if len(bits) != 3:
+        raise template.TemplateSyntaxError("'%s' принимает два аргумента: вид фрагмента и пост" % bits[0])
+    nodelist = parser.parse(('endpostcache',))
+    parser.delete_first_token()
+    return PostCacheNode(nodelist, parser.compile_filter(bits[1]), parser.compile_filter(bits[2]))
+
+
+register.tag('postcache', do_postcache)
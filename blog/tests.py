@@ -1,3 +1,1396 @@
-from django.test import TestCase
+import json
+import os
+import re
+import runpy
+import shutil
+import sqlite3
+import tempfile
+import zipfile
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+from PIL import Image
+from django.conf import settings
+from django.core import mail as django_mail
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connection, connections, transaction
+from django.template import Context, Template, engines
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from . import (clusters, counters, geocoder, imaging, mail, metrics, nearby, pagination, routers, search, stats, tasks,
+               trips)
+from .benchmarks import data
+from .forms import UserChangeForm
+from .models import (User, PostModel, TagModel, EmojisModel, ImagePostModel, OutboxEmailModel, CountryModel,
+                     MediaBlobModel, MapClusterModel)
+from .storage import blob_storage
+from .views import ListPostView
+
+MEDIA_ROOT = tempfile.mkdtemp()
+CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def make_image(name='photo.jpg', size=(64, 48), exif=None):
+    """Загружаемый файл с небольшим JPEG для тестов."""
+    buffer = BytesIO()
+    Image.new('RGB', size, 'blue').save(buffer, format='JPEG', **({'exif': exif} if exif else {}))
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/jpeg')
+
+
+def make_exif(location=None, taken=None):
+    """EXIF с координатами (широта, долгота) и временем съемки 'ГГГГ:ММ:ДД ЧЧ:ММ:СС'."""
+    exif = Image.Exif()
+    if location:
+        exif[0x8825] = {1: 'N' if location[0] >= 0 else 'S', 2: (abs(location[0]), 0.0, 0.0),
+                        3: 'E' if location[1] >= 0 else 'W', 4: (abs(location[1]), 0.0, 0.0)}
+    if taken:
+        exif[0x8769] = {0x9003: taken}
+    return exif
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHES=CACHES)
+class MapFeedTest(TestCase):
+    """Лента карты отдает посты внутри bbox, а на мелких зумах - кластеры"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('author@example.com', 'password')
+        self.emoji = EmojisModel.objects.create(name='smile', emoji='blog/emoji/smile.png')
+        self.posts = {title: PostModel.objects.create(author=self.user, emoji=self.emoji, title=title, text='Текст',
+                                                      lon=latitude, lat=longitude)
+                      for title, latitude, longitude in [('Москва', 55.75, 37.62), ('Казань', 55.79, 49.12),
+                                                         ('Анадырь', 64.73, 177.51), ('Провидения', 64.42, -173.23)]}
+        PostModel.objects.create(author=self.user, emoji=self.emoji, title='Без места', text='Текст')
+        self.client.force_login(self.user)
+
+    def get_features(self, **params):
+        response = self.client.get(reverse('map-feed'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()['features']
+
+    def get_titles(self, bbox):
+        return {feature['properties']['title'] for feature in self.get_features(bbox=bbox)}
+
+    def test_posts_in_bbox(self):
+        features = self.get_features(bbox='50,30,60,40')
+        moscow = self.posts['Москва']
+        self.assertEqual([feature['id'] for feature in features], [moscow.pk])
+        # GeoJSON: [долгота, широта]
+        self.assertEqual(features[0]['geometry']['coordinates'], [37.62, 55.75])
+        self.assertEqual(features[0]['properties']['url'], moscow.get_absolute_url())
+        self.assertEqual(self.get_titles('50,30,60,50'), {'Москва', 'Казань'})
+        # Долготы после прокрутки мира приводятся к [-180, 180]
+        self.assertEqual(self.get_titles('50,390,60,400'), {'Москва'})
+
+    def test_bbox_across_antimeridian(self):
+        self.assertEqual(self.get_titles('60,170,70,-170'), {'Анадырь', 'Провидения'})
+        self.assertEqual(self.get_titles('60,170,70,180'), {'Анадырь'})
+        self.assertEqual(self.get_titles('-85,-180,85,180'), {'Москва', 'Казань', 'Анадырь', 'Провидения'})
+
+    def test_bad_params(self):
+        for params in [{}, {'bbox': 'a,b,c,d'}, {'bbox': '50,30,60'}, {'bbox': '60,30,50,40'},
+                       {'bbox': '-95,30,60,40'}, {'bbox': '50,30,95,40'}, {'bbox': '50,30,60,40', 'zoom': 'x'}]:
+            with self.subTest(params=params), self.assertLogs('django.request', 'WARNING'):
+                response = self.client.get(reverse('map-feed'), params)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('error', response.json())
+
+    def test_zoom_threshold(self):
+        features = self.get_features(bbox='-85,-180,85,180', zoom=0)
+        self.assertTrue(all(feature['properties']['cluster'] for feature in features))
+        self.assertEqual(sum(feature['properties']['count'] for feature in features), 4)
+        features = self.get_features(bbox='50,30,60,50', zoom=clusters.CLUSTER_MAX_ZOOM)
+        self.assertEqual(sorted(feature['properties']['count'] for feature in features), [1, 1])
+        features = self.get_features(bbox='50,30,60,50', zoom=clusters.CLUSTER_MAX_ZOOM + 1)
+        self.assertEqual({feature['id'] for feature in features},
+                         {self.posts['Москва'].pk, self.posts['Казань'].pk})
+        self.assertFalse(any('cluster' in feature['properties'] for feature in features))
+
+
+@override_settings(CACHES=CACHES)
+class MapClusterTest(TestCase):
+    """Кластеры карты обновляются при создании, переносе и удалении постов так же, как при пересборке"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('author@example.com', 'password')
+        self.emoji = EmojisModel.objects.create(name='smile', emoji='blog/emoji/smile.png')
+
+    def create_post(self, title, latitude, longitude):
+        return PostModel.objects.create(author=self.user, emoji=self.emoji, title=title, text='Текст',
+                                        lon=latitude, lat=longitude)
+
+    def snapshot(self):
+        return {(cluster.zoom, cluster.x, cluster.y): (cluster.count, round(cluster.latitude_sum, 9),
+                                                        round(cluster.longitude_sum, 9))
+                for cluster in MapClusterModel.objects.all()}
+
+    def assertMatchesRebuild(self):
+        incremental = self.snapshot()
+        self.assertTrue(all(count > 0 for count, _, _ in incremental.values()))
+        call_command('rebuild_clusters', stdout=StringIO())
+        self.assertEqual(incremental, self.snapshot())
+
+    def test_incremental_maintenance(self):
+        moscow = self.create_post('Москва', 55.75, 37.62)
+        self.create_post('Кремль', 55.76, 37.64)
+        kazan = self.create_post('Казань', 55.79, 49.12)
+        self.assertEqual([cluster.count for cluster in clusters.in_bbox(0, -85, -180, 85, 180)], [3])
+        self.assertEqual(sorted(cluster.count for cluster in clusters.in_bbox(8, 50, 30, 60, 50)), [1, 2])
+        self.assertMatchesRebuild()
+        kazan.lon, kazan.lat = 59.94, 30.31
+        kazan.save()
+        kazan.save()
+        self.assertMatchesRebuild()
+        moscow.delete()
+        self.assertMatchesRebuild()
+        unplaced = self.create_post('Сочи', None, None)
+        self.assertMatchesRebuild()
+        unplaced.place(43.6, 39.7)
+        self.assertMatchesRebuild()
+        PostModel.objects.all().delete()
+        self.assertEqual(self.snapshot(), {})
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHES=CACHES)
+class PostQueryCountTest(TestCase):
+    """Количество запросов при выводе постов не зависит от их числа"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('author@example.com', 'password')
+        cls.emoji = EmojisModel.objects.create(name='smile', emoji='blog/emoji/smile.png')
+        cls.tags = [TagModel.objects.create(name='Горы'), TagModel.objects.create(name='Море')]
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+    def create_posts(self, count, images=2):
+        posts = []
+        start = PostModel.objects.count()
+        for number in range(start, start + count):
+            post = PostModel.objects.create(author=self.user, title='Пост %s' % number, text='Текст',
+                                            lon=55.75 + number / 100, lat=37.6, emoji=self.emoji)
+            post.tag.set(self.tags)
+            for _ in range(images):
+                ImagePostModel.objects.create(post=post, image=make_image())
+            posts.append(post)
+        return posts
+
+    def count_queries(self, func):
+        with CaptureQueriesContext(connection) as context:
+            func()
+        return len(context.captured_queries)
+
+    def load_posts(self):
+        for post in PostModel.objects.with_related():
+            post.author.email, post.emoji.name, list(post.tag.all()), post.images[:1]
+
+    def test_loader_query_count_is_flat(self):
+        self.create_posts(2)
+        small = self.count_queries(self.load_posts)
+        self.create_posts(8)
+        self.assertEqual(self.count_queries(self.load_posts), small)
+
+    def test_home_query_count_is_flat(self):
+        self.create_posts(12)
+        self.client.force_login(self.user)
+        counts = []
+        for page_size in (2, 4, 12):
+            # Лента кэшируется целиком - измеряем рендер, а не попадание в кэш
+            cache.clear()
+            with mock.patch.object(ListPostView, 'paginate_by', page_size):
+                counts.append(self.count_queries(lambda: self.client.get(reverse('home'))))
+        self.assertEqual(len(set(counts)), 1, counts)
+
+    def test_detail_query_count_is_flat(self):
+        few, many = self.create_posts(1, images=1)[0], self.create_posts(1, images=5)[0]
+        self.client.force_login(self.user)
+        # Индекс ближайших постов сверяется с базой при первом запросе - сверяем заранее
+        nearby.nearest(0, 0)
+        self.assertEqual(
+            self.count_queries(lambda: self.client.get(few.get_absolute_url())),
+            self.count_queries(lambda: self.client.get(many.get_absolute_url())),
+        )
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHES=CACHES)
+class PostSummaryTest(TestCase):
+    """Обложка и список тегов поста следуют за фото и тегами"""
+
+    def setUp(self):
+        user = User.objects.create_user('author@example.com', 'password')
+        emoji = EmojisModel.objects.create(name='smile', emoji='blog/emoji/smile.png')
+        self.mountains, self.sea = TagModel.objects.create(name='Горы'), TagModel.objects.create(name='Море')
+        self.post = PostModel.objects.create(author=user, emoji=emoji, title='Пост', text='Текст',
+                                             lon=55.75, lat=37.62)
+        self.post.tag.set([self.sea, self.mountains])
+        self.images = [ImagePostModel.objects.create(post=self.post, image=make_image(size=size))
+                       for size in ((64, 48), (48, 64))]
+
+    def summary(self):
+        self.post.refresh_from_db()
+        return self.post.cover.name, self.post.tag_list
+
+    def test_tags(self):
+        self.assertEqual(self.summary()[1], ['Горы', 'Море'])
+        self.sea.name = 'Айсберги'
+        self.sea.save()
+        self.assertEqual(self.summary()[1], ['Айсберги', 'Горы'])
+        self.mountains.delete()
+        self.assertEqual(self.summary()[1], ['Айсберги'])
+
+    def test_cover(self):
+        first, second = self.images
+        self.assertEqual(self.summary()[0], first.image.name)
+        first.delete()
+        self.assertEqual(self.summary()[0], second.image.name)
+        second.delete()
+        self.assertEqual(self.summary()[0], '')
+
+    def test_backfill(self):
+        expected = self.summary()
+        PostModel.objects.update(cover='', cover_variants={}, tag_list=[])
+        call_command('backfill_post_summary', '--chunk-size', '1', stdout=StringIO())
+        self.assertEqual(self.summary(), expected)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHES=CACHES, BACKGROUND_TASKS_ASYNC=False)
+class ImageProcessingTest(TestCase):
+    """Фото обрабатывается одним исполнителем, неудачная обработка не оставляет ссылок на копии"""
+
+    def setUp(self):
+        user = User.objects.create_user('author@example.com', 'password')
+        emoji = EmojisModel.objects.create(name='smile', emoji='blog/emoji/smile.png')
+        self.post = PostModel.objects.create(author=user, emoji=emoji, title='Пост', text='Текст',
+                                             lon=55.75, lat=37.62)
+        # Без выполнения on_commit: фото ждет обработки
+        self.image = ImagePostModel.objects.create(post=self.post, image=make_image(size=(1400, 800)))
+        self.original = self.image.image.name
+
+    def blobs(self):
+        return dict(MediaBlobModel.objects.values_list('name', 'refs'))
+
+    def test_processed_once(self):
+        with mock.patch.object(ImagePostModel, 'process', autospec=True,
+                               side_effect=ImagePostModel.process) as process:
+            tasks.process_image(self.image.pk)
+            tasks.process_image(self.image.pk)
+        self.assertEqual(process.call_count, 1)
+        self.image.refresh_from_db()
+        self.assertEqual(self.image.status, ImagePostModel.STATUS_READY)
+        self.assertEqual(sum(self.blobs().values()), len(self.image.file_names()))
+
+    def test_claimed_image_skipped(self):
+        ImagePostModel.objects.filter(pk=self.image.pk).update(status=ImagePostModel.STATUS_PROCESSING)
+        with mock.patch.object(ImagePostModel, 'process') as process:
+            tasks.process_image(self.image.pk)
+        process.assert_not_called()
+        self.assertTrue(self.post.images_processing)
+
+    def test_failure_releases_copies(self):
+        def failing(file, name, metadata=None):
+            yield from list(derivatives(file, name, metadata))[:3]
+            raise OSError('диск заполнен')
+
+        derivatives = imaging.iter_derivatives
+        with mock.patch.object(imaging, 'iter_derivatives', failing), self.assertRaises(OSError):
+            tasks.process_image(self.image.pk)
+        self.assertEqual(ImagePostModel.objects.get().status, ImagePostModel.STATUS_FAILED)
+        self.assertEqual(self.blobs(), {self.original: 1})
+
+    def test_deleted_during_processing(self):
+        def deleting(file, name, metadata=None):
+            for derivative in derivatives(file, name, metadata):
+                ImagePostModel.objects.filter(pk=self.image.pk).delete()
+                yield derivative
+
+        derivatives = imaging.iter_derivatives
+        with mock.patch.object(imaging, 'iter_derivatives', deleting), self.assertRaises(DatabaseError), \
+                self.captureOnCommitCallbacks(execute=True):
+            tasks.process_image(self.image.pk)
+        self.assertEqual(self.blobs(), {})
+        self.assertFalse(blob_storage.exists(self.original))
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHES=CACHES, BACKGROUND_TASKS_ASYNC=False)
+class PictureTagTest(TestCase):
+    """{% picture %} выводит источники AVIF и WebP с srcset по ширинам и JPEG-фолбэк"""
+    template = Template("{% load imagetags %}{% picture image.image image.variants 'card' sizes 'photo' 'Алтай' %}")
+    sizes = '(max-width: 640px) 100vw, 640px'
+
+    def setUp(self):
+        user = User.objects.create_user('author@example.com', 'password')
+        emoji = EmojisModel.objects.create(name='smile', emoji='blog/emoji/smile.png')
+        self.post = PostModel.objects.create(author=user, emoji=emoji, title='Пост', text='Текст',
+                                             lon=55.75, lat=37.62)
+
+    def render(self, image):
+        return self.template.render(Context({'image': image, 'sizes': self.sizes}))
+
+    def parse_srcset(self, srcset):
+        return [re.fullmatch(r'(\S+) (\d+)w', item).groups() for item in srcset.split(', ')]
+
+    def test_processed(self):
+        image = ImagePostModel.objects.create(post=self.post, image=make_image(size=(1600, 900)))
+        tasks.process_image(image.pk)
+        image.refresh_from_db()
+        html = self.render(image)
+        widths = sorted(variant['width'] for variant in image.variants.values())
+        self.assertEqual(widths, [160, 320, 640, 1280])
+
+        sources = re.findall(r'<source type="([^"]+)" srcset="([^"]+)" sizes="([^"]+)">', html)
+        formats = [name for name in imaging.FORMATS if name != 'jpeg' and name in imaging.available_formats()]
+        self.assertEqual([source[0] for source in sources], [imaging.FORMATS[name][2] for name in formats])
+        for name, (_, srcset, sizes) in zip(formats, sources):
+            entries = self.parse_srcset(srcset)
+            self.assertEqual(sorted(int(width) for _, width in entries), widths)
+            self.assertTrue(all(url.endswith('.' + imaging.FORMATS[name][1]) for url, _ in entries))
+            self.assertEqual(sizes, self.sizes)
+        # Источники идут до <img>, иначе браузер их не рассмотрит
+        self.assertTrue(html.startswith('<picture><source ' if sources else '<picture><img '))
+
+        img = re.search(r'<img src="([^"]+)" srcset="([^"]+)" sizes="([^"]+)" width="(\d+)" height="(\d+)" '
+                        r'class="photo" alt="Алтай"></picture>$', html)
+        self.assertIsNotNone(img, html)
+        src, srcset, sizes, width, height = img.groups()
+        card = image.variants['card']
+        self.assertEqual(src, default_storage.url(card['files']['jpeg']))
+        self.assertEqual((int(width), int(height)), (card['width'], card['height']))
+        self.assertEqual(sorted(int(width) for _, width in self.parse_srcset(srcset)), widths)
+        self.assertEqual(sizes, self.sizes)
+
+    def test_source_order(self):
+        """AVIF идет раньше WebP, даже если установленный Pillow не умеет сохранять AVIF."""
+        image = ImagePostModel.objects.create(post=self.post, image=make_image(size=(1600, 900)))
+        tasks.process_image(image.pk)
+        image.refresh_from_db()
+        for variant in image.variants.values():
+            variant['files']['avif'] = variant['files']['jpeg'].replace('.jpg', '.avif')
+        self.assertEqual(re.findall(r'<source type="([^"]+)"', self.render(image)), ['image/avif', 'image/webp'])
+
+    def test_pending(self):
+        # Без выполнения on_commit: фото ждет обработки
+        image = ImagePostModel.objects.create(post=self.post, image=make_image(size=(1400, 800)))
+        self.assertEqual((image.status, image.variants), (ImagePostModel.STATUS_PENDING, {}))
+        self.assertEqual(self.render(image),
+                         '<img src="%s" class="photo" alt="Алтай">' % image.image.url)
+
+
+@override_settings(CACHES=CACHES, BACKGROUND_TASKS_ASYNC=False)
+class BlobStorageTest(TestCase):
+    """Одинаковые файлы хранятся один раз, файл удаляется вместе с последней ссылкой"""
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = self.settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = User.objects.create_user('author@example.com', 'password')
+        self.emoji = EmojisModel.objects.create(name='smile', emoji='blog/emoji/smile.png')
+        self.post = PostModel.objects.create(author=self.user, emoji=self.emoji, title='Пост', text='Текст',
+                                             lon=55.75, lat=37.62)
+
+    def refs(self, name):
+        return MediaBlobModel.objects.filter(name=name).values_list('refs', flat=True).first()
+
+    def test_identical_uploads_share_blob(self):
+        first = ImagePostModel.objects.create(post=self.post, image=make_image('first.jpg'))
+        second = ImagePostModel.objects.create(post=self.post, image=make_image('second.jpg'))
+        name = first.image.name
+        self.assertEqual(second.image.name, name)
+        self.assertTrue(name.startswith('blobs/'))
+        self.assertEqual(self.refs(name), 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(self.refs(name), 1)
+        self.assertTrue(blob_storage.exists(name))
+        # Каскадное удаление поста снимает ссылки его фото
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post.delete()
+        self.assertIsNone(self.refs(name))
+        self.assertFalse(blob_storage.exists(name))
+
+    def test_processed_image_releases_all_copies(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            # Крупнее копии full, иначе копия совпадет с оригиналом байт в байт
+            image = ImagePostModel.objects.create(post=self.post, image=make_image(size=(1400, 800)))
+        original = image.image.name
+        for callback in callbacks:
+            callback()
+        image.refresh_from_db()
+        names = image.file_names()
+        self.assertEqual(image.status, ImagePostModel.STATUS_READY)
+        # Оригинал заменен копиями и больше не хранится
+        self.assertIsNone(self.refs(original))
+        self.assertFalse(blob_storage.exists(original))
+        self.assertEqual(sum(MediaBlobModel.objects.values_list('refs', flat=True)), len(names))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post.delete()
+        self.assertFalse(MediaBlobModel.objects.exists())
+        self.assertFalse(any(blob_storage.exists(name) for name in names))
+
+    def test_avatar_replacement(self):
+        friend = User.objects.create_user('friend@example.com', 'password')
+        names = []
+        for user, size in ((self.user, (30, 30)), (friend, (30, 30)), (self.user, (40, 40))):
+            form = UserChangeForm({'email': user.email}, {'avatar': make_image(size=size)}, instance=user)
+            self.assertTrue(form.is_valid(), form.errors)
+            names.append(form.save().avatar.name)
+        first, shared, replaced = names
+        self.assertEqual(first, shared)
+        self.assertNotEqual(first, replaced)
+        # У первого аватара осталась ссылка друга, у нового - одна
+        self.assertEqual((self.refs(first), self.refs(replaced)), (1, 1))
+        form = UserChangeForm({'email': friend.email}, {'avatar': make_image(size=(50, 50))}, instance=friend)
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+        self.assertIsNone(self.refs(first))
+        self.assertFalse(blob_storage.exists(first))
+
+    def test_collect_blobs(self):
+        image = ImagePostModel.objects.create(post=self.post, image=make_image())
+        dropped = image.image.name
+        MediaBlobModel.objects.filter(name=dropped).update(refs=7)
+        kept = blob_storage.save('kept.jpg', make_image(size=(10, 10)))
+        ImagePostModel.objects.filter(pk=image.pk).update(image=kept)
+        stray = blob_storage.save('stray.jpg', make_image(size=(20, 20)))
+        unrecorded = ImagePostModel.objects.create(post=self.post, image=make_image(size=(30, 30))).image.name
+        MediaBlobModel.objects.filter(name__in=[stray, unrecorded]).delete()
+
+        out = StringIO()
+        call_command('collect_blobs', '--dry-run', stdout=out)
+        self.assertEqual(set(out.getvalue().split()[:2]), {dropped, stray})
+        self.assertTrue(blob_storage.exists(dropped))
+        self.assertEqual(self.refs(dropped), 7)
+
+        call_command('collect_blobs', stdout=StringIO())
+        # Ссылки пересчитаны по базе: удалены только файлы, на которые никто не ссылается
+        self.assertEqual(dict(MediaBlobModel.objects.values_list('name', 'refs')), {kept: 1, unrecorded: 1})
+        self.assertTrue(blob_storage.exists(kept))
+        self.assertTrue(blob_storage.exists(unrecorded))
+        self.assertFalse(blob_storage.exists(dropped))
+        self.assertFalse(blob_storage.exists(stray))
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHES=CACHES)
+class FeedCacheTest(TestCase):
+    """Лента кэшируется на пользователя и отдает 304 по ETag, пока посты не изменились"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('author@example.com', 'password')
+        self.friend = User.objects.create_user('friend@example.com', 'password')
+        emoji = EmojisModel.objects.create(name='smile', emoji='blog/emoji/smile.png')
+        self.post = PostModel.objects.create(author=self.user, emoji=emoji, title='Москва', text='Текст',
+                                             lon=55.75, lat=37.62)
+        self.client.force_login(self.user)
+
+    def test_conditional_get(self):
+        response = self.client.get(reverse('home'))
+        etag = response['ETag']
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response['Cache-Control'])
+        with mock.patch.object(ListPostView, 'get_queryset', side_effect=AssertionError('рендер')):
+            self.assertEqual(self.client.get(reverse('home'), HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            # Без заголовка ответ берется из кэша, а не рендерится заново
+            cached = self.client.get(reverse('home'))
+        self.assertEqual((cached.status_code, cached['ETag'], cached.content), (200, etag, response.content))
+        feed = self.client.get(reverse('feed'))
+        self.assertNotEqual(feed['ETag'], etag)
+
+    def test_post_change_invalidates(self):
+        etag = self.client.get(reverse('home'))['ETag']
+        self.post.title = 'Казань'
+        self.post.save()
+        response = self.client.get(reverse('home'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.context['map_items'][0]['icon'], 'Казань')
+        etag = response['ETag']
+        self.post.delete()
+        response = self.client.get(reverse('home'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response.context['map_items']), (200, []))
+
+    def test_cached_hit_sets_no_cookies(self):
+        render = ListPostView.render_to_response
+
+        def render_with_cookie(view, context, **kwargs):
+            response = render(view, context, **kwargs)
+            response.set_cookie('feed_seen', 'author')
+            return response
+
+        with mock.patch.object(ListPostView, 'render_to_response', render_with_cookie):
+            response = self.client.get(reverse('home'))
+            self.assertEqual(response.cookies['feed_seen'].value, 'author')
+            self.client.cookies.pop('feed_seen')
+            cached = self.client.get(reverse('home'))
+        self.assertEqual((cached.content, cached['Content-Type']), (response.content, response['Content-Type']))
+        self.assertEqual(list(cached.cookies), [])
+        feed = self.client.get(reverse('map-feed'), {'bbox': '50,30,60,40'})
+        cached = self.client.get(reverse('map-feed'), {'bbox': '50,30,60,40'})
+        self.assertEqual((cached.content, cached['Content-Type']), (feed.content, 'application/json'))
+
+    def test_per_user(self):
+        own = self.client.get(reverse('home'))
+        self.client.force_login(self.friend)
+        response = self.client.get(reverse('home'), HTTP_IF_NONE_MATCH=own['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], own['ETag'])
+        self.assertContains(response, 'friend@example.com')
+        self.assertNotContains(response, 'author@example.com')
+        self.assertIn('Cookie', response['Vary'])
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHES=CACHES)
+class CursorPaginationTest(TestCase):
+    """Страницы по курсору идут без повторов и пропусков даже при одинаковой дате создания"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('author@example.com', 'password')
+        emoji = EmojisModel.objects.create(name='smile', emoji='blog/emoji/smile.png')
+        self.posts = [PostModel.objects.create(author=self.user, emoji=emoji, title='Пост %s' % number,
+                                               text='Текст', lon=55 + number / 10, lat=37.6)
+                      for number in range(9)]
+        # Половина постов создана в одну и ту же секунду
+        PostModel.objects.filter(pk__in=[post.pk for post in self.posts[2:7]]).update(
+            datetime_create='2023-05-01T10:00:00Z')
+        self.client.force_login(self.user)
+
+    def expected(self):
+        return list(PostModel.objects.order_by('-datetime_create', '-pk').values_list('pk', flat=True))
+
+    def test_cursor_round_trip(self):
+        post = PostModel.objects.get(pk=self.posts[3].pk)
+        self.assertEqual(pagination.decode_cursor(pagination.encode_cursor(post)), (post.datetime_create, post.pk))
+        for cursor in ('!!!', 'YWJj', pagination.encode_cursor(post)[:-3], 'MjAyMy0wNS0wMXx4'):
+            with self.assertRaises(ValueError):
+                pagination.decode_cursor(cursor)
+
+    def test_pages_without_duplicates_or_gaps(self):
+        seen, cursor = [], None
+        while True:
+            page = pagination.paginate(PostModel.objects.all(), cursor, 2)
+            seen.extend(post.pk for post in page)
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+        self.assertEqual(seen, self.expected())
+
+    def test_feed_json(self):
+        data = self.client.get(reverse('feed')).json()
+        self.assertEqual(set(data), {'posts', 'next'})
+        self.assertEqual(set(data['posts'][0]), {'center', 'url', 'icon'})
+        seen = [item['url'] for item in data['posts']]
+        while data['next']:
+            data = self.client.get(reverse('feed'), {'cursor': data['next']}).json()
+            seen.extend(item['url'] for item in data['posts'])
+        self.assertEqual(seen, [PostModel.objects.get(pk=pk).get_absolute_url() for pk in self.expected()])
+
+    def test_invalid_cursor(self):
+        with self.assertLogs('django.request', 'WARNING'):
+            response = self.client.get(reverse('feed'), {'cursor': 'не курсор'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', response.json())
+        response = self.client.get(reverse('home'), {'cursor': 'не курсор'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([post.pk for post in response.context['posts']], self.expected()[:ListPostView.paginate_by])
+
+
+@skipUnless(connection.vendor in ('sqlite', 'postgresql'), 'EXPLAIN проверяется для SQLite и PostgreSQL')
+class QueryPlanTest(TestCase):
+    """Основные запросы читают данные по индексам, а не полным просмотром таблиц"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('author@example.com', 'password')
+        cls.emoji = EmojisModel.objects.create(name='smile', emoji='blog/emoji/smile.png')
+        cls.tag = TagModel.objects.create(name='Горы')
+        for number in range(20):
+            post = PostModel.objects.create(author=cls.user, title='Пост %s' % number, text='Текст',
+                                            lon=55 + number / 10, lat=37 + number / 10, emoji=cls.emoji)
+            post.tag.add(cls.tag)
+        cls.post = post
+
+    def full_scans(self, queryset):
+        """Строки плана запроса, означающие полный просмотр таблицы."""
+        if connection.vendor == 'postgresql':
+            # На маленьких таблицах PostgreSQL и так выберет Seq Scan - запрещаем его,
+            # чтобы проверить, что подходящий индекс вообще есть.
+            with connection.cursor() as cursor:
+                cursor.execute('SET enable_seqscan = off')
+            return [line for line in queryset.explain().splitlines() if 'Seq Scan' in line]
+        return [line for line in queryset.explain().splitlines()
+                if re.search(r'\bSCAN (TABLE )?\w+\s*$', line)]
+
+    def assertNoFullScan(self, queryset):
+        scans = self.full_scans(queryset)
+        self.assertFalse(scans, '%s\n%s' % (queryset.query, '\n'.join(scans)))
+
+    def test_home_feed(self):
+        self.assertNoFullScan(pagination.after_cursor(PostModel.objects.all(), None)[:5])
+        cursor = pagination.encode_cursor(self.post)
+        self.assertNoFullScan(pagination.after_cursor(PostModel.objects.all(), cursor)[:5])
+
+    def test_tag_page(self):
+        self.assertNoFullScan(pagination.after_cursor(PostModel.objects.filter(tag=self.tag), None)[:5])
+
+    def test_author_posts(self):
+        self.assertNoFullScan(pagination.after_cursor(PostModel.objects.filter(author=self.user), None)[:5])
+
+    def test_map_bbox(self):
+        queryset = PostModel.objects.in_bbox(55, 37, 56, 38)
+        self.assertNoFullScan(queryset)
+        self.assertIn('geohash', queryset.explain())
+
+    def test_user_admin_ordering(self):
+        self.assertNoFullScan(User.objects.all()[:20])
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHES=CACHES)
+class PostCountersTest(TestCase):
+    """Счетчики постов тегов и emoji следуют за связями и совпадают с полным пересчетом"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('author@example.com', 'password')
+        self.smile, self.sun = [EmojisModel.objects.create(name=name, emoji='blog/emoji/%s.png' % name)
+                                for name in ('smile', 'sun')]
+        self.mountains, self.sea, self.city = [TagModel.objects.create(name=name) for name in ('Горы', 'Море', 'Город')]
+        self.posts = [PostModel.objects.create(author=self.user, emoji=self.smile, title='Пост %s' % number,
+                                               text='Текст', lon=55.75, lat=37.62) for number in range(3)]
+        self.client.force_login(self.user)
+
+    def counts(self):
+        tags = dict(TagModel.objects.values_list('name', 'post_count'))
+        emojis = dict(EmojisModel.objects.values_list('name', 'post_count'))
+        return tags, emojis
+
+    def assertCounts(self, tags, emojis):
+        self.assertEqual(self.counts(), (tags, emojis))
+        counters.recount()
+        self.assertEqual(self.counts(), (tags, emojis))
+
+    def test_tag_links(self):
+        first, second, third = self.posts
+        first.tag.add(self.mountains, self.sea)
+        second.tag.set([self.mountains])
+        self.sea.postmodel_set.add(second, third)
+        self.assertCounts({'Горы': 2, 'Море': 3, 'Город': 0}, {'smile': 3, 'sun': 0})
+        # Удаление несвязанного тега не меняет счетчики
+        first.tag.remove(self.sea, self.city)
+        third.tag.add(self.sea)
+        self.assertCounts({'Горы': 2, 'Море': 2, 'Город': 0}, {'smile': 3, 'sun': 0})
+        self.mountains.postmodel_set.remove(first)
+        second.tag.clear()
+        self.assertCounts({'Горы': 0, 'Море': 1, 'Город': 0}, {'smile': 3, 'sun': 0})
+        self.sea.postmodel_set.clear()
+        self.assertCounts({'Горы': 0, 'Море': 0, 'Город': 0}, {'smile': 3, 'sun': 0})
+
+    def test_post_delete_and_emoji_change(self):
+        first, second, _ = self.posts
+        first.tag.set([self.mountains, self.sea])
+        second.tag.set([self.sea])
+        second.emoji = self.sun
+        second.save()
+        self.assertCounts({'Горы': 1, 'Море': 2, 'Город': 0}, {'smile': 2, 'sun': 1})
+        first.save()
+        self.assertCounts({'Горы': 1, 'Море': 2, 'Город': 0}, {'smile': 2, 'sun': 1})
+        first.delete()
+        second.delete()
+        self.assertCounts({'Горы': 0, 'Море': 0, 'Город': 0}, {'smile': 1, 'sun': 0})
+
+    def test_cards_cached(self):
+        post = self.posts[0]
+        post.tag.add(self.mountains)
+        url = reverse('tag', kwargs={'url': self.mountains.slug})
+        self.assertContains(self.client.get(url), 'Пост 0')
+        # Изменение в обход save() не меняет версию поста - карточка берется из кэша
+        PostModel.objects.filter(pk=post.pk).update(title='Вершина')
+        self.assertContains(self.client.get(url), 'Пост 0')
+        post.refresh_from_db()
+        post.save()
+        self.assertContains(self.client.get(url), 'Вершина')
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHES=CACHES)
+class ReplicaRoutingTest(TransactionTestCase):
+    """Read-only представления читают из реплики - второго файла SQLite, снятого .backup с основной базы"""
+    databases = {'default', routers.REPLICA_DB_ALIAS}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # В тестах replica - зеркало default; здесь она смотрит в отдельный файл
+        cls.replica_dir = tempfile.mkdtemp()
+        replica = connections[routers.REPLICA_DB_ALIAS]
+        cls.mirror_name = replica.settings_dict['NAME']
+        replica.close()
+        replica.settings_dict['NAME'] = os.path.join(cls.replica_dir, 'replica.sqlite3')
+
+    @classmethod
+    def tearDownClass(cls):
+        replica = connections[routers.REPLICA_DB_ALIAS]
+        replica.close()
+        replica.settings_dict['NAME'] = cls.mirror_name
+        shutil.rmtree(cls.replica_dir, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('author@example.com', 'password')
+        self.emoji = EmojisModel.objects.create(name='smile', emoji='blog/emoji/smile.png')
+        self.replicated = self.create_post('В реплике')
+        self.backup()
+        self.primary_only = self.create_post('Только в основной базе')
+        self.client.force_login(self.user)
+
+    def tearDown(self):
+        # Индекс поиска FTS5 не очищается вместе с таблицами моделей - удаляем посты с сигналами
+        for post in PostModel.objects.all():
+            post.delete()
+
+    def create_post(self, title):
+        return PostModel.objects.create(author=self.user, emoji=self.emoji, title=title, text='Текст',
+                                        lon=55.75, lat=37.62)
+
+    def backup(self):
+        """Копирует основную базу в файл реплики, как sqlite3 db.sqlite3 ".backup db-replica.sqlite3"."""
+        replica = connections[routers.REPLICA_DB_ALIAS]
+        replica.close()
+        connection.ensure_connection()
+        with sqlite3.connect(replica.settings_dict['NAME']) as target:
+            connection.connection.backup(target)
+        target.close()
+
+    def test_views_read_replica(self):
+        replica = connections[routers.REPLICA_DB_ALIAS]
+        with CaptureQueriesContext(replica) as queries:
+            response = self.client.get(reverse('home'))
+        self.assertEqual([post.title for post in response.context['posts']], ['В реплике'])
+        self.assertTrue(any('blog_postmodel' in query['sql'] for query in queries.captured_queries))
+        with CaptureQueriesContext(replica) as queries:
+            self.assertEqual(self.client.get(self.replicated.get_absolute_url()).status_code, 200)
+            # Пост еще не доехал до реплики
+            with self.assertLogs('django.request', 'WARNING'):
+                self.assertEqual(self.client.get(self.primary_only.get_absolute_url()).status_code, 404)
+        self.assertTrue(queries.captured_queries)
+
+    def test_writes_go_to_default(self):
+        with routers.read_only():
+            TagModel.objects.create(name='Горы')
+        self.assertTrue(TagModel.objects.using(DEFAULT_DB_ALIAS).filter(name='Горы').exists())
+        self.assertFalse(TagModel.objects.using(routers.REPLICA_DB_ALIAS).filter(name='Горы').exists())
+        with routers.read_only():
+            self.replicated.title = 'Переименован'
+            self.replicated.save()
+        self.assertEqual(PostModel.objects.using(DEFAULT_DB_ALIAS).get(pk=self.replicated.pk).title, 'Переименован')
+        self.assertEqual(PostModel.objects.using(routers.REPLICA_DB_ALIAS).get(pk=self.replicated.pk).title,
+                         'В реплике')
+
+    def test_read_fallback(self):
+        router = routers.PrimaryReplicaRouter()
+        # Вне read_only() и для пользователей - основная база
+        self.assertEqual(router.db_for_read(PostModel), DEFAULT_DB_ALIAS)
+        self.assertEqual(PostModel.objects.count(), 2)
+        user = User.objects.create_user('new@example.com', 'password')
+        with routers.read_only():
+            self.assertEqual(router.db_for_read(PostModel), routers.REPLICA_DB_ALIAS)
+            self.assertEqual(PostModel.objects.count(), 1)
+            self.assertEqual(router.db_for_read(User), DEFAULT_DB_ALIAS)
+            self.assertEqual(User.objects.get(email='new@example.com'), user)
+            # Реплика-зеркало основной базы читается через основное соединение
+            mirror = dict(connections.settings[routers.REPLICA_DB_ALIAS], NAME=connection.settings_dict['NAME'])
+            with mock.patch.dict(connections[routers.REPLICA_DB_ALIAS].settings_dict, mirror):
+                self.assertEqual(router.db_for_read(PostModel), DEFAULT_DB_ALIAS)
+            with mock.patch.dict(settings.DATABASES):
+                del settings.DATABASES[routers.REPLICA_DB_ALIAS]
+                self.assertEqual(router.db_for_read(PostModel), DEFAULT_DB_ALIAS)
+
+
+class SqliteConnectionTest(SimpleTestCase):
+    """Новое соединение с файлом SQLite получает PRAGMA из SQLITE_PRAGMAS, atomic() начинается с BEGIN IMMEDIATE"""
+    alias = 'sqlite-file'
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        # Отдельное соединение с файлом: тестовая база в памяти не поддерживает WAL
+        connections[self.alias] = connections[DEFAULT_DB_ALIAS].__class__(
+            dict(connections[DEFAULT_DB_ALIAS].settings_dict, NAME=os.path.join(directory, 'db.sqlite3')), self.alias)
+        self.addCleanup(connections.__delitem__, self.alias)
+        self.addCleanup(connections[self.alias].close)
+
+    def pragma(self, name):
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute('PRAGMA %s' % name)
+            return cursor.fetchone()[0]
+
+    def test_pragmas(self):
+        self.assertIsNone(connections[self.alias].connection)
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+        self.assertEqual(self.pragma('busy_timeout'), settings.SQLITE_PRAGMAS['busy_timeout'])
+        # 1 - NORMAL
+        self.assertEqual(self.pragma('synchronous'), 1)
+        self.assertEqual(self.pragma('cache_size'), settings.SQLITE_PRAGMAS['cache_size'])
+
+    def test_atomic_begins_immediate(self):
+        connection = connections[self.alias]
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic(using=self.alias):
+                connection.cursor().execute('CREATE TABLE point (name TEXT)')
+        self.assertEqual(queries.captured_queries[0]['sql'], 'BEGIN IMMEDIATE')
+        self.assertTrue(connection.get_autocommit())
+
+
+@override_settings(BACKGROUND_TASKS_ASYNC=False, EMAIL_OUTBOX_BATCH_SIZE=2, EMAIL_OUTBOX_MAX_ATTEMPTS=2,
+                   EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class OutboxTest(TestCase):
+    """Письма ставятся в очередь и отправляются пачками через одно соединение"""
+
+    def setUp(self):
+        self.users = [User.objects.create_user('user%s@example.com' % number, 'password') for number in range(3)]
+
+    def test_email_user_sends_after_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.users[0].email_user('Тема', 'Текст')
+        self.assertEqual(len(django_mail.outbox), 0)
+        for callback in callbacks:
+            callback()
+        self.assertEqual([message.to for message in django_mail.outbox], [['user0@example.com']])
+        self.assertEqual(OutboxEmailModel.objects.get().status, OutboxEmailModel.STATUS_SENT)
+
+    def test_batches_share_connection(self):
+        for user in self.users:
+            user.email_user('Тема', 'Текст')
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.open') as open_connection:
+            self.assertEqual(mail.send_outbox(), 3)
+        # Три письма пачками по два - два соединения
+        self.assertEqual(open_connection.call_count, 2)
+        self.assertEqual(len(django_mail.outbox), 3)
+
+    def test_failed_send_is_retried_with_backoff(self):
+        email = self.users[0].email_user('Тема', 'Текст')
+        with mock.patch('django.core.mail.EmailMessage.send', side_effect=OSError('down')), \
+                self.assertLogs('blog.mail', 'WARNING'):
+            self.assertEqual(mail.send_outbox(), 0)
+            email.refresh_from_db()
+            self.assertEqual((email.status, email.attempts), (OutboxEmailModel.STATUS_PENDING, 1))
+            self.assertGreater(email.next_attempt, email.created + mail.retry_delay(1) / 2)
+            self.assertEqual(mail.send_outbox(), 0)
+            OutboxEmailModel.objects.update(next_attempt=email.created)
+            mail.send_outbox()
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutboxEmailModel.STATUS_FAILED, 2))
+        self.assertIn('down', email.last_error)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHES=CACHES)
+class TemplateTest(TestCase):
+    """Данные карты встраиваются через json_script, без DEBUG шаблоны берутся из кэша загрузчика"""
+
+    def load_settings(self, debug):
+        with mock.patch.dict(os.environ, DJANGO_DEBUG=debug):
+            return runpy.run_path(os.path.join(settings.BASE_DIR, 'my_travel', 'settings.py'))
+
+    def test_map_items_escaped(self):
+        user = User.objects.create_user('author@example.com', 'password')
+        emoji = EmojisModel.objects.create(name='smile', emoji='blog/emoji/smile.png')
+        title = 'Конец </script><script>alert("x")</script>'
+        PostModel.objects.create(author=user, emoji=emoji, title=title, text='Текст', lon=55.75, lat=37.62)
+        self.client.force_login(user)
+        content = self.client.get(reverse('home')).content.decode()
+        self.assertNotIn('</script><script>alert', content)
+        data = re.search(r'<script id="map-items" type="application/json">(.*?)</script>', content, re.S).group(1)
+        self.assertIn('\\u003C/script\\u003E', data)
+        self.assertEqual([item['icon'] for item in json.loads(data)], [title])
+
+    def test_cached_loader_without_debug(self):
+        production = self.load_settings('0')
+        self.assertFalse(production['DEBUG'])
+        self.assertNotIn('debug_toolbar', production['INSTALLED_APPS'])
+        loaders = production['TEMPLATES'][0]['OPTIONS']['loaders']
+        self.assertEqual(loaders, [('django.template.loaders.cached.Loader', production['TEMPLATE_LOADERS'])])
+        self.assertEqual(self.load_settings('1')['TEMPLATES'][0]['OPTIONS']['loaders'],
+                         production['TEMPLATE_LOADERS'])
+        with self.settings(DEBUG=False, TEMPLATES=production['TEMPLATES']):
+            engine = engines.all()[0].engine
+            self.assertEqual([type(loader).__module__ for loader in engine.template_loaders],
+                             ['django.template.loaders.cached'])
+            self.assertIs(engine.get_template('blog/index.html'), engine.get_template('blog/index.html'))
+
+
+@override_settings(CACHES=CACHES)
+class MetricsTest(TestCase):
+    """Middleware собирает показатели по имени маршрута"""
+
+    def setUp(self):
+        metrics.reset()
+        self.user = User.objects.create_user('staff@example.com', 'password')
+        self.user.staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+
+    def test_view_metrics_exported(self):
+        cache.clear()
+        self.client.get(reverse('home'))
+        self.client.get(reverse('home'))
+        text = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('blog_requests_total{view="home",status="2xx"} 2', text)
+        self.assertIn('blog_request_duration_seconds_count{view="home"} 2', text)
+        self.assertIn('blog_cache_requests_total{view="home",result="hit"} 1', text)
+        queries = re.search(r'blog_db_queries_total\{view="home"\} (\d+)', text)
+        self.assertGreater(int(queries.group(1)), 0)
+        render = re.search(r'blog_template_render_seconds_total\{view="home"\} ([\d.]+)', text)
+        self.assertGreater(float(render.group(1)), 0)
+
+    def test_metrics_hidden_from_other_users(self):
+        self.user.staff = False
+        self.user.save()
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(CACHES=CACHES)
+class SearchTest(TestCase):
+    """Запросы кириллицей и латиницей приводятся к тем же термам, что и посты"""
+
+    def setUp(self):
+        user = User.objects.create_user('author@example.com', 'password')
+        emoji = EmojisModel.objects.create(name='smile', emoji='blog/emoji/smile.png')
+        self.winter = PostModel.objects.create(author=user, emoji=emoji, title='Москва зимой', text='Снег',
+                                               lon=55.75, lat=37.62)
+        self.square = PostModel.objects.create(author=user, emoji=emoji, title='Красная площадь',
+                                               text='Прогулка по Moskva', lon=55.75, lat=37.62)
+
+    def test_stem(self):
+        self.assertEqual([search.stem(word) for word in ['горы', 'горах', 'красная', 'зимой', 'ёлки']],
+                         ['гор', 'гор', 'красн', 'зим', 'елк'])
+        self.assertEqual(search.cyrillic('krasnyy'), 'красный')
+        self.assertEqual(search.terms('Krasnaya ploshchad, Красная площадь'), ['krasn', 'ploshchad'] * 2)
+
+    def assertFound(self):
+        self.assertEqual(search.search('зимой'), [self.winter.pk])
+        self.assertEqual(search.search('zima'), [self.winter.pk])
+        self.assertEqual(search.search('krasnaya'), [self.square.pk])
+        self.assertEqual(search.search('krasnaya ploshchad'), [self.square.pk])
+        # Заголовок весит больше текста
+        self.assertEqual(search.search('moskva'), [self.winter.pk, self.square.pk])
+        self.assertEqual(search.search('Москва'), [self.winter.pk, self.square.pk])
+        self.assertEqual(search.search('zima krasnaya'), [])
+
+    def test_fts5(self):
+        if not search._fts5('default'):
+            self.skipTest('База без FTS5')
+        self.assertFound()
+
+    def test_search_terms(self):
+        with mock.patch.object(search, '_fts5', return_value=False):
+            search.rebuild()
+            self.assertFound()
+
+
+class BenchmarkDataTest(TestCase):
+    """Генератор данных бенчмарков заполняет и денормализованные данные"""
+
+    def test_seed(self):
+        created = data.seed(users=3, posts=20, tags=5, emojis=2, images=0)
+        self.assertEqual(created, {'users': 3, 'tags': 5, 'emojis': 2, 'posts': 20, 'images': 0})
+        self.assertTrue(self.client.login(username=data.user_email(0), password=data.PASSWORD))
+        post = PostModel.objects.first()
+        self.assertEqual(post.tag_list, sorted(post.tag.values_list('name', flat=True)))
+        self.assertEqual(sum(TagModel.objects.values_list('post_count', flat=True)),
+                         PostModel.tag.through.objects.count())
+        self.assertIn(post.pk, search.search(post.title, limit=100))
+        self.assertEqual(sum(cluster.count for cluster in clusters.in_bbox(0, -85, -180, 85, 180)), 20)
+
+
+GPX = """<?xml version="1.0"?>
+<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1">
+  <wpt lat="43.6" lon="39.7"><name>Сочи</name><desc>Море</desc><type>Море</type>
+    <link href="gpx/sea.jpg"/></wpt>
+  <trk><trkseg>
+    <trkpt lat="41.7" lon="44.8"><time>2023-05-01T09:00:00Z</time></trkpt>
+    <trkpt lat="41.9" lon="44.9"><time>2023-05-01T10:00:00Z</time></trkpt>
+  </trkseg></trk>
+</gpx>"""
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHES=CACHES, BACKGROUND_TASKS_ASYNC=False, IMPORT_CHUNK_SIZE=2,
+                   TIME_ZONE='UTC')
+class TripArchiveTest(TestCase):
+    """Импорт архива поездки создает посты со всеми связями, экспорт читается импортом обратно"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('traveller@example.com', 'password')
+        self.emoji = EmojisModel.objects.create(name='smile', emoji='blog/emoji/smile.png')
+        self.client.force_login(self.user)
+
+    def make_archive(self):
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as archive:
+            archive.writestr('trip/points.geojson', json.dumps({'type': 'FeatureCollection', 'features': [
+                {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [37.6, 55.7]},
+                 'properties': {'title': 'Москва', 'text': 'Красная площадь', 'tags': ['Города', 'Музеи'],
+                                'created': '2023-04-30T10:00:00+00:00', 'photos': ['photos/moscow.jpg']}},
+                {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [30.3, 59.9]},
+                 'properties': {'name': 'Петербург', 'tags': 'Города'}},
+            ]}))
+            archive.writestr('trip/photos/moscow.jpg', make_image().read())
+            archive.writestr('trip.gpx', GPX)
+            archive.writestr('gpx/sea.jpg', make_image(size=(60, 40)).read())
+            archive.writestr('exif.jpg', make_image(size=(50, 40), exif=make_exif((50.5, 86.1))).read())
+            archive.writestr('track.jpg', make_image(size=(40, 40), exif=make_exif(taken='2023:05:01 09:10:00')).read())
+            archive.writestr('unknown.jpg', make_image(size=(30, 40)).read())
+        buffer.seek(0)
+        return SimpleUploadedFile('trip.zip', buffer.getvalue(), content_type='application/zip')
+
+    def test_import(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('import-trip'), {'archive': self.make_archive()})
+        self.assertContains(response, 'Импортировано постов: 5, фото: 4')
+        posts = {post.title: post for post in PostModel.objects.with_related()}
+        self.assertEqual(set(posts), {'Москва', 'Петербург', 'Сочи', 'exif', 'track'})
+        moscow = posts['Москва']
+        self.assertEqual((moscow.lon, moscow.lat, moscow.tag_list), (55.7, 37.6, ['Города', 'Музеи']))
+        self.assertEqual(moscow.datetime_create.isoformat(), '2023-04-30T10:00:00+00:00')
+        self.assertEqual((posts['exif'].lon, posts['exif'].lat), (50.5, 86.1))
+        self.assertEqual((posts['track'].lon, posts['track'].lat), (41.7, 44.8))
+        self.assertEqual(posts['Сочи'].tag_list, ['Море'])
+        self.assertTrue(all(image.status == ImagePostModel.STATUS_READY for post in posts.values()
+                            for image in post.images))
+        self.assertTrue(moscow.cover)
+        self.assertEqual(dict(TagModel.objects.values_list('name', 'post_count')),
+                         {'Города': 2, 'Музеи': 1, 'Море': 1})
+        self.assertEqual(EmojisModel.objects.get().post_count, 5)
+        self.assertEqual(search.search('площадь'), [moscow.pk])
+        self.assertEqual(sum(cluster.count for cluster in clusters.in_bbox(0, -85, -180, 85, 180)), 5)
+
+    def test_export_round_trip(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            trips.import_archive(self.make_archive(), self.user)
+        # Пост без места экспортируется с geometry: null и возвращается импортом тоже без места
+        PostModel.objects.create(author=self.user, emoji=self.emoji, title='Без места', text='Еще не на карте')
+        response = self.client.get(reverse('export-trip'))
+        content = b''.join(response.streaming_content)
+        with zipfile.ZipFile(BytesIO(content)) as archive:
+            self.assertEqual(len([name for name in archive.namelist() if name.startswith('photos/')]), 4)
+            features = json.loads(archive.read(trips.EXPORT_GEOJSON))['features']
+        self.assertEqual([feature['geometry'] for feature in features if feature['properties']['title'] == 'Без места'],
+                         [None])
+        other = User.objects.create_user('friend@example.com', 'password')
+        with self.captureOnCommitCallbacks(execute=True):
+            result = trips.import_archive(BytesIO(content), other)
+        self.assertEqual((result['posts'], result['images'], result['skipped']), (6, 4, []))
+        fields = ('title', 'text', 'lon', 'lat', 'geohash', 'country')
+        self.assertEqual(sorted(PostModel.objects.filter(author=other).values_list(*fields), key=str),
+                         sorted(PostModel.objects.filter(author=self.user).values_list(*fields), key=str))
+        unplaced = PostModel.objects.get(author=other, title='Без места')
+        self.assertEqual((unplaced.lon, unplaced.lat, unplaced.geohash, unplaced.country), (None, None, '', None))
+        self.assertEqual(sum(cluster.count for cluster in clusters.in_bbox(0, -85, -180, 85, 180)), 10)
+
+    def test_unplaced_post_placed_from_photo(self):
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as archive:
+            archive.writestr('points.geojson', json.dumps({'type': 'FeatureCollection', 'features': [
+                {'type': 'Feature', 'geometry': None, 'properties': {'title': 'Алтай', 'photos': ['altai.jpg']}},
+                {'type': 'Feature', 'geometry': {'type': 'LineString', 'coordinates': [[86.1, 50.5], [86.2, 50.6]]},
+                 'properties': {'title': 'Маршрут'}},
+            ]}))
+            archive.writestr('altai.jpg', make_image(exif=make_exif((50.5, 86.1))).read())
+        buffer.seek(0)
+        with self.captureOnCommitCallbacks(execute=True):
+            result = trips.import_archive(buffer, self.user)
+        self.assertEqual((result['posts'], result['images']), (1, 1))
+        post = PostModel.objects.get()
+        self.assertEqual((post.title, post.lon, post.lat), ('Алтай', 50.5, 86.1))
+        self.assertTrue(post.geohash)
+
+    def test_bad_archive(self):
+        response = self.client.post(reverse('import-trip'), {'archive': SimpleUploadedFile('trip.zip', b'nope')})
+        self.assertContains(response, 'не является архивом')
+        self.assertFalse(PostModel.objects.exists())
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHES=CACHES, BACKGROUND_TASKS_ASYNC=False)
+class PhotoGeotagTest(TestCase):
+    """Пост без выбранной точки получает место съемки из геотега фото"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('author@example.com', 'password')
+        self.emoji = EmojisModel.objects.create(name='smile', emoji='blog/emoji/smile.png')
+        self.tag = TagModel.objects.create(name='Горы')
+        self.client.force_login(self.user)
+
+    def create_post(self, title, images, **coordinates):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('create-post'), {'title': title, 'text': 'Текст', 'tag': [self.tag.pk],
+                                                      'emoji': self.emoji.pk, 'images': images, **coordinates})
+        return PostModel.objects.get(title=title)
+
+    def test_post_placed_from_exif(self):
+        post = self.create_post('Алтай', [make_image(), make_image(exif=make_exif((50.5, 86.1)))])
+        self.assertEqual((post.lon, post.lat), (50.5, 86.1))
+        self.assertTrue(post.geohash)
+        self.assertEqual(sorted(post.imagepostmodel_set.values_list('lon', 'lat'), key=str),
+                         [(50.5, 86.1), (None, None)])
+        self.assertEqual(sum(cluster.count for cluster in clusters.in_bbox(0, -85, -180, 85, 180)), 1)
+
+    def test_chosen_point_kept(self):
+        post = self.create_post('Москва', [make_image(exif=make_exif((50.5, 86.1)))], lon='55.7', lat='37.6')
+        self.assertEqual((post.lon, post.lat), (55.7, 37.6))
+        self.assertEqual(post.imagepostmodel_set.get().lon, 50.5)
+
+    def test_post_without_location(self):
+        post = self.create_post('Где-то', [make_image()])
+        self.assertIsNone(post.lon)
+        self.assertFalse(clusters.in_bbox(0, -85, -180, 85, 180))
+        response = self.client.get(reverse('home'))
+        self.assertEqual(response.context['map_items'], [])
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHES=CACHES, BACKGROUND_TASKS_ASYNC=False)
+class PhotoGeotagRequestTest(TransactionTestCase):
+    """Без транзакции теста фото обрабатывается прямо во время запроса и место поста не затирается"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('author@example.com', 'password')
+        self.emoji = EmojisModel.objects.create(name='smile', emoji='blog/emoji/smile.png')
+        self.tag = TagModel.objects.create(name='Горы')
+        self.client.force_login(self.user)
+
+    def tearDown(self):
+        # Индекс поиска FTS5 не очищается вместе с таблицами моделей - удаляем посты с сигналами
+        for post in PostModel.objects.all():
+            post.delete()
+
+    def test_post_placed_from_exif(self):
+        response = self.client.post(reverse('create-post'), {
+            'title': 'Алтай', 'text': 'Текст', 'tag': [self.tag.pk], 'emoji': self.emoji.pk,
+            'images': [make_image(exif=make_exif((50.5, 86.1)))]})
+        post = PostModel.objects.get()
+        self.assertRedirects(response, post.get_absolute_url(), fetch_redirect_response=False)
+        self.assertEqual(post.imagepostmodel_set.values_list('lon', 'lat', 'status').get(),
+                         (50.5, 86.1, ImagePostModel.STATUS_READY))
+        self.assertEqual((post.lon, post.lat), (50.5, 86.1))
+        self.assertTrue(post.geohash)
+        self.assertEqual(post.tag_list, ['Горы'])
+        self.assertEqual(sum(cluster.count for cluster in clusters.in_bbox(0, -85, -180, 85, 180)), 1)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHES=CACHES, NEARBY_REFRESH_INTERVAL=3600)
+class NearbyTest(TestCase):
+    """Ближайшие посты и маршрут; индекс следует за изменениями постов"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('author@example.com', 'password')
+        self.friend = User.objects.create_user('friend@example.com', 'password')
+        self.emoji = EmojisModel.objects.create(name='smile', emoji='blog/emoji/smile.png')
+        self.moscow = self.create_post('Москва', 55.75, 37.62)
+        self.kazan = self.create_post('Казань', 55.79, 49.12)
+        self.spb = self.create_post('Петербург', 59.94, 30.31, author=self.friend)
+        self.client.force_login(self.user)
+
+    def create_post(self, title, latitude, longitude, author=None):
+        return PostModel.objects.create(author=author or self.user, emoji=self.emoji, title=title, text='Текст',
+                                        lon=latitude, lat=longitude)
+
+    def test_nearest(self):
+        found = nearby.nearest(55.7, 37.6, 3)
+        self.assertEqual([pk for pk, _ in found], [self.moscow.pk, self.spb.pk, self.kazan.pk])
+        self.assertAlmostEqual(found[1][1], 639, delta=5)
+        self.assertEqual([pk for pk, _ in nearby.nearest(55.7, 37.6, 5, author=self.user.pk)],
+                         [self.moscow.pk, self.kazan.pk])
+
+    def test_index_follows_changes(self):
+        nearby.nearest(0, 0)
+        self.kazan.lon, self.kazan.lat = 55.7, 37.6
+        self.kazan.save()
+        self.assertEqual([pk for pk, _ in nearby.nearest(55.7, 37.6, 2)], [self.kazan.pk, self.moscow.pk])
+        self.moscow.delete()
+        self.create_post('Без места', None, None)
+        self.assertEqual([pk for pk, _ in nearby.nearest(55.7, 37.6, 5)], [self.kazan.pk, self.spb.pk])
+
+    def test_api(self):
+        response = self.client.get(reverse('nearby'), {'point': '59.9,30.3', 'limit': 2})
+        self.assertEqual([post['icon'] for post in response.json()['posts']], ['Петербург', 'Москва'])
+        response = self.client.get(reverse('nearby'), {'point': '59.9,30.3', 'mine': '1'})
+        self.assertEqual([post['icon'] for post in response.json()['posts']], ['Москва', 'Казань'])
+        self.assertEqual(self.client.get(reverse('nearby'), {'point': '91,0'}).status_code, 400)
+
+    def test_detail_page(self):
+        response = self.client.get(self.moscow.get_absolute_url())
+        self.assertEqual([post.title for post in response.context['nearby']], ['Петербург', 'Казань'])
+        self.assertContains(response, 'км')
+
+    def test_route(self):
+        self.create_post('Владимир', 56.13, 40.41)
+        data = self.client.get(reverse('route')).json()
+        self.assertEqual([post['icon'] for post in data['properties']['posts']], ['Москва', 'Владимир', 'Казань'])
+        self.assertEqual(data['geometry']['coordinates'][0], [37.62, 55.75])
+        self.assertAlmostEqual(data['properties']['distance'], 178 + 545, delta=15)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHES=CACHES)
+class TripStatsTest(TestCase):
+    """Статистика поездок считается по всем постам и дополняется новыми без пересчета"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('author@example.com', 'password')
+        self.emoji = EmojisModel.objects.create(name='smile', emoji='blog/emoji/smile.png')
+        self.client.force_login(self.user)
+
+    def create_post(self, title, latitude, longitude, created):
+        post = PostModel.objects.create(author=self.user, emoji=self.emoji, title=title, text='Текст',
+                                        lon=latitude, lat=longitude)
+        PostModel.objects.filter(pk=post.pk).update(datetime_create=created)
+        return post
+
+    def test_stats(self):
+        self.create_post('Москва', 55.75, 37.62, '2023-04-30T10:00:00Z')
+        self.create_post('Где-то', None, None, '2023-05-01T10:00:00Z')
+        self.create_post('Казань', 55.79, 49.12, '2023-05-02T10:00:00Z')
+        self.create_post('Владимир', 56.13, 40.41, '2023-05-03T10:00:00Z')
+        result = stats.get(self.user.pk)
+        self.assertEqual((result['posts'], result['countries']), (4, 1))
+        self.assertAlmostEqual(result['distance'], 720 + 545, delta=15)
+        self.assertEqual(result['furthest']['title'], 'Казань')
+        self.assertEqual([(month.isoformat(), count) for month, count in result['months']],
+                         [('2023-04-01', 1), ('2023-05-01', 3)])
+
+    def test_incremental_update(self):
+        self.create_post('Москва', 55.75, 37.62, '2023-04-30T10:00:00Z')
+        stats.get(self.user.pk)
+        PostModel.objects.create(author=self.user, emoji=self.emoji, title='Петербург', text='Текст',
+                                 lon=59.94, lat=30.31)
+        with mock.patch.object(stats, 'compute', side_effect=AssertionError('пересчет')), \
+                self.assertNumQueries(1):
+            result = stats.get(self.user.pk)
+        self.assertEqual((result['posts'], result['furthest']['title']), (2, 'Петербург'))
+        self.assertAlmostEqual(result['distance'], 634, delta=10)
+        stats.invalidate(self.user.pk)
+        self.assertEqual(stats.get(self.user.pk), result)
+
+    def test_profile_page(self):
+        self.create_post('Москва', 55.75, 37.62, '2023-04-30T10:00:00Z')
+        response = self.client.get(reverse('profile', kwargs={'url': self.user.slug}))
+        self.assertContains(response, 'Апрель 2023')
+        self.assertEqual(response.context['stats']['posts'], 1)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHES=CACHES)
+class GeocoderTest(TestCase):
+    """Страна поста определяется офлайн по границам из COUNTRY_BOUNDARIES"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('author@example.com', 'password')
+        self.emoji = EmojisModel.objects.create(name='smile', emoji='blog/emoji/smile.png')
+        self.client.force_login(self.user)
+
+    def test_lookup(self):
+        index = geocoder.get_index()
+        places = {(55.75, 37.62): 'Россия', (53.02, 158.65): 'Россия', (66.5, -175.0): 'Россия',
+                  (54.71, 20.51): 'Россия', (39.93, 32.86): 'Турция', (41.72, 44.79): 'Грузия',
+                  (41.9, 12.5): 'Италия', (37.6, 14.2): 'Италия', (43.24, 76.9): 'Казахстан',
+                  (-16.6, 179.3): 'Фиджи', (-16.5, -179.99): 'Фиджи', (45.0, -30.0): None}
+        self.assertEqual({point: index.name_at(*point) for point in places}, places)
+
+    def test_points_near_borders(self):
+        """Города в 10-30 км по разные стороны границы; анклав Лесото - дыра в полигоне ЮАР."""
+        index = geocoder.get_index()
+        places = {(60.71, 28.75): 'Россия', (61.06, 28.19): 'Финляндия',
+                  (59.37, 28.61): 'Россия', (59.36, 27.41): 'Эстония',
+                  (52.21, 24.36): 'Беларусь', (52.03, 23.12): 'Польша',
+                  (51.77, 55.1): 'Россия', (51.23, 51.37): 'Казахстан',
+                  (48.58, 7.75): 'Франция', (48.57, 7.82): 'Германия',
+                  (32.3, -106.8): 'США', (31.2, -106.3): 'Мексика',
+                  (-29.3, 27.5): 'Лесото', (-29.1, 26.2): 'ЮАР'}
+        self.assertEqual({point: index.name_at(*point) for point in places}, places)
+
+    def test_every_country_has_interior(self):
+        """На сетке с шагом 0.25 градуса находится каждая страна: правило четности не теряет полигоны."""
+        index = geocoder.get_index()
+        latitudes, longitudes = np.meshgrid(np.arange(-89.9, 90, 0.25), np.arange(-179.9, 180, 0.25), indexing='ij')
+        countries = index.lookup(latitudes.ravel(), longitudes.ravel())
+        self.assertEqual({index.names[country] for country in np.unique(countries[countries != geocoder.NOWHERE])},
+                         set(index.names))
+        self.assertEqual(len(index.names), 177)
+
+    def test_boundary_rings_are_simple(self):
+        """Кольца замкнуты, без повторов вершин и самопересечений - иначе правило четности теряет куски стран."""
+        def side(origin, first, second):
+            return ((first[0] - origin[0]) * (second[1] - origin[1])
+                    - (first[1] - origin[1]) * (second[0] - origin[0]))
+
+        with open(settings.COUNTRY_BOUNDARIES, encoding='utf-8') as file:
+            features = json.load(file)['features']
+        for feature in features:
+            for polygon in feature['geometry']['coordinates']:
+                for ring in polygon:
+                    name = feature['properties']['NAME_RU']
+                    self.assertEqual(ring[0], ring[-1], name)
+                    self.assertEqual(len({tuple(point) for point in ring[:-1]}), len(ring) - 1, name)
+                    edges = list(zip(ring[:-1], ring[1:]))
+                    for first in range(len(edges)):
+                        # Соседние ребра (в том числе последнее с первым) сходятся в общей вершине
+                        for second in range(first + 2, len(edges) - (first == 0)):
+                            (a, b), (c, d) = edges[first], edges[second]
+                            crosses = side(c, d, a) * side(c, d, b) < 0 and side(a, b, c) * side(a, b, d) < 0
+                            self.assertFalse(crosses, '%s: %s-%s x %s-%s' % (name, a, b, c, d))
+
+    def test_post_country(self):
+        post = PostModel.objects.create(author=self.user, emoji=self.emoji, title='Рим', text='Текст',
+                                        lon=55.75, lat=37.62)
+        self.assertEqual(post.country.name, 'Россия')
+        post.lon, post.lat = 41.9, 12.5
+        post.save()
+        self.assertEqual(post.country.name, 'Италия')
+        response = self.client.get(post.country.get_absolute_url())
+        self.assertEqual([item.title for item in response.context['posts']], ['Рим'])
+        self.assertContains(self.client.get(post.get_absolute_url()), post.country.get_absolute_url())
+
+    def test_save_without_move_skips_lookup(self):
+        post = PostModel.objects.create(author=self.user, emoji=self.emoji, title='Рим', text='Текст',
+                                        lon=41.9, lat=12.5)
+        unplaced = PostModel.objects.create(author=self.user, emoji=self.emoji, title='Без места', text='Текст')
+        with mock.patch.object(geocoder, 'country_id', wraps=geocoder.country_id) as lookup:
+            post.title = 'Рим весной'
+            post.save()
+            post.save(update_fields=['title'])
+            post = PostModel.objects.get(pk=post.pk)
+            post.save()
+            lookup.assert_not_called()
+            post.lon, post.lat = 55.75, 37.62
+            post.save()
+            self.assertEqual(lookup.call_count, 1)
+            unplaced.place(41.9, 12.5)
+            self.assertEqual(lookup.call_count, 2)
+        self.assertEqual(dict(PostModel.objects.values_list('title', 'country__name')),
+                         {'Рим весной': 'Россия', 'Без места': 'Италия'})
+
+    def test_assign(self):
+        PostModel.objects.bulk_create([
+            PostModel(author=self.user, emoji=self.emoji, title=title, text='Текст', slug='post-%s' % number,
+                      lon=latitude, lat=longitude)
+            for number, (title, latitude, longitude) in enumerate([('Казань', 55.79, 49.12), ('Тбилиси', 41.72, 44.79),
+                                                                    ('Океан', 45.0, -30.0), ('Рим', 41.9, 12.5)])])
+        self.assertEqual(geocoder.assign(PostModel.objects.all(), batch_size=3), 3)
+        self.assertEqual(dict(PostModel.objects.values_list('title', 'country__name')),
+                         {'Казань': 'Россия', 'Тбилиси': 'Грузия', 'Океан': None, 'Рим': 'Италия'})
+        self.assertEqual(stats.get(self.user.pk)['countries'], 3)
+        updated = dict(PostModel.objects.values_list('pk', 'datetime_update'))
+        # Только чтение пачек и стран: страна уже верная, UPDATE не нужен
+        with self.assertNumQueries(5):
+            geocoder.assign(PostModel.objects.all(), batch_size=3)
+        self.assertEqual(dict(PostModel.objects.values_list('pk', 'datetime_update')), updated)
+        self.assertEqual(CountryModel.objects.count(), 3)
@@ -0,0 +1,388 @@
+"""Импорт и экспорт поездок архивом ZIP.
+
+Архив для импорта может содержать:
+
+- GeoJSON (.geojson, .json) - каждая точка (Point) становится постом,
+  объект без геометрии (geometry: null) - постом без места, которое потом
+  дадут геотеги его фото. Свойства: title (или name), text (или
+  description), tags (список или строка через запятую), emoji (slug),
+  created (ISO 8601) и photos - пути фото внутри архива относительно файла
+  GeoJSON;
+- GPX (.gpx) - каждая путевая точка (wpt) становится постом: name, desc,
+  time, type (тег) и link href (фото). Точки треков (trkpt) со временем
+  нужны, чтобы найти место фото без координат в EXIF;
+- фото (.jpg, .jpeg, .png, .webp). Фото, на которые не ссылается ни одна
+  точка, становятся отдельными постами с координатами из EXIF или из
+  ближайшей по времени точки трека; фото без координат пропускаются.
+
+Архив читается по одному файлу, фото копируются в хранилище потоком. Посты,
+связи с тегами и фото создаются через bulk_create пачками по
+IMPORT_CHUNK_SIZE, каждая пачка - в своей транзакции. bulk_create не
+отправляет сигналы, поэтому кластеры карты, поисковый индекс, счетчики и
+списки тегов обновляются для пачки явно. Фото уменьшаются в фоновом пуле
+(blog.tasks), обложки постов обновятся по мере обработки.
+
+export_archive() отдает архив того же формата (posts.geojson и фото)
+генератором байтов для StreamingHttpResponse: посты читаются пачками по pk,
+фото копируются в архив по частям, так что ни архив, ни все посты целиком
+в памяти не держатся.
+"""
+import json
+import posixpath
+import uuid
+import zipfile
+from bisect import bisect_left
+from collections import Counter
+from datetime import timedelta
+from tempfile import SpooledTemporaryFile
+from xml.etree import ElementTree
+
+from django.conf import settings
+from django.core.files import File
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.template import defaultfilters
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from unidecode import unidecode
+
+from . import clusters, counters, geo, geocoder, imaging, search, tasks
+from .models import PostModel, TagModel, EmojisModel, ImagePostModel
+
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+GEOJSON_EXTENSIONS = ('.geojson', '.json')
+GPX_EXTENSION = '.gpx'
+
+# Насколько далеко по времени может быть точка трека от момента съемки фото
+TRACK_TOLERANCE = timedelta(minutes=15)
+
+EXPORT_GEOJSON = 'posts.geojson'
+
+
+def _extension(name):
+    return posixpath.splitext(name)[1].lower()
+
+
+def _local_name(tag):
+    """Имя элемента XML без пространства имен."""
+    return tag.rsplit('}', 1)[-1]
+
+
+def _aware(value):
+    if value is not None and timezone.is_naive(value):
+        return timezone.make_aware(value)
+    return value
+
+
+def _entry(title, text, latitude, longitude, tags=(), emoji=None, created=None, photos=()):
+    """Описание будущего поста или None, если координаты некорректны. Пост без места - обе координаты None."""
+    if latitude is not None or longitude is not None:
+        try:
+            latitude, longitude = float(latitude), float(longitude)
+        except (TypeError, ValueError):
+            return None
+        if not (abs(latitude) <= 90 and abs(longitude) <= 180):
+            return None
+    if isinstance(tags, str):
+        tags = tags.split(',')
+    return {
+        'title': str(title or '').strip()[:150],
+        'text': str(text or '').strip(),
+        'latitude': latitude,
+        'longitude': longitude,
+        'tags': list(dict.fromkeys(str(tag).strip()[:50] for tag in tags if str(tag).strip())),
+        'emoji': emoji,
+        'created': _aware(created),
+        'photos': list(photos),
+    }
+
+
+def _geojson_entries(content, directory):
+    """Посты из точек GeoJSON."""
+    data = json.loads(content)
+    features = data.get('features', []) if data.get('type') == 'FeatureCollection' else [data]
+    for feature in features:
+        geometry = feature.get('geometry')
+        if geometry is None:
+            # Экспорт так сохраняет пост, который еще не поставлен на карту
+            longitude = latitude = None
+        elif geometry.get('type') == 'Point':
+            # GeoJSON хранит [долгота, широта]
+            longitude, latitude = (geometry.get('coordinates') or [None, None])[:2]
+            if longitude is None or latitude is None:
+                continue
+        else:
+            continue
+        properties = feature.get('properties') or {}
+        created = properties.get('created')
+        yield _entry(properties.get('title') or properties.get('name'),
+                     properties.get('text') or properties.get('description'),
+                     latitude, longitude, properties.get('tags') or (), properties.get('emoji'),
+                     parse_datetime(created) if isinstance(created, str) else None,
+                     [posixpath.normpath(posixpath.join(directory, photo))
+                      for photo in properties.get('photos') or ()])
+
+
+def _gpx_entries(file, directory, track):
+    """Посты из путевых точек GPX; точки треков со временем добавляются в track."""
+    for _, element in ElementTree.iterparse(file):
+        name = _local_name(element.tag)
+        if name not in ('wpt', 'trkpt'):
+            continue
+        children = {_local_name(child.tag): child for child in element}
+        time = children.get('time')
+        created = parse_datetime(time.text.strip()) if time is not None and time.text else None
+        if name == 'trkpt':
+            if created is not None:
+                try:
+                    track.append((_aware(created), float(element.get('lat')), float(element.get('lon'))))
+                except (TypeError, ValueError):
+                    pass
+        else:
+            text = {key: (children[key].text or '') if key in children else '' for key in ('name', 'desc', 'type')}
+            photos = [posixpath.normpath(posixpath.join(directory, child.get('href')))
+                      for child in element if _local_name(child.tag) == 'link' and child.get('href')]
+            yield _entry(text['name'], text['desc'], element.get('lat'), element.get('lon'),
+                         [text['type']] if text['type'] else (), created=created, photos=photos)
+        element.clear()
+
+
+def _track_location(track, moment):
+    """Ближайшая по времени точка трека (широта, долгота), если она не дальше TRACK_TOLERANCE."""
+    if not track or moment is None:
+        return None
+    index = bisect_left(track, (moment,))
+    nearest = min(track[max(index - 1, 0):index + 1], key=lambda point: abs(point[0] - moment))
+    if abs(nearest[0] - moment) > TRACK_TOLERANCE:
+        return None
+    return nearest[1], nearest[2]
+
+
+def _read_entries(archive, members):
+    """Все посты архива и имена фото, для которых не нашлось координат."""
+    entries, track = [], []
+    for info in members:
+        directory = posixpath.dirname(info.filename)
+        extension = _extension(info.filename)
+        try:
+            if extension in GEOJSON_EXTENSIONS:
+                entries.extend(_geojson_entries(archive.read(info), directory))
+            elif extension == GPX_EXTENSION:
+                with archive.open(info) as file:
+                    entries.extend(_gpx_entries(file, directory, track))
+        except (ValueError, AttributeError, ElementTree.ParseError) as error:
+            raise ValueError('Не удалось прочитать %s: %s' % (info.filename, error))
+    entries = [entry for entry in entries if entry is not None]
+    track.sort(key=lambda point: point[0])
+
+    referenced = {photo for entry in entries for photo in entry['photos']}
+    skipped = []
+    for info in members:
+        if _extension(info.filename) not in PHOTO_EXTENSIONS or info.filename in referenced:
+            continue
+        with archive.open(info) as file:
+            try:
+                location, taken = imaging.read_exif(file)
+            except OSError:
+                location, taken = None, None
+        taken = _aware(taken)
+        location = location or _track_location(track, taken)
+        if location is None:
+            skipped.append(info.filename)
+            continue
+        title = posixpath.splitext(posixpath.basename(info.filename))[0]
+        entries.append(_entry(title, '', *location, created=taken, photos=[info.filename]))
+    return entries, skipped
+
+
+def _unique_slugs(titles):
+    """slug для каждого заголовка; занятые и повторяющиеся получают случайный суффикс."""
+    slugs = [defaultfilters.slugify(unidecode(title))[:41] or 'post' for title in titles]
+    taken = set(PostModel.objects.filter(slug__in=slugs).values_list('slug', flat=True))
+    result = []
+    for slug in slugs:
+        if slug in taken:
+            slug = '%s-%s' % (slug, uuid.uuid4().hex[:8])
+        taken.add(slug)
+        result.append(slug)
+    return result
+
+
+def _tags(names):
+    """Теги по имени; недостающие создаются."""
+    names = set(names)
+    if not names:
+        return {}
+    existing = TagModel.objects.filter(name__in=names)
+    tags = {tag.name: tag for tag in existing}
+    missing = {name: defaultfilters.slugify(unidecode(name)) or 'tag-%s' % uuid.uuid4().hex[:8]
+               for name in names - set(tags)}
+    TagModel.objects.bulk_create([TagModel(name=name, slug=slug) for name, slug in missing.items()],
+                                 ignore_conflicts=True)
+    tags.update((tag.name, tag) for tag in TagModel.objects.filter(name__in=missing))
+    # Имя, чей slug уже занят другим тегом (например, "Горы" и "горы"), привязываем к этому тегу
+    by_slug = {tag.slug: tag for tag in TagModel.objects.filter(slug__in=missing.values())}
+    for name, slug in missing.items():
+        if name not in tags and slug in by_slug:
+            tags[name] = by_slug[slug]
+    return tags
+
+
+def _save_photo(archive, info):
+    """Копирует фото из архива в хранилище потоком и возвращает имя файла."""
+    field = ImagePostModel._meta.get_field('image')
+    with archive.open(info) as member:
+        content = File(member, name=posixpath.basename(info.filename))
+        content.size = info.file_size
+        return field.storage.save(field.generate_filename(None, content.name), content)
+
+
+def _import_chunk(archive, photos, entries, user, emojis, default_emoji):
+    """Создает посты пачки со всеми связями. Возвращает (посты, pk новых фото)."""
+    titles = [entry['title'] or 'Точка %s' % number for number, entry in enumerate(entries, 1)]
+    placed = [entry for entry in entries if entry['latitude'] is not None]
+    countries = iter(geocoder.country_ids([entry['latitude'] for entry in placed],
+                                          [entry['longitude'] for entry in placed]))
+    posts = []
+    for entry, title, slug in zip(entries, titles, _unique_slugs(titles)):
+        emoji = emojis.get(entry['emoji'], default_emoji)
+        point = (entry['latitude'], entry['longitude'])
+        # lon хранит широту, lat - долготу (см. blog.geo)
+        posts.append(PostModel(author=user, emoji=emoji, title=title, text=entry['text'], slug=slug,
+                               lon=point[0], lat=point[1], geohash='' if None in point else geo.encode(*point),
+                               country_id=None if None in point else next(countries)))
+    PostModel.objects.bulk_create(posts)
+    by_slug = PostModel.objects.in_bulk([post.slug for post in posts], field_name='slug')
+    posts = [by_slug[post.slug] for post in posts]
+
+    dated = []
+    for post, entry in zip(posts, entries):
+        if entry['created'] is not None:
+            post.datetime_create = entry['created']
+            dated.append(post)
+    PostModel.objects.bulk_update(dated, ['datetime_create'])
+
+    tags = _tags(name for entry in entries for name in entry['tags'])
+    links = {(post.pk, tags[name].pk) for post, entry in zip(posts, entries) for name in entry['tags']}
+    PostModel.tag.through.objects.bulk_create([PostModel.tag.through(postmodel_id=post_id, tagmodel_id=tag_id)
+                                               for post_id, tag_id in links])
+
+    images = [ImagePostModel(post=post, image=_save_photo(archive, photos[name]))
+              for post, entry in zip(posts, entries) for name in entry['photos'] if name in photos]
+    ImagePostModel.objects.bulk_create(images)
+
+    # То, что при обычном сохранении делают сигналы
+    post_ids = [post.pk for post in posts]
+    PostModel.objects.filter(pk__in=post_ids).refresh_summary()
+    search.update(PostModel.objects.filter(pk__in=post_ids).only('title', 'text', 'tag_list'))
+    clusters.add_points((post.lon, post.lat) for post in posts if post.lon is not None)
+    counters.change_tags(Counter(tag_id for _, tag_id in links))
+    counters.change_emojis(Counter(post.emoji_id for post in posts))
+    image_ids = ImagePostModel.objects.filter(post_id__in=post_ids,
+                                              status=ImagePostModel.STATUS_PENDING).values_list('pk', flat=True)
+    return posts, list(image_ids)
+
+
+def import_archive(file, user, emoji=None):
+    """Создает посты пользователя из архива поездки.
+
+    emoji - emoji постов, для которых оно не указано (по умолчанию первое).
+    Возвращает {'posts': .., 'images': .., 'skipped': [фото без координат]}.
+    Некорректный архив - ValueError.
+    """
+    emojis = {item.slug: item for item in EmojisModel.objects.all()}
+    default_emoji = emoji or EmojisModel.objects.order_by('pk').first()
+    if default_emoji is None:
+        raise ValueError('Нет ни одного emoji для постов')
+    try:
+        archive = zipfile.ZipFile(file)
+    except zipfile.BadZipFile:
+        raise ValueError('Файл не является архивом ZIP')
+    with archive:
+        members = [info for info in archive.infolist() if not info.is_dir()]
+        if sum(info.file_size for info in members) > settings.IMPORT_MAX_SIZE:
+            raise ValueError('Архив больше %s МБ' % (settings.IMPORT_MAX_SIZE // 2 ** 20))
+        photos = {info.filename: info for info in members if _extension(info.filename) in PHOTO_EXTENSIONS}
+        entries, skipped = _read_entries(archive, members)
+        post_count = image_count = 0
+        for start in range(0, len(entries), settings.IMPORT_CHUNK_SIZE):
+            with transaction.atomic():
+                posts, image_ids = _import_chunk(archive, photos, entries[start:start + settings.IMPORT_CHUNK_SIZE],
+                                                 user, emojis, default_emoji)
+                for image_id in image_ids:
+                    tasks.run_in_background(tasks.process_image, image_id)
+            post_count += len(posts)
+            image_count += len(image_ids)
+    return {'posts': post_count, 'images': image_count, 'skipped': skipped}
+
+
+class _Stream:
+    """Файл только для записи: zipfile пишет в него, генератор забирает накопленные байты"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _user_posts(user, chunk_size):
+    """Посты пользователя с фото, пачками по pk."""
+    last_pk = 0
+    while True:
+        posts = list(PostModel.objects.filter(author=user, pk__gt=last_pk).order_by('pk')
+                     .select_related('emoji').prefetch_related('imagepostmodel_set')[:chunk_size])
+        if not posts:
+            return
+        yield from posts
+        last_pk = posts[-1].pk
+
+
+def export_archive(user, chunk_size=100):
+    """Архив поездок пользователя в формате импорта, отдаваемый по частям (bytes)."""
+    stream = _Stream()
+    # Точки GeoJSON копятся во временном файле: в памяти до 1 МБ, дальше на диске
+    features = SpooledTemporaryFile(max_size=2 ** 20)
+    separator = b''
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for post in _user_posts(user, chunk_size):
+            photos = []
+            for image in sorted(post.imagepostmodel_set.all(), key=lambda item: item.pk):
+                try:
+                    source = image.image.open('rb')
+                except FileNotFoundError:
+                    continue
+                name = 'photos/%s/%s%s' % (post.slug, len(photos) + 1, _extension(image.image.name))
+                # Фото уже сжаты - храним без сжатия
+                with source, archive.open(zipfile.ZipInfo(name, post.datetime_create.timetuple()[:6]), 'w') as target:
+                    for chunk in source.chunks():
+                        target.write(chunk)
+                        yield stream.take()
+                photos.append(name)
+            feature = {
+                'type': 'Feature',
+                # GeoJSON ожидает [долгота, широта]; у поста, еще не получившего место из фото, геометрии нет
+                'geometry': None if post.lon is None else {'type': 'Point', 'coordinates': [post.lat, post.lon]},
+                'properties': {'title': post.title, 'text': post.text, 'tags': post.tag_list,
+                               'emoji': post.emoji.slug, 'created': post.datetime_create, 'photos': photos},
+            }
+            features.write(separator + json.dumps(feature, cls=DjangoJSONEncoder, ensure_ascii=False).encode())
+            separator = b',\n'
+        features.seek(0)
+        with archive.open(EXPORT_GEOJSON, 'w') as target:
+            target.write(b'{"type": "FeatureCollection", "features": [\n')
+            for chunk in iter(lambda: features.read(64 * 1024), b''):
+                target.write(chunk)
+                yield stream.take()
+            target.write(b'\n]}\n')
+        features.close()
+    yield stream.take()
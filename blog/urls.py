@@ -1,6 +1,5 @@
 from django.urls import path
 from .views import *
-from django.views.decorators.cache import cache_page
 
 urlpatterns = [
     path('', ListPostView.as_view(), name='home'),
@@ -13,4 +12,15 @@ urlpatterns = [
     path('profile/<slug:url>/', profile_view, name='profile'),
     path('create-post/', CreateNewPostView.as_view(), name='create-post'),
     path('post/<slug:url>/', PostDetailView.as_view(), name='post'),
+    path('feed/', PostFeedView.as_view(), name='feed'),
+    path('map/feed/', MapFeedView.as_view(), name='map-feed'),
+    path('nearby/', NearbyView.as_view(), name='nearby'),
+    path('route/', RouteView.as_view(), name='route'),
+    path('search/', SearchView.as_view(), name='search'),
+    path('tag/<slug:url>/', TagPostView.as_view(), name='tag'),
+    path('emoji/<slug:url>/', EmojiPostView.as_view(), name='emoji'),
+    path('country/<int:url>/', CountryPostView.as_view(), name='country'),
+    path('metrics/', metrics_view, name='metrics'),
+    path('import/', ImportTripView.as_view(), name='import-trip'),
+    path('export/', export_trip_view, name='export-trip'),
 ]
@@ -1,28 +1,109 @@
+import hashlib
+
+from django.conf import settings
 from django.contrib.auth.views import LoginView, PasswordResetView
-from django.shortcuts import render, redirect
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, render, redirect
 from django.contrib.auth import get_user_model
 from django.contrib.auth.forms import AuthenticationForm
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
+from django.template import defaultfilters
 from django.urls import reverse_lazy
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
 
-from .forms import RegisterForm, ChangePasswordForm, UserChangeForm, CreatePostForm, LoginUserForm
+from .forms import RegisterForm, ChangePasswordForm, UserChangeForm, CreatePostForm, LoginUserForm, ImportTripForm
 from django.contrib.sites.shortcuts import get_current_site
 from django.template.loader import render_to_string
 from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
 from django.utils.encoding import force_bytes, force_text
 from .token import activation_token
+from . import cache, clusters, geo, metrics, nearby, pagination, routers, search, stats, trips
+from .templatetags.imagetags import picture
 from django.contrib.auth.forms import PasswordResetForm
-from .models import PostModel, TagModel, ImagePostModel
-from django.views.generic import ListView, DetailView
+from .models import PostModel, TagModel, EmojisModel, ImagePostModel, CountryModel
+from django.views.generic import ListView, DetailView, View
 from django.views.generic.edit import CreateView, FormView
 from django.contrib.auth.mixins import LoginRequiredMixin
 
 User = get_user_model()
 
 
-class ListPostView(LoginRequiredMixin, ListView):
-    """Домашняя страница с отображением списка 4 последних постов"""
+class ReplicaReadMixin:
+    """Представление только читает данные - запросы идут в реплику, если она настроена (см. blog.routers).
+
+    Ответ рендерится внутри того же блока, чтобы запросы шаблона тоже ушли в реплику.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        with routers.read_only():
+            response = super().dispatch(request, *args, **kwargs)
+            if hasattr(response, 'render'):
+                response.render()
+        return response
+
+
+class CachedFeedMixin:
+    """Кэш ответа ленты на пользователя и условный GET.
+
+    ETag и Last-Modified строятся из версии ленты (одним агрегатом по постам,
+    см. cache.feed_version), пользователя и адреса запроса. Если у клиента
+    актуальная версия, он получает 304 без рендера; иначе ответ берется
+    из кэша по тому же ETag или рендерится и кэшируется.
+    """
+    feed_cache_timeout = 60 * 15
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD') or not request.user.is_authenticated:
+            return super().dispatch(request, *args, **kwargs)
+        user = request.user
+        last, count = cache.feed_version()
+        last_modified = max(filter(None, [last, user.update_date]))
+        etag = quote_etag(hashlib.md5(('%s:%s:%s:%s:%s' % (
+            user.pk, user.update_date.timestamp(), last_modified.timestamp(), count, request.get_full_path(),
+        )).encode()).hexdigest())
+        response = get_conditional_response(request, etag=etag,
+                                            last_modified=int(last_modified.timestamp()))
+        if response is None:
+            response = cache.get_response(etag)
+        if response is None:
+            response = super().dispatch(request, *args, **kwargs)
+            if hasattr(response, 'render'):
+                response.render()
+            if response.status_code == 200:
+                cache.set_response(etag, response, self.feed_cache_timeout)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ['Cookie'])
+        return response
+
+
+class CursorPaginationMixin:
+    """Постраничный вывод ListView по курсору (?cursor=...), см. blog.pagination.
+
+    С некорректным курсором показывается первая страница.
+    """
+
+    def paginate_queryset(self, queryset, page_size):
+        try:
+            page = pagination.paginate(queryset, self.request.GET.get('cursor'), page_size)
+        except ValueError:
+            page = pagination.paginate(queryset, None, page_size)
+        return None, page, page.object_list, page.has_next()
+
+    def get_context_data(self, *, object_list=None, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['next_cursor'] = context['page_obj'].next_cursor
+        return context
+
+
+class ListPostView(ReplicaReadMixin, LoginRequiredMixin, CachedFeedMixin, CursorPaginationMixin, ListView):
+    """Домашняя страница с отображением списка 4 последних постов.
+
+    Следующие страницы выбираются по курсору (?cursor=...), см. blog.pagination.
+    """
     model = PostModel
     paginate_by = 4
     template_name = 'blog/index.html'
@@ -32,28 +113,221 @@ class ListPostView(LoginRequiredMixin, ListView):
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super().get_context_data(**kwargs)
         context['title'] = 'Домашняя'
-        for post in context['posts']:
-            context['image'] = ImagePostModel.objects.filter(post_id=post.id).first()
+        context['post_zoom'] = clusters.CLUSTER_MAX_ZOOM + 1
+        # Пункты меню карты выводятся одним JSON через json_script, а не циклом в шаблоне
+        context['map_items'] = [PostFeedView.get_item(post) for post in context['posts'] if post.lon is not None]
+        return context
+
+    def get_queryset(self):
+        return PostModel.objects.all()
+
+
+class PostFeedView(ReplicaReadMixin, LoginRequiredMixin, CachedFeedMixin, View):
+    """JSON-вариант ленты для бесконечной прокрутки: страница постов и курсор следующей"""
+    login_url = reverse_lazy('sign_in')
+
+    def get(self, request, *args, **kwargs):
+        try:
+            page = pagination.paginate(PostModel.objects.all(), request.GET.get('cursor'), ListPostView.paginate_by)
+        except ValueError as error:
+            return JsonResponse({'error': str(error)}, status=400)
+        return JsonResponse({'posts': [self.get_item(post) for post in page if post.lon is not None],
+                             'next': page.next_cursor})
+
+    @staticmethod
+    def get_item(post):
+        return {
+            'center': [post.lon, post.lat],
+            'url': post.get_absolute_url(),
+            'icon': post.title,
+        }
+
+
+class MapFeedView(ReplicaReadMixin, LoginRequiredMixin, CachedFeedMixin, View):
+    """GeoJSON с постами внутри видимой области карты.
+
+    Область передается параметром bbox=south,west,north,east, текущий зум карты -
+    параметром zoom. До clusters.CLUSTER_MAX_ZOOM включительно вместо постов
+    отдаются готовые кластеры с количеством постов.
+    """
+    limit = 500
+    login_url = reverse_lazy('sign_in')
+
+    def get(self, request, *args, **kwargs):
+        try:
+            bbox = geo.parse_bbox(request.GET.get('bbox'))
+            zoom = int(request.GET.get('zoom', clusters.CLUSTER_MAX_ZOOM + 1))
+        except ValueError as error:
+            return JsonResponse({'error': str(error)}, status=400)
+        if zoom <= clusters.CLUSTER_MAX_ZOOM:
+            features = [self.get_cluster_feature(cluster) for cluster in clusters.in_bbox(zoom, *bbox)]
+        else:
+            posts = PostModel.objects.in_bbox(*bbox)[:self.limit]
+            features = cache.get_or_render_many('map', list(posts), self.get_feature)
+        return JsonResponse({'type': 'FeatureCollection',
+                             'features': features})
+
+    @staticmethod
+    def get_cluster_feature(cluster):
+        latitude, longitude = cluster.center
+        return {
+            'type': 'Feature',
+            'id': str(cluster),
+            'geometry': {'type': 'Point', 'coordinates': [round(longitude, 6), round(latitude, 6)]},
+            'properties': {'cluster': True, 'count': cluster.count},
+        }
+
+    @staticmethod
+    def get_feature(post):
+        return {
+            'type': 'Feature',
+            'id': post.pk,
+            # GeoJSON ожидает [долгота, широта]
+            'geometry': {'type': 'Point', 'coordinates': [post.lat, post.lon]},
+            'properties': {
+                'title': post.title,
+                'url': post.get_absolute_url(),
+                'tags': post.tag_list,
+                'image': picture(post.cover, post.cover_variants, 'balloon', sizes='150px', css_class='w-50') or None,
+                'text': defaultfilters.truncatechars(post.text, 30),
+            },
+        }
+
+
+class PostFilterView(ReplicaReadMixin, LoginRequiredMixin, CursorPaginationMixin, ListView):
+    """Посты с общим тегом, emoji или страной, от новых к старым"""
+    template_name = 'blog/post_list.html'
+    context_object_name = 'posts'
+    login_url = reverse_lazy('sign_in')
+    paginate_by = 12
+    filter_model = None
+    filter_field = None
+    filter_lookup = 'slug'
+    title = None
+
+    def get_queryset(self):
+        self.filter_object = get_object_or_404(self.filter_model, **{self.filter_lookup: self.kwargs['url']})
+        return PostModel.objects.filter(**{self.filter_field: self.filter_object})
+
+    def get_context_data(self, *, object_list=None, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['filter_object'] = self.filter_object
+        context['title'] = '%s - %s' % (self.title, self.filter_object.name)
         return context
 
+
+class TagPostView(PostFilterView):
+    filter_model = TagModel
+    filter_field = 'tag'
+    title = 'Тег'
+
+
+class EmojiPostView(PostFilterView):
+    filter_model = EmojisModel
+    filter_field = 'emoji'
+    title = 'Emoji'
+
+
+class CountryPostView(PostFilterView):
+    filter_model = CountryModel
+    filter_field = 'country'
+    filter_lookup = 'pk'
+    title = 'Страна'
+
+
+class SearchView(ReplicaReadMixin, LoginRequiredMixin, ListView):
+    """Поиск постов по заголовку, тексту и тегам, от более релевантных к менее (см. blog.search)"""
+    template_name = 'blog/search.html'
+    context_object_name = 'posts'
+    login_url = reverse_lazy('sign_in')
+    limit = 50
+
     def get_queryset(self):
-        return PostModel.objects.order_by('-datetime_create').prefetch_related('tag')
+        post_ids = search.search(self.request.GET.get('q', ''), self.limit)
+        posts = PostModel.objects.in_bulk(post_ids)
+        return [posts[pk] for pk in post_ids if pk in posts]
+
+    def get_context_data(self, *, object_list=None, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['query'] = self.request.GET.get('q', '')
+        context['title'] = 'Поиск - ' + context['query'] if context['query'] else 'Поиск'
+        return context
 
 
-class PostDetailView(DetailView):
+class PostDetailView(ReplicaReadMixin, DetailView):
     """Представление страницы с детальным описание поста"""
     model = PostModel
     template_name = 'blog/post_detail.html'
     context_object_name = 'post'
     slug_url_kwarg = 'url'
+    queryset = PostModel.objects.with_related()
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['title'] = 'Детально о посте - ' + str(context['post'])
-        context['images'] = ImagePostModel.objects.filter(post_id=context['post'].id)
+        context['images'] = context['post'].images
         context['col_images'] = len(context['images'])
+        context['nearby'] = self.get_nearby(context['post'])
         return context
 
+    @staticmethod
+    def get_nearby(post):
+        """Ближайшие к посту посты с атрибутом distance в км."""
+        if post.lon is None or post.lat is None:
+            return []
+        # lon хранит широту, lat - долготу (см. blog.geo)
+        return nearby_posts(nearby.nearest(post.lon, post.lat, settings.NEARBY_DETAIL_LIMIT, exclude=[post.pk]))
+
+
+def nearby_posts(found):
+    """Посты по списку (pk, расстояние) из blog.nearby в том же порядке."""
+    posts = PostModel.objects.in_bulk([pk for pk, _ in found])
+    result = []
+    for pk, distance in found:
+        if pk in posts:
+            posts[pk].distance = distance
+            result.append(posts[pk])
+    return result
+
+
+class NearbyView(ReplicaReadMixin, LoginRequiredMixin, View):
+    """JSON с ближайшими к точке постами, от ближнего к дальнему.
+
+    Точка передается параметром point=latitude,longitude, число постов - limit
+    (не больше NEARBY_MAX_LIMIT). С mine=1 ищутся только посты пользователя.
+    """
+    login_url = reverse_lazy('sign_in')
+
+    def get(self, request, *args, **kwargs):
+        try:
+            latitude, longitude = geo.parse_point(request.GET.get('point'))
+            limit = int(request.GET.get('limit', 10))
+        except ValueError as error:
+            return JsonResponse({'error': str(error)}, status=400)
+        author = request.user.pk if request.GET.get('mine') == '1' else None
+        found = nearby.nearest(latitude, longitude, max(1, min(limit, settings.NEARBY_MAX_LIMIT)), author)
+        return JsonResponse({'posts': [dict(PostFeedView.get_item(post), distance=round(post.distance, 3))
+                                       for post in nearby_posts(found)]})
+
+
+class RouteView(ReplicaReadMixin, LoginRequiredMixin, View):
+    """Маршрут по постам пользователя: от самого раннего к ближайшему еще не посещенному.
+
+    Отдается GeoJSON Feature с линией маршрута; в properties - посты по порядку
+    и длина маршрута в км.
+    """
+    login_url = reverse_lazy('sign_in')
+
+    def get(self, request, *args, **kwargs):
+        posts = PostModel.objects.filter(author=request.user, lon__isnull=False).order_by('datetime_create', 'pk')
+        posts, distance = nearby.route(posts)
+        return JsonResponse({
+            'type': 'Feature',
+            # GeoJSON ожидает [долгота, широта]
+            'geometry': {'type': 'LineString', 'coordinates': [[post.lat, post.lon] for post in posts]},
+            'properties': {'distance': round(distance, 3), 'posts': [PostFeedView.get_item(post) for post in posts]},
+        })
+
 
 class UserLoginView(LoginView):
     """Представление страницы с логированием"""
@@ -182,18 +456,28 @@ def activate(request, uid64, token):
 
 def profile_view(request, url):
     """Страница изменения профиля"""
+    trip_stats = stats.get(request.user.pk)
     if request.method == 'POST':
         form = UserChangeForm(request.POST, request.FILES, instance=request.user)
         if form.is_valid():
             form.save()
             return redirect(to='home')
     else:
+        # Если страна не выбрана, предлагаем страну первого поста (см. blog.stats)
         form = UserChangeForm(initial={'email': request.user.email,
                                        'sex': request.user.sex,
-                                       'country': request.user.country,
+                                       'country': request.user.country_id or trip_stats['home_country'],
                                        'birthday': request.user.birthday})
     return render(request, 'blog/profile.html', {'user': request.user,
-                                                 'form': form})
+                                                 'form': form,
+                                                 'stats': trip_stats})
+
+
+def metrics_view(request):
+    """Метрики запросов в формате Prometheus (см. blog.metrics)"""
+    if not request.user.is_staff and request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        raise Http404
+    return HttpResponse(metrics.render_text(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 @login_required
@@ -219,8 +503,43 @@ class CreateNewPostView(CreateView):
         post = form.save(commit=False)
         post.author = self.request.user
         post.save()
+        form.save_m2m()
         images = self.request.FILES.getlist('images')
         for image in images:
             ImagePostModel.objects.create(post=post,
                                           image=image)
-        return super().form_valid(form)
+        # Пост уже сохранен: повторный form.save() затер бы координаты, которые фото могли дать посту (place)
+        self.object = post
+        return redirect(self.get_success_url())
+
+
+class ImportTripView(LoginRequiredMixin, FormView):
+    """Создание постов из архива поездки из другого приложения (см. blog.trips)"""
+    form_class = ImportTripForm
+    template_name = 'blog/import_trip.html'
+    login_url = reverse_lazy('sign_in')
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['title'] = 'Импорт поездки'
+        return context
+
+    def form_valid(self, form):
+        try:
+            result = trips.import_archive(form.cleaned_data['archive'], self.request.user,
+                                          form.cleaned_data['emoji'])
+        except ValueError as error:
+            form.add_error('archive', str(error))
+            return self.form_invalid(form)
+        message = 'Импортировано постов: %s, фото: %s' % (result['posts'], result['images'])
+        if result['skipped']:
+            message += '. Фото без координат пропущено: %s' % len(result['skipped'])
+        return render(self.request, 'blog/message.html', {'title': 'Импорт поездки', 'message': message})
+
+
+@login_required
+def export_trip_view(request):
+    """Архив всех постов пользователя с фото, отдается по мере записи"""
+    response = StreamingHttpResponse(trips.export_archive(request.user), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="trips-%s.zip"' % request.user.slug
+    return response
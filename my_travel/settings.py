@@ -23,7 +23,8 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = 'django-insecure-_t99-v!4ry0i@uuqz-ix#eks-4e4_(bz-#zo-8d7otx@ep!c2y'
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+# В production задается DJANGO_DEBUG=0
+DEBUG = os.environ.get('DJANGO_DEBUG', '1') == '1'
 
 ALLOWED_HOSTS = ['192.168.19.133']
 
@@ -38,11 +39,11 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'blog.apps.BlogConfig',
-
-    'debug_toolbar',
 ]
 
 MIDDLEWARE = [
+    # Первым, чтобы в метрики запроса вошло время остальных middleware (см. blog.metrics)
+    'blog.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -50,18 +51,29 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'debug_toolbar.middleware.DebugToolbarMiddleware',
 ]
 
+# debug_toolbar нужен только при разработке
+if DEBUG:
+    INSTALLED_APPS.append('debug_toolbar')
+    MIDDLEWARE.append('debug_toolbar.middleware.DebugToolbarMiddleware')
+
 ROOT_URLCONF = 'my_travel.urls'
 
+TEMPLATE_LOADERS = [
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+]
+
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates с замером времени рендера для blog.metrics
+        'BACKEND': 'blog.metrics.TimedDjangoTemplates',
         'DIRS': [BASE_DIR / 'templates']
         ,
-        'APP_DIRS': True,
         'OPTIONS': {
+            # Без DEBUG шаблоны разбираются один раз на процесс и берутся из памяти
+            'loaders': TEMPLATE_LOADERS if DEBUG else [('django.template.loaders.cached.Loader', TEMPLATE_LOADERS)],
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -78,13 +90,72 @@ WSGI_APPLICATION = 'my_travel.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+SQLITE = {
+    # django.db.backends.sqlite3 с BEGIN IMMEDIATE в transaction.atomic(), см. blog.backends.sqlite3
+    'ENGINE': 'blog.backends.sqlite3',
+    'NAME': BASE_DIR / 'db.sqlite3',
+    'OPTIONS': {
+        'transaction_mode': 'IMMEDIATE',
+    },
 }
 
+POSTGRES = {
+    'ENGINE': 'django.db.backends.postgresql',
+    'NAME': os.environ.get('POSTGRES_DB', 'my_travel'),
+    'USER': os.environ.get('POSTGRES_USER', 'my_travel'),
+    'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+    'HOST': os.environ.get('POSTGRES_HOST', '127.0.0.1'),
+    'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+    # Постоянные соединения: соединение потока переиспользуется между запросами
+    'CONN_MAX_AGE': int(os.environ.get('POSTGRES_CONN_MAX_AGE', 600)),
+    # Соединение проверяется в начале каждого запроса, оборванное переоткрывается (см. blog.db)
+    'CONN_HEALTH_CHECKS': True,
+}
+
+# База выбирается переменной окружения DJANGO_DATABASE: sqlite (по умолчанию),
+# sqlite-replica, postgres или postgres-replica (нужен psycopg2, параметры из POSTGRES_*).
+# В профилях *-replica read-only представления читают из алиаса replica
+# (blog.routers). Для локальной проверки с SQLite реплика - копия файла базы:
+# sqlite3 db.sqlite3 ".backup db-replica.sqlite3". В тестах реплика - зеркало default.
+# Профиль sqlite тоже объявляет replica, но на тот же файл - роутер читает из default.
+DATABASE_PROFILES = {
+    'sqlite': {
+        'default': SQLITE,
+        'replica': dict(SQLITE, TEST={'MIRROR': 'default'}),
+    },
+    'sqlite-replica': {
+        'default': SQLITE,
+        'replica': dict(SQLITE, NAME=BASE_DIR / 'db-replica.sqlite3', TEST={'MIRROR': 'default'}),
+    },
+    'postgres': {
+        'default': POSTGRES,
+    },
+    'postgres-replica': {
+        'default': POSTGRES,
+        'replica': dict(POSTGRES,
+                        HOST=os.environ.get('POSTGRES_REPLICA_HOST', POSTGRES['HOST']),
+                        PORT=os.environ.get('POSTGRES_REPLICA_PORT', '5433'),
+                        TEST={'MIRROR': 'default'}),
+    },
+}
+
+DATABASES = DATABASE_PROFILES[os.environ.get('DJANGO_DATABASE', 'sqlite')]
+
+# PRAGMA, которые выполняются для каждого нового соединения с SQLite (blog.db)
+SQLITE_PRAGMAS = {
+    # WAL: чтение не блокирует запись и наоборот, одновременно пишет одно соединение
+    'journal_mode': 'wal',
+    # В режиме WAL fsync выполняется только при checkpoint, база остается согласованной при сбое
+    'synchronous': 'normal',
+    # Ждать освобождения блокировки до 5 с вместо немедленной ошибки "database is locked"
+    'busy_timeout': 5000,
+    'mmap_size': 128 * 1024 * 1024,
+    # Отрицательное значение - размер кэша страниц в КиБ
+    'cache_size': -32000,
+}
+
+DATABASE_ROUTERS = ['blog.routers.PrimaryReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -134,17 +205,65 @@ AUTH_USER_MODEL = 'blog.User'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 
-LOGIN_URL = '/sing_in/'
+LOGIN_URL = 'sign_in'
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
+# Очередь писем (blog.mail): размер пачки на одно соединение и повторные попытки
+EMAIL_OUTBOX_BATCH_SIZE = 50
+EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+EMAIL_OUTBOX_RETRY_DELAY = 60
+
 INTERNAL_IPS = [
     '127.0.0.1',
 ]
 
-CACHES = {
-    'default': {
+# Адреса, с которых /metrics/ доступен без входа (сервер Prometheus); сотрудникам доступен всегда
+METRICS_ALLOWED_IPS = INTERNAL_IPS
+
+# Бэкенд кэша выбирается переменной окружения DJANGO_CACHE: file (по умолчанию),
+# locmem или redis (нужен пакет django-redis, адрес берется из REDIS_URL).
+CACHE_PROFILES = {
+    'file': {
         'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
         'LOCATION': os.path.join(BASE_DIR, 'caches'),
-    }
-}
\ No newline at end of file
+    },
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'my_travel',
+    },
+    'redis': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379/1'),
+    },
+}
+
+CACHES = {
+    'default': CACHE_PROFILES[os.environ.get('DJANGO_CACHE', 'file')],
+}
+
+# Кэш фрагментов постов (blog.cache)
+FRAGMENT_CACHE_ALIAS = 'default'
+FRAGMENT_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Фоновые задачи (blog.tasks): обработка фото выполняется в пуле потоков
+BACKGROUND_TASKS_ASYNC = True
+BACKGROUND_WORKERS = 2
+
+# Перекодированное изображение держится в памяти до этого размера, дальше пишется на диск
+IMAGE_SPOOL_MAX_MEMORY = 2 * 1024 * 1024
+
+# Импорт поездок (blog.trips): постов в одной транзакции и предельный размер распакованного архива
+IMPORT_CHUNK_SIZE = 200
+IMPORT_MAX_SIZE = 512 * 1024 * 1024
+
+# Ближайшие посты (blog.nearby): как часто сверять индекс с базой, сколько постов на странице поста и в API
+NEARBY_REFRESH_INTERVAL = 5
+NEARBY_DETAIL_LIMIT = 5
+NEARBY_MAX_LIMIT = 100
+
+# Статистика поездок в профиле (blog.stats) хранится в кэше фрагментов
+TRIP_STATS_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+# Границы стран для офлайн-определения страны поста (blog.geocoder)
+COUNTRY_BOUNDARIES = os.path.join(BASE_DIR, 'blog', 'data', 'countries.geojson')